@@ -0,0 +1,21 @@
+"""
+ASGI config for aviatickets project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+The flights endpoints are served by async views (the FLIGHTS_ASYNC_VIEWS setting), so requests
+waiting for external suppliers do not occupy worker threads.
+
+    $ uvicorn aviatickets.asgi:application --workers 4
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aviatickets.settings')
+os.environ.setdefault('FLIGHTS_ASYNC_VIEWS', '1')
+
+application = get_asgi_application()
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ticketsapi.middleware.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,6 +71,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'aviatickets.wsgi.application'
+ASGI_APPLICATION = 'aviatickets.asgi.application'
 
 
 # Database
@@ -82,6 +84,10 @@ DATABASES = {
     }
 }
 
+# Type of implicit primary keys, existing migrations use AutoField
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -120,3 +126,99 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Flights data
+# Sources of flight data by the 'return' parameter: paths to XML files or URLs of external XML suppliers
+
+FLIGHTS_SOURCES = {
+    # Flights without return itineraries
+    '0': os.path.join(BASE_DIR, 'ticketsapi', 'xml_files', 'RS_ViaOW.xml'),
+    # Flights with return itineraries
+    '1': os.path.join(BASE_DIR, 'ticketsapi', 'xml_files', 'RS_Via-3.xml'),
+}
+
+# Settings of the HTTP client for external suppliers (see ticketsapi.handlers.suppliers.DEFAULT_CLIENT_SETTINGS)
+
+FLIGHTS_SUPPLIER_CLIENT = {
+    'TIMEOUT': 30,
+    'CONNECT_TIMEOUT': 5,
+    'MAX_CONNECTIONS': 100,
+    'MAX_CONCURRENCY': 20,
+}
+
+# Fan-out to several sources (the 'sources' parameter): default and maximum deadline in seconds
+# (longer 'deadline' parameters are cut to the maximum) and number of threads that parse local files
+
+FLIGHTS_FANOUT_DEADLINE = 5.0
+FLIGHTS_FANOUT_MAX_DEADLINE = 30.0
+FLIGHTS_FANOUT_WORKERS = 4
+
+# Maximum number of parsed XML responses kept in the process-wide cache
+
+FLIGHTS_CACHE_MAX_SIZE = 8
+
+# XML responses of this size (in bytes) or larger are streamed instead of being parsed and cached as a whole
+
+FLIGHTS_STREAMING_MIN_SIZE = 50 * 1024 * 1024
+
+# Engine for the getCheapest/getFastest/getOptimal queries: 'python' or 'numpy' (requires NumPy)
+
+FLIGHTS_ENGINE = 'python'
+
+# JSON serializer of flight responses: 'auto' (orjson if it is installed), 'orjson' or 'json'
+
+FLIGHTS_JSON_SERIALIZER = 'auto'
+
+# Encodings for pre-compressed responses, brotli is used only if the brotli package is installed
+
+FLIGHTS_PRECOMPRESS = ('br', 'gzip')
+
+# Per-stage timing of requests (parse, transform, rank, serialize): Server-Timing header
+# and histograms at /metrics. FLIGHTS_TIMING_LOG also writes one JSON line per request to the 'ticketsapi.timing' logger
+
+FLIGHTS_TIMING_ENABLED = False
+FLIGHTS_TIMING_LOG = False
+
+# Rows per INSERT when search responses are saved to the database (see the store_flights command)
+
+FLIGHTS_STORE_BATCH_SIZE = 1000
+
+# The route search checks for responses stored by other processes at most once in this many seconds
+# (see ticketsapi.handlers.flights_routes.get_timetable)
+
+FLIGHTS_ROUTES_CHECK_INTERVAL = 1.0
+
+# Background refresh of the sources (see ticketsapi.handlers.flights_refresh.DEFAULT_REFRESH_SETTINGS):
+# requests are served from snapshots younger than MAX_STALENESS seconds, snapshots older than INTERVAL
+# are refreshed in background
+
+FLIGHTS_REFRESH = {
+    'ENABLED': False,
+    'INTERVAL': 60,
+    'MAX_STALENESS': 600,
+}
+
+# Responses of external suppliers shared by all server processes of the host: the first process requests
+# the supplier, the others reuse its response for TTL seconds. Requires a POSIX system, disabled if DIRECTORY is None
+
+FLIGHTS_SHARED_RESULTS = {
+    'DIRECTORY': None,
+    'TTL': 2.0,
+}
+
+# Async views of the flights endpoints (see ticketsapi.views.flights_async_view). The ASGI application
+# enables them through the environment, the WSGI application serves the sync views
+
+FLIGHTS_ASYNC_VIEWS = os.environ.get('FLIGHTS_ASYNC_VIEWS', '0') == '1'
+
+# Price history of repeated searches (see ticketsapi.handlers.flights_history.DEFAULT_HISTORY_SETTINGS):
+# every received response is recorded to DIRECTORY, raw points are merged into hourly and daily points,
+# points older than the retention of their level are dropped. Disabled if DIRECTORY is None
+
+FLIGHTS_PRICE_HISTORY = {
+    'DIRECTORY': None,
+    'RAW_RETENTION': 2 * 24 * 3600,
+    'HOURLY_RETENTION': 60 * 24 * 3600,
+    'DAILY_RETENTION': None,
+}
@@ -15,19 +15,35 @@ Including another URLconf
 """
 # from django.contrib import admin
 from django.urls import path
+from django.conf import settings
 from django.conf.urls import url
 
-from ticketsapi.views import flights_view, flights_difference_view, methods_list
+from ticketsapi.views import (
+    flights_view, flights_async_view, flights_difference_view, flights_difference_async_view, flights_top_view,
+    methods_list, metrics_view, price_history_view, routes_view, stored_flights_view
+)
+
+# The ASGI application serves flights with async views (see aviatickets.asgi)
+if settings.FLIGHTS_ASYNC_VIEWS:
+    flights_handler, flights_difference_handler = flights_async_view, flights_difference_async_view
+else:
+    flights_handler, flights_difference_handler = flights_view, flights_difference_view
 
 
 urlpatterns = [
     # path('admin/', admin.site.urls),
     url('^$', methods_list),
-    url('flights.(getAll)', flights_view),
-    url('flights.(getMostExpensive)', flights_view),
-    url('flights.(getCheapest)', flights_view),
-    url('flights.(getLongest)', flights_view),
-    url('flights.(getFastest)', flights_view),
-    url('flights.(getOptimal)', flights_view),
-    path('flights.getDifference', flights_difference_view)
+    url('flights.(getAll)', flights_handler),
+    url('flights.(getMostExpensive)', flights_handler),
+    url('flights.(getCheapest)', flights_handler),
+    url('flights.(getLongest)', flights_handler),
+    url('flights.(getFastest)', flights_handler),
+    url('flights.(getOptimal)', flights_handler),
+    url('flights.(getSummary)', flights_handler),
+    path('flights.getDifference', flights_difference_handler),
+    path('flights.getTop', flights_top_view),
+    path('flights.getPriceHistory', price_history_view),
+    url('^stored.(getAll|getMostExpensive|getCheapest|getLongest|getFastest)$', stored_flights_view),
+    url('^routes.(getEarliestArrival|getFewestStops)$', routes_view),
+    path('metrics', metrics_view)
 ]
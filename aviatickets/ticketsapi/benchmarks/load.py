@@ -0,0 +1,215 @@
+"""
+This file contains the load test of the flights views: many concurrent searches served by one process.
+
+The application is called in-process, without network servers: the WSGI application by a pool of worker threads
+(like a threaded WSGI server), the ASGI application on an event loop (like an ASGI server).
+Sources are served by the fake supplier with latency, so searches spend most of their time waiting for it.
+Every application runs in a child process with its own URL configuration (see the FLIGHTS_ASYNC_VIEWS setting).
+"""
+import asyncio
+import importlib
+import multiprocessing
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os.path import basename, join
+from statistics import median
+from threading import Lock, Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.test import override_settings
+from django.urls import clear_url_caches
+
+from ticketsapi.management.commands.fake_supplier import create_app, web
+
+APPLICATIONS = ('wsgi', 'asgi')
+
+
+class InFlight:
+    """
+    Number of requests being processed by the application and its peak
+    """
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self.current -= 1
+        return False
+
+
+def start_fake_supplier(directory, latency, jitter=0):
+    """
+    Runs the fake supplier on a free port in a daemon thread
+
+    :param directory: <class 'str'> - directory with XML files
+    :param latency: <class 'int'> - delay before each response, ms
+    :param jitter: <class 'int'> - random addition to the delay, ms
+    :return: <class 'str'> - base URL of the supplier
+    """
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_app(directory, latency, jitter))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    Thread(target=loop.run_forever, name='fake-supplier', daemon=True).start()
+    host, port = runner.addresses[0][:2]
+    return 'http://{}:{}/'.format(host, port)
+
+
+def get_percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def call_wsgi(application, url, in_flight):
+    """
+    :param application: WSGI application
+    :param url: <class 'str'> - path with the query string, e.g. '/flights.getCheapest?return=0'
+    :param in_flight: <class 'InFlight'>
+    :return: <class 'int'> - HTTP status
+    """
+    parts = urlsplit(url)
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': parts.path, 'QUERY_STRING': parts.query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'wsgi.url_scheme': 'http',
+        'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+    }
+    statuses = []
+    with in_flight:
+        body = application(environ, lambda status, headers, exc_info=None: statuses.append(status))
+        for _ in body:
+            pass
+        body.close()
+    return int(statuses[0].split()[0])
+
+
+async def call_asgi(application, url, in_flight):
+    """
+    :param application: ASGI application
+    :param url: <class 'str'> - path with the query string
+    :param in_flight: <class 'InFlight'>
+    :return: <class 'int'> - HTTP status
+    """
+    parts = urlsplit(url)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': parts.path, 'raw_path': parts.path.encode(), 'query_string': parts.query.encode(), 'root_path': '',
+        'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    with in_flight:
+        await application(scope, receive, send)
+    return next(message['status'] for message in messages if message['type'] == 'http.response.start')
+
+
+def run_wsgi(url, requests, threads):
+    """
+    :return: <class 'tuple'> - (latencies in seconds, statuses, peak number of requests in flight)
+    """
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+    in_flight = InFlight()
+
+    def call(submitted):
+        status = call_wsgi(application, url, in_flight)
+        # Time in the queue of the worker threads is a part of the latency seen by clients
+        return perf_counter() - submitted, status
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(call, [perf_counter() for _ in range(requests)]))
+    return [latency for latency, _ in results], [status for _, status in results], in_flight.peak
+
+
+def run_asgi(url, requests, concurrency):
+    """
+    :return: <class 'tuple'> - (latencies in seconds, statuses, peak number of requests in flight)
+    """
+    from django.core.asgi import get_asgi_application
+    application = get_asgi_application()
+    in_flight = InFlight()
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call():
+            async with semaphore:
+                start = perf_counter()
+                status = await call_asgi(application, url, in_flight)
+                return perf_counter() - start, status
+
+        return await asyncio.gather(*(call() for _ in range(requests)))
+
+    results = asyncio.run(main())
+    return [latency for latency, _ in results], [status for _, status in results], in_flight.peak
+
+
+def run_in_child(queue, app, url, requests, concurrency, threads, sources):
+    with override_settings(FLIGHTS_ASYNC_VIEWS=app == 'asgi', FLIGHTS_SOURCES=sources):
+        # The URL configuration chooses the views when it is imported
+        clear_url_caches()
+        importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+        start = perf_counter()
+        if app == 'asgi':
+            latencies, statuses, peak = run_asgi(url, requests, concurrency)
+        else:
+            latencies, statuses, peak = run_wsgi(url, requests, threads)
+        queue.put((perf_counter() - start, latencies, statuses, peak))
+
+
+def run_load_test(url, apps=APPLICATIONS, requests=500, concurrency=100, threads=8, latency=300, jitter=0,
+                  directory=None, log=print):
+    """
+    Sends concurrent searches to the applications
+
+    :param url: <class 'str'> - path with the query string, e.g. '/flights.getCheapest'
+    :param apps: names of the applications: 'wsgi', 'asgi'
+    :param requests: <class 'int'> - number of requests to every application
+    :param concurrency: <class 'int'> - maximum number of requests sent at the same time
+    :param threads: <class 'int'> - worker threads of the WSGI application
+    :param latency: <class 'int'> - latency of the fake supplier, ms
+    :param jitter: <class 'int'> - random addition to the latency, ms
+    :param directory: <class 'str'> - directory with XML files served by the supplier (bundled files by default)
+    :param log: function that receives progress messages
+    :return: list with records
+    """
+    directory = directory or join(settings.BASE_DIR, 'ticketsapi', 'xml_files')
+    supplier_url = start_fake_supplier(directory, latency, jitter)
+    sources = {name: supplier_url + basename(path) for name, path in settings.FLIGHTS_SOURCES.items()}
+
+    context = multiprocessing.get_context('fork')
+    records = []
+    for app in apps:
+        log('{}: {} requests to {}'.format(app, requests, url))
+        queue = context.Queue()
+        process = context.Process(
+            target=run_in_child, args=(queue, app, url, requests, concurrency, threads, sources)
+        )
+        process.start()
+        seconds, latencies, statuses, peak = queue.get()
+        process.join()
+        records.append({
+            'benchmark': 'load' + url, 'app': app, 'requests': requests,
+            'concurrency': concurrency if app == 'asgi' else threads, 'supplier_latency_ms': latency,
+            'seconds': seconds, 'requests_per_second': requests / seconds, 'peak_in_flight': peak,
+            'errors': sum(1 for status in statuses if status != 200),
+            'latency_p50_ms': median(latencies) * 1000, 'latency_p99_ms': get_percentile(latencies, 99) * 1000,
+        })
+    return records
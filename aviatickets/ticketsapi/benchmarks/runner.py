@@ -0,0 +1,240 @@
+"""
+This file contains the benchmarks of the parser, the handlers and the flights views.
+
+Every benchmark returns a record: a dictionary with the benchmark name, the document parameters
+and the measured values. Records are saved as JSON by the 'benchmark' management command.
+"""
+import multiprocessing
+import resource
+from os.path import getsize, join
+from statistics import median
+from time import perf_counter
+
+from django.test import Client, override_settings
+
+from ticketsapi.benchmarks.synthetic import write_response
+from ticketsapi.handlers import flights_columns
+from ticketsapi.handlers.flights_diff import iter_difference_json
+from ticketsapi.handlers.flights_handler import flights_cache, get_by, get_difference, get_optimal
+from ticketsapi.handlers.flights_parser import from_xml_to_dict, from_xml_to_result
+from ticketsapi.handlers.flights_snapshot import SUFFIX, open_snapshot, write_snapshot
+
+# Values of records that are compared between runs, lower is better
+COMPARED_VALUES = ('seconds', 'peak_memory_kb')
+
+VIEW_URLS = (
+    '/flights.getAll', '/flights.getAll?limit=20&max_stops=1', '/flights.getCheapest', '/flights.getFastest',
+    '/flights.getOptimal', '/flights.getSummary', '/flights.getTop?k=20', '/flights.getDifference'
+)
+
+
+def measure(func, repeat):
+    """
+    Runs the function several times
+
+    :param func: function without arguments
+    :param repeat: <class 'int'> - number of runs
+    :return: <class 'float'> - median time of one run, seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return median(times)
+
+
+def run_in_child(queue, parser, path):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    parser(path)
+    seconds = perf_counter() - start
+    queue.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+
+
+def measure_parser(parser, path):
+    """
+    Runs the parser in a child process, so the peak memory of the process is not affected by other benchmarks
+
+    :param parser: function that receives the path of the XML file
+    :param path: <class 'str'> - path of the XML file
+    :return: <class 'tuple'> - (time in seconds, growth of the peak resident memory in KB)
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=run_in_child, args=(queue, parser, path))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def generate_documents(directory, size):
+    """
+    Generates one-way and return documents of the size
+
+    :param directory: <class 'str'> - directory for the documents
+    :param size: <class 'int'> - number of priced options
+    :return: dictionary: 'one_way'/'return' -> path of the document
+    """
+    paths = {}
+    for name, return_tickets in (('one_way', False), ('return', True)):
+        paths[name] = join(directory, 'synthetic_{}_{}.xml'.format(name, size))
+        write_response(paths[name], size, return_tickets=return_tickets, seed=size)
+    return paths
+
+
+def benchmark_parser(paths, size):
+    """
+    Measures throughput and peak memory of from_xml_to_dict, from_xml_to_result
+    and of opening the snapshot of the document (megabytes are counted by the XML document)
+    """
+    records = []
+    for name, path in sorted(paths.items()):
+        megabytes = getsize(path) / 2 ** 20
+        snapshot_path = path + SUFFIX
+        write_snapshot(from_xml_to_result(path), snapshot_path)
+        parsers = (
+            ('from_xml_to_dict', from_xml_to_dict, path), ('from_xml_to_result', from_xml_to_result, path),
+            ('open_snapshot', open_snapshot, snapshot_path)
+        )
+        for parser_name, parser, parser_path in parsers:
+            seconds, peak_memory_kb = measure_parser(parser, parser_path)
+            records.append({
+                'benchmark': 'parser.' + parser_name, 'size': size, 'document': name,
+                'seconds': seconds, 'peak_memory_kb': peak_memory_kb,
+                'options_per_second': size / seconds, 'megabytes_per_second': megabytes / seconds
+            })
+    return records
+
+
+def get_query_run(query, result, engine, mode):
+    """
+    :param query: function that receives a search result and the engine
+    :param result: <class 'SearchResult'> with flights data
+    :param engine: <class 'str'> - 'python' or 'numpy'
+    :param mode: <class 'str'> - 'cold' runs get a copy of the result without derived data, 'warm' runs reuse it
+    :return: function without arguments that runs the query once
+    """
+    def run():
+        return query(result.replace(result.options) if mode == 'cold' else result, engine)
+
+    return run
+
+
+def benchmark_handlers(paths, size, repeat):
+    """
+    Measures latency of get_by, get_optimal for every engine, get_difference and the full difference.
+    'cold' runs use a fresh copy of the result, so no memoized columns or summaries are reused.
+    """
+    engines = ['python'] + (['numpy'] if flights_columns.is_available() else [])
+    results = {name: from_xml_to_result(path) for name, path in paths.items()}
+    queries = {
+        'get_by.price.min': lambda flights, engine: get_by('price', flights, min, engine),
+        'get_by.price.max': lambda flights, engine: get_by('price', flights, max, engine),
+        'get_by.duration.min': lambda flights, engine: get_by('duration', flights, min, engine),
+        'get_by.duration.max': lambda flights, engine: get_by('duration', flights, max, engine),
+        'get_optimal': lambda flights, engine: get_optimal(flights, engine),
+    }
+
+    records = []
+    for name, result in sorted(results.items()):
+        for engine in engines:
+            for query_name, query in queries.items():
+                for mode in ('cold', 'warm'):
+                    records.append({
+                        'benchmark': 'handlers.' + query_name, 'size': size, 'document': name,
+                        'engine': engine, 'mode': mode,
+                        'seconds': measure(get_query_run(query, result, engine, mode), repeat)
+                    })
+
+    records.append({
+        'benchmark': 'handlers.get_difference', 'size': size, 'document': 'one_way/return',
+        'seconds': measure(lambda: get_difference(results['one_way'], results['return']), repeat)
+    })
+    # Full difference of two versions of the same response, chain indexes are built on every run
+    changed = results['return'].replace(results['return'].options[1:])
+    records.append({
+        'benchmark': 'handlers.iter_difference_json', 'size': size, 'document': 'return',
+        'seconds': measure(lambda: b''.join(iter_difference_json(
+            results['return'].replace(results['return'].options), changed.replace(changed.options)
+        )), repeat)
+    })
+    return records
+
+
+def benchmark_views(paths, size, requests):
+    """
+    Measures requests per second of the flights views through the Django test client.
+    The documents are parsed before the measurement, so the parse time is not included.
+    """
+    client = Client(HTTP_HOST='localhost')
+    records = []
+    with override_settings(FLIGHTS_SOURCES={'0': paths['one_way'], '1': paths['return']}):
+        flights_cache.clear()
+        for url in VIEW_URLS:
+            client.get(url)
+            seconds = measure(lambda: client.get(url), requests) * requests
+            records.append({
+                'benchmark': 'views' + url, 'size': size, 'document': 'return',
+                'seconds': seconds / requests, 'requests_per_second': requests / seconds
+            })
+        flights_cache.clear()
+    return records
+
+
+def run_benchmarks(sizes, directory, repeat=5, requests=50, parts=('parser', 'handlers', 'views'), log=print):
+    """
+    Generates the documents and runs the benchmarks
+
+    :param sizes: list with numbers of priced options
+    :param directory: <class 'str'> - directory for the generated documents
+    :param repeat: <class 'int'> - number of runs of every handler benchmark
+    :param requests: <class 'int'> - number of requests of every view benchmark
+    :param parts: names of the benchmark groups to run
+    :param log: function that receives progress messages
+    :return: list with records
+    """
+    records = []
+    for size in sizes:
+        log('Generating documents with {} options'.format(size))
+        paths = generate_documents(directory, size)
+        if 'parser' in parts:
+            log('Parser, {} options'.format(size))
+            records += benchmark_parser(paths, size)
+        if 'handlers' in parts:
+            log('Handlers, {} options'.format(size))
+            records += benchmark_handlers(paths, size, repeat)
+        if 'views' in parts:
+            log('Views, {} options'.format(size))
+            records += benchmark_views(paths, size, requests)
+    return records
+
+
+def get_record_key(record):
+    """
+    :param record: dictionary with benchmark results
+    :return: <class 'tuple'> that identifies the benchmark between runs
+    """
+    return tuple(record.get(name) for name in ('benchmark', 'size', 'document', 'engine', 'mode'))
+
+
+def compare(records, previous_records, threshold):
+    """
+    Compares records with records of a previous run
+
+    :param records: list with records of this run
+    :param previous_records: list with records of the previous run
+    :param threshold: <class 'float'> - allowed slowdown, e.g. 0.2 for 20%
+    :return: list with (key, value name, previous value, value, ratio) for regressions only
+    """
+    previous = {get_record_key(record): record for record in previous_records}
+    regressions = []
+    for record in records:
+        old = previous.get(get_record_key(record))
+        if old is None:
+            continue
+        for name in COMPARED_VALUES:
+            if record.get(name) and old.get(name) and record[name] > old[name] * (1 + threshold):
+                regressions.append((get_record_key(record), name, old[name], record[name], record[name] / old[name]))
+    return regressions
@@ -0,0 +1,106 @@
+"""
+This file contains the generator of synthetic AirFareSearchResponse documents for benchmarks.
+
+Documents are written incrementally, so responses with millions of priced options
+can be generated in constant memory.
+"""
+import random
+from datetime import datetime, timedelta
+
+from lxml import etree
+
+CARRIERS = (
+    ('AI', 'AirIndia'), ('EK', 'Emirates'), ('TG', 'ThaiAirways'), ('QR', 'QatarAirways'),
+    ('EY', 'EtihadAirways'), ('SQ', 'SingaporeAirlines'), ('9W', 'JetAirways'), ('FZ', 'flydubai')
+)
+HUBS = ('DEL', 'BOM', 'DOH', 'AUH', 'SIN', 'KUL', 'MCT', 'CMB')
+PASSENGER_TYPES = ('SingleAdult', 'SingleChild', 'SingleInfant')
+
+
+def write_flight(xf, rnd, carrier, source, destination, departure, duration):
+    """
+    Writes one Flight tag
+
+    :return: <class 'datetime.datetime'> - arrival time
+    """
+    arrival = departure + duration
+    with xf.element('Flight'):
+        for tag, text, attrib in (
+            ('Carrier', carrier[1], {'id': carrier[0]}),
+            ('FlightNumber', str(rnd.randint(1, 9999)), {}),
+            ('Source', source, {}),
+            ('Destination', destination, {}),
+            ('DepartureTimeStamp', departure.strftime('%Y-%m-%dT%H%M'), {}),
+            ('ArrivalTimeStamp', arrival.strftime('%Y-%m-%dT%H%M'), {}),
+            ('Class', rnd.choice('GUVYKLMN'), {}),
+            ('NumberOfStops', '0', {}),
+            ('FareBasis', '{:032x}'.format(rnd.getrandbits(128)), {}),
+            ('WarningText', None, {}),
+            ('TicketType', 'E', {}),
+        ):
+            element = etree.Element(tag, attrib)
+            element.text = text
+            xf.write(element)
+    return arrival
+
+
+def write_itinerary(xf, rnd, tag, source, destination, date):
+    """
+    Writes one OnwardPricedItinerary/ReturnPricedItinerary tag with 1-3 segments
+    """
+    carrier = rnd.choice(CARRIERS)
+    airports = [source] + rnd.sample(HUBS, rnd.randint(0, 2)) + [destination]
+    departure = date + timedelta(minutes=rnd.randrange(0, 24 * 60, 5))
+    with xf.element(tag):
+        with xf.element('Flights'):
+            for segment_source, segment_destination in zip(airports, airports[1:]):
+                arrival = write_flight(
+                    xf, rnd, carrier, segment_source, segment_destination, departure,
+                    timedelta(minutes=rnd.randrange(60, 8 * 60, 5))
+                )
+                departure = arrival + timedelta(minutes=rnd.randrange(45, 12 * 60, 5))
+
+
+def write_pricing(xf, rnd, passenger_types):
+    with xf.element('Pricing', currency='SGD'):
+        for passenger_type in passenger_types:
+            base_fare = rnd.randint(5000, 150000)
+            taxes = rnd.randint(0, 30000)
+            for charge_type, amount in (
+                ('BaseFare', base_fare), ('AirlineTaxes', taxes), ('TotalAmount', base_fare + taxes)
+            ):
+                element = etree.Element('ServiceCharges', type=passenger_type, ChargeType=charge_type)
+                element.text = '{}.{:02d}'.format(*divmod(amount, 100))
+                xf.write(element)
+
+
+def write_response(output, options, return_tickets=True, seed=0, source='DXB', destination='BKK'):
+    """
+    Writes a synthetic AirFareSearchResponse document
+
+    :param output: path of the file or binary file-like object
+    :param options: <class 'int'> - number of priced itineraries
+    :param return_tickets: <class 'bool'> - whether itineraries have return flights
+    :param seed: seed of the random generator, equal seeds produce equal documents
+    :param source: <class 'str'> - departure airport code
+    :param destination: <class 'str'> - arrival airport code
+    """
+    rnd = random.Random(seed)
+    onward_date = datetime(2018, 10, 22)
+    return_date = onward_date + timedelta(days=8)
+    passenger_types = PASSENGER_TYPES if not return_tickets else PASSENGER_TYPES[:1]
+
+    with etree.xmlfile(output, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('AirFareSearchResponse', RequestTime='28-09-2015 20:23:49',
+                        ResponseTime='28-09-2015 20:23:56'):
+            request_id = etree.Element('RequestId')
+            request_id.text = '{:08X}'.format(seed)
+            xf.write(request_id)
+            with xf.element('PricedItineraries'):
+                for _ in range(options):
+                    with xf.element('Flights'):
+                        write_itinerary(xf, rnd, 'OnwardPricedItinerary', source, destination, onward_date)
+                        if return_tickets:
+                            write_itinerary(xf, rnd, 'ReturnPricedItinerary', destination, source, return_date)
+                        write_pricing(xf, rnd, passenger_types)
@@ -0,0 +1,37 @@
+"""
+This file contains the errors of flight data processing.
+
+Fatal errors are raised as subclasses of FlightsError, every class knows its HTTP status,
+so views turn them into responses in one place (see views.handle_flights_errors).
+Errors in one priced itinerary are not fatal: the itinerary is skipped and counted (see ITEM_ERRORS).
+"""
+
+
+class FlightsError(Exception):
+    """
+    Base class of fatal errors
+    """
+    status = 500
+    error = 'Internal Server Error (500)'
+
+
+class SourceError(FlightsError):
+    """
+    The source of flight data (a local file or an external supplier) is unavailable
+    or its response can not be used
+    """
+    status = 502
+    error = 'Bad Gateway (502)'
+
+
+class ParseError(SourceError):
+    """
+    The XML response is malformed or does not contain required response data
+    """
+    status = 422
+    error = 'Unprocessable Entity (422)'
+
+
+# Errors raised by parsing and converting one priced itinerary with missing or wrong tags and values.
+# decimal.InvalidOperation is an ArithmeticError.
+ITEM_ERRORS = (AttributeError, KeyError, IndexError, TypeError, ValueError, ArithmeticError)
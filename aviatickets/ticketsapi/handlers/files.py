@@ -0,0 +1,24 @@
+"""
+This file contains writing of files that are read by other processes and threads while they are replaced.
+"""
+import os
+from threading import get_ident
+
+
+def write_atomically(path, write):
+    """
+    Writes the file to a temporary file next to it and renames it over the file,
+    so readers see either the old or the new file, never a partial one.
+    The temporary file is removed if writing fails.
+
+    :param path: <class 'str'> - path of the file
+    :param write: function that receives the binary file object and writes the data
+    """
+    temporary_path = '{}.{}.{}.tmp'.format(path, os.getpid(), get_ident())
+    try:
+        with open(temporary_path, 'wb') as output:
+            write(output)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
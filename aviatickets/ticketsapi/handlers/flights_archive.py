@@ -0,0 +1,470 @@
+"""
+This file contains reading of compressed XML responses and archives of responses.
+
+Compressed files (gzip, xz and zstd, recognized by their magic bytes, not by the name) are opened
+as streams that decompress the data while the parser reads it (see open_source): no temporary files
+are written and the decompressed document is never kept in memory as a whole. zstd requires the zstandard package.
+
+An archive (ARCHIVE_SUFFIX) keeps many responses in one file: every member is compressed separately,
+so one response is read without decompressing the others. A member is addressed as 'path.xmlar#name'.
+Layout: magic, compressed members, JSON index, footer: index offset and length (uint64), magic.
+The index has the compression and offset, compressed length and size of every member (see write_archive).
+"""
+import gzip
+import json
+import lzma
+import os
+import struct
+import zlib
+from functools import lru_cache
+from io import RawIOBase
+
+from ticketsapi.handlers.errors import ParseError, SourceError
+from ticketsapi.handlers.files import write_atomically
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_SUFFIX = '.xmlar'
+ARCHIVE_MAGIC = b'AFARCH\x00\x01'
+FOOTER = struct.Struct('<QQ8s')
+CHUNK_SIZE = 64 * 1024
+
+# Compression -> magic bytes at the start of the compressed data
+MAGIC_BYTES = {
+    'gzip': b'\x1f\x8b',
+    'xz': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+}
+# Compression -> suffix of compressed files written by compress_file
+SUFFIXES = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+COMPRESSIONS = tuple(SUFFIXES)
+
+# Errors raised while reading corrupted or truncated compressed data
+DECOMPRESSION_ERRORS = (EOFError, zlib.error, lzma.LZMAError) + (
+    (gzip.BadGzipFile,) if hasattr(gzip, 'BadGzipFile') else ()
+) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def is_available(compression):
+    """
+    :param compression: <class 'str'> - one of COMPRESSIONS
+    :return: True if the compression can be read and written
+    """
+    return compression != 'zstd' or zstandard is not None
+
+
+def split_source(source):
+    """
+    :param source: <class 'str'> - path of a file or 'path.xmlar#name' of an archive member
+    :return: <class 'tuple'> - (path of the file, name of the member or None)
+    """
+    path, separator, name = source.partition(ARCHIVE_SUFFIX + '#')
+    if not separator:
+        return source, None
+    return path + ARCHIVE_SUFFIX, name
+
+
+def detect_compression(file):
+    """
+    :param file: file object open for reading in binary mode at the start of the data, the position is not changed
+    :return: <class 'str'> - one of COMPRESSIONS or None if the data is not compressed
+    """
+    start = file.peek(8)[:8] if hasattr(file, 'peek') else b''
+    for compression, magic in MAGIC_BYTES.items():
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+class DecompressedFile(RawIOBase):
+    """
+    Decompressed data of a binary file object, the file is closed with the reader
+    """
+
+    def __init__(self, file, stream):
+        """
+        :param file: binary file object with compressed data
+        :param stream: decompressing file object that reads the file
+        """
+        self.file = file
+        self.stream = stream
+        self.name = file.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.stream.readinto(buffer)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            self.file.close()
+        super().close()
+
+
+def decompress_stream(file, compression):
+    """
+    :param file: binary file object with compressed data, it is closed with the returned file object
+    :param compression: <class 'str'> - one of COMPRESSIONS or None
+    :return: file object that returns the decompressed data
+    :raise SourceError: if the compression is not available
+    """
+    if compression is None:
+        return file
+    if compression == 'gzip':
+        return DecompressedFile(file, gzip.GzipFile(fileobj=file, mode='rb'))
+    if compression == 'xz':
+        return DecompressedFile(file, lzma.LZMAFile(file, mode='rb'))
+    if zstandard is None:
+        raise SourceError('{} is compressed with zstd, the zstandard package is required'.format(file.name))
+    return DecompressedFile(file, zstandard.ZstdDecompressor().stream_reader(file, read_size=CHUNK_SIZE))
+
+
+class MemberReader(RawIOBase):
+    """
+    Reads the bytes of one member from the archive file
+    """
+
+    def __init__(self, file, offset, length):
+        """
+        :param file: binary file object of the archive, it is closed with the reader
+        :param offset: <class 'int'> - position of the member in the archive
+        :param length: <class 'int'> - compressed length of the member
+        """
+        self.file = file
+        self.name = file.name
+        self.remaining = length
+        file.seek(offset)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.file.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+        self.remaining -= size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+@lru_cache(maxsize=32)
+def read_index(path, mtime_ns, size):
+    """
+    Reads the index of the archive, the index of every version of the file is read once
+
+    :param path: <class 'str'> - path of the archive
+    :param mtime_ns: <class 'int'> - modification time of the archive (part of the cache key)
+    :param size: <class 'int'> - size of the archive in bytes
+    :return: dictionary with 'compression' and 'members': name -> [offset, compressed length, size]
+    :raise ParseError: if the file is not an archive or the index is damaged
+    """
+    with open(path, 'rb') as archive:
+        if size < len(ARCHIVE_MAGIC) + FOOTER.size or archive.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ParseError('{} is not an archive of responses'.format(path))
+        archive.seek(size - FOOTER.size)
+        index_offset, index_length, magic = FOOTER.unpack(archive.read(FOOTER.size))
+        if magic != ARCHIVE_MAGIC or index_offset + index_length > size - FOOTER.size:
+            raise ParseError('{} is truncated'.format(path))
+        archive.seek(index_offset)
+        try:
+            index = json.loads(archive.read(index_length))
+            index['members'] = {name: member for name, *member in index['members']}
+        except (ValueError, KeyError, TypeError) as error:
+            raise ParseError('{} has a malformed index: {}'.format(path, error)) from error
+    return index
+
+
+def get_index(path):
+    """
+    :param path: <class 'str'> - path of the archive
+    :return: dictionary with the index of the archive (see read_index)
+    :raise SourceError: if the archive can not be read
+    :raise ParseError: if the file is not an archive or the index is damaged
+    """
+    try:
+        file_stat = os.stat(path)
+        return read_index(path, file_stat.st_mtime_ns, file_stat.st_size)
+    except OSError as error:
+        raise SourceError('{} can not be read: {}'.format(path, error)) from error
+
+
+def open_source(source):
+    """
+    Opens the XML data of the source for reading
+
+    :param source: <class 'str'> - path of an XML file, a compressed XML file or 'path.xmlar#name' of an archive member
+    :return: binary file object with the decompressed XML data
+    :raise SourceError: if the file or the member can not be read
+    :raise ParseError: if the archive is damaged
+    """
+    path, name = split_source(source)
+    if name is None:
+        try:
+            file = open(path, 'rb')
+        except OSError as error:
+            raise SourceError('{} can not be read: {}'.format(path, error)) from error
+        try:
+            return decompress_stream(file, detect_compression(file))
+        except BaseException:
+            file.close()
+            raise
+
+    index = get_index(path)
+    member = index['members'].get(name)
+    if member is None:
+        raise SourceError('{} has no response {}'.format(path, name))
+    offset, length, _ = member
+    try:
+        file = open(path, 'rb')
+    except OSError as error:
+        raise SourceError('{} can not be read: {}'.format(path, error)) from error
+    reader = MemberReader(file, offset, length)
+    try:
+        return decompress_stream(reader, index['compression'])
+    except BaseException:
+        reader.close()
+        raise
+
+
+def read_varint(data, position):
+    """
+    :param data: <class 'bytes'> - data of the xz index
+    :param position: <class 'int'> - position of the multibyte integer
+    :return: <class 'tuple'> - (integer, position after it)
+    :raise ValueError: if the integer is truncated or longer than 9 bytes
+    """
+    value = 0
+    for shift in range(0, 63, 7):
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+    raise ValueError('Too long integer')
+
+
+def get_xz_size(file, file_size):
+    """
+    Sums the uncompressed sizes stored in the indexes of all xz streams of the file (read from the end)
+
+    :param file: binary file object of the xz file
+    :param file_size: <class 'int'> - size of the file in bytes
+    :return: <class 'int'> - size of the decompressed data or None if the file is damaged
+    """
+    size, end = 0, file_size
+    while end > 0:
+        file.seek(end - 4)
+        if file.read(4) == b'\x00' * 4:
+            # Stream padding
+            end -= 4
+            continue
+        if end < 24:
+            return None
+        file.seek(end - 12)
+        footer = file.read(12)
+        if footer[10:] != b'YZ':
+            return None
+        index_length = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        index_start = end - 12 - index_length
+        if index_start < 12:
+            return None
+        file.seek(index_start)
+        index = file.read(index_length)
+        try:
+            count, position = read_varint(index, 1)
+            blocks_length = 0
+            for _ in range(count):
+                unpadded_size, position = read_varint(index, position)
+                uncompressed_size, position = read_varint(index, position)
+                blocks_length += (unpadded_size + 3) & ~3
+                size += uncompressed_size
+        except (IndexError, ValueError):
+            return None
+        end = index_start - blocks_length - 12
+        if index[0] != 0 or end < 0:
+            return None
+        file.seek(end)
+        if file.read(6) != MAGIC_BYTES['xz']:
+            return None
+    return size
+
+
+def get_zstd_size(file, file_size):
+    """
+    Sums the content sizes of all zstd frames of the file, blocks of the frames are skipped by their headers
+
+    :param file: binary file object of the zstd file
+    :param file_size: <class 'int'> - size of the file in bytes
+    :return: <class 'int'> - size of the decompressed data or None if a frame has no content size or is damaged
+    """
+    size, position = 0, 0
+    while position < file_size:
+        file.seek(position)
+        header = file.read(18)
+        magic = struct.unpack('<I', header[:4])[0] if len(header) >= 4 else None
+        if magic is not None and magic & 0xfffffff0 == 0x184d2a50:
+            # Skippable frame
+            position += 8 + struct.unpack('<I', header[4:8])[0]
+            continue
+        if not header.startswith(MAGIC_BYTES['zstd']):
+            return None
+        content_size = zstandard.frame_content_size(header)
+        if content_size < 0:
+            return None
+        size += content_size
+        position += zstandard.frame_header_size(header)
+        last = False
+        while not last:
+            file.seek(position)
+            block = file.read(3)
+            if len(block) < 3:
+                return None
+            block_header = int.from_bytes(block, 'little')
+            last, block_type = block_header & 1, block_header >> 1 & 3
+            if block_type == 3:
+                return None
+            position += 3 + (1 if block_type == 1 else block_header >> 3)
+        if zstandard.get_frame_parameters(header).has_checksum:
+            position += 4
+    return size if position == file_size else None
+
+
+@lru_cache(maxsize=32)
+def read_compressed_size(path, mtime_ns, size):
+    """
+    Reads the size of the decompressed data of the compressed file, every version of the file is read once
+
+    :param path: <class 'str'> - path of the file
+    :param mtime_ns: <class 'int'> - modification time of the file (part of the cache key)
+    :param size: <class 'int'> - size of the file in bytes
+    :return: <class 'int'> - size in bytes, the size of the file if it is not compressed,
+    None if the size is not stored reliably: gzip keeps only the size of the last member modulo 4 GiB
+    """
+    with open(path, 'rb') as file:
+        compression = detect_compression(file)
+        try:
+            if compression is None:
+                return size
+            if compression == 'xz':
+                return get_xz_size(file, size)
+            if compression == 'zstd' and zstandard is not None:
+                return get_zstd_size(file, size)
+        except DECOMPRESSION_ERRORS + (ValueError, struct.error):
+            return None
+    return None
+
+
+def get_source_size(source):
+    """
+    Returns the size of the XML data of the source: the size of the member for archive members,
+    the size stored in the xz index or the zstd frames for compressed files, else the size of the file
+
+    :param source: <class 'str'> - path of a file or 'path.xmlar#name' of an archive member
+    :return: <class 'int'> - size in bytes or None if it is unknown (gzip files, zstd frames without the size)
+    :raise SourceError: if the file can not be read
+    """
+    path, name = split_source(source)
+    if name is not None:
+        member = get_index(path)['members'].get(name)
+        if member is None:
+            raise SourceError('{} has no response {}'.format(path, name))
+        return member[2]
+    try:
+        file_stat = os.stat(path)
+        return read_compressed_size(path, file_stat.st_mtime_ns, file_stat.st_size)
+    except OSError as error:
+        raise SourceError('{} can not be read: {}'.format(path, error)) from error
+
+
+def get_compressor(compression, level=None, size=None):
+    """
+    :param compression: <class 'str'> - one of COMPRESSIONS
+    :param level: <class 'int'> - compression level or None for the default one
+    :param size: <class 'int'> - size of the data, it is written to the zstd frame (see get_source_size), or None
+    :return: object with compress(data) and flush() methods that writes one gzip member, xz stream or zstd frame
+    """
+    if compression == 'gzip':
+        return zlib.compressobj(9 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'xz':
+        return lzma.LZMACompressor(preset=level)
+    if compression == 'zstd' and zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return compressor.compressobj(size=-1 if size is None else size)
+    raise ValueError('Compression {} is not available'.format(compression))
+
+
+def copy_compressed(source, output, compressor):
+    """
+    Reads the XML data of the source chunk by chunk and writes it compressed
+
+    :param source: <class 'str'> - path of an XML file, a compressed XML file or an archive member
+    :param output: binary file object
+    :param compressor: see get_compressor
+    :return: <class 'tuple'> - (compressed length, size of the XML data)
+    """
+    length, size = 0, 0
+    with open_source(source) as xml_file:
+        for chunk in iter(lambda: xml_file.read(CHUNK_SIZE), b''):
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            output.write(data)
+            length += len(data)
+    data = compressor.flush()
+    output.write(data)
+    return length + len(data), size
+
+
+def compress_file(source, compression='gzip', level=None):
+    """
+    Writes the compressed copy of the XML file next to it (e.g. RS_1.xml.gz)
+
+    :param source: <class 'str'> - path of the XML file
+    :param compression: <class 'str'> - one of COMPRESSIONS
+    :param level: <class 'int'> - compression level or None
+    :return: <class 'str'> - path of the compressed file
+    """
+    compressor = get_compressor(compression, level, get_source_size(source))
+    path = source + SUFFIXES[compression]
+    write_atomically(path, lambda output: copy_compressed(source, output, compressor))
+    return path
+
+
+def write_archive(path, members, compression='gzip', level=None):
+    """
+    Writes the archive of responses
+
+    :param path: <class 'str'> - path of the archive, it should end with ARCHIVE_SUFFIX
+    :param members: iterable of (name, source) pairs: sources are read with open_source
+    :param compression: <class 'str'> - one of COMPRESSIONS
+    :param level: <class 'int'> - compression level or None
+    :return: <class 'list'> with [name, offset, compressed length, size] of every member
+    :raise ValueError: if a name is repeated or contains '#'
+    """
+    index = []
+    names = set()
+
+    def write(output):
+        output.write(ARCHIVE_MAGIC)
+        offset = len(ARCHIVE_MAGIC)
+        for name, source in members:
+            if '#' in name or name in names:
+                raise ValueError('Wrong or repeated member name: {}'.format(name))
+            names.add(name)
+            length, size = copy_compressed(
+                source, output, get_compressor(compression, level, get_source_size(source))
+            )
+            index.append([name, offset, length, size])
+            offset += length
+        data = json.dumps({'compression': compression, 'members': index}).encode()
+        output.write(data)
+        output.write(FOOTER.pack(offset, len(data), ARCHIVE_MAGIC))
+
+    write_atomically(path, write)
+    return index
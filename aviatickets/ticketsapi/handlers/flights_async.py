@@ -0,0 +1,68 @@
+"""
+This file contains receiving of flight data for async views (see views.flights_async_view).
+
+Requests to external suppliers are awaited on the event loop: they run on the supplier client loop
+(see suppliers), so no thread is blocked while a supplier responds.
+Local files, snapshots and background-refreshed sources are parsed in the fan-out thread pool.
+"""
+import asyncio
+
+from ticketsapi.handlers.flights_fanout import merge_results, parse_executor, report_failure
+from ticketsapi.handlers.flights_handler import submit_flights
+from ticketsapi.handlers.timing import stage, submit_in_context
+
+
+async def get_flights_async(source):
+    """
+    Receives flight data like get_flights without blocking the event loop
+
+    :param source: path where the XML or snapshot file is located or URL of the supplier
+    :return: <class 'SearchResult'> with flights data
+    :raise FlightsError: if the source can not be fetched (see flights_handler.fetch_flights)
+    """
+    # The same fetch as in the sync fan-out (see flights_handler.submit_flights)
+    return await asyncio.wrap_future(submit_flights(source))
+
+
+async def fetch_many_async(sources, deadline=None):
+    """
+    Receives flight data from all sources concurrently and waits until all of them are ready
+    or the deadline expires (see flights_fanout.fetch_many)
+
+    :param sources: dictionary: source name -> path or URL
+    :param deadline: <class 'float'> - maximum waiting time in seconds or None to wait for all sources
+    :return: <class 'tuple'> - (dictionary: source name -> <class 'SearchResult'> for sources that are ready,
+    dictionary: source name -> status for the others: 'failed' or 'timeout')
+    """
+    with stage('fetch'):
+        tasks = {name: asyncio.ensure_future(get_flights_async(source)) for name, source in sources.items()}
+        await asyncio.wait(tasks.values(), timeout=deadline)
+
+    results, errors = {}, {}
+    for name, task in tasks.items():
+        if not task.done():
+            task.cancel()
+            errors[name] = 'timeout'
+        elif task.exception() is not None:
+            report_failure(name, sources[name], task.exception())
+            errors[name] = 'failed'
+        else:
+            results[name] = task.result()
+    return results, errors
+
+
+async def get_flights_many_async(sources, deadline=None):
+    """
+    Receives flight data from several sources concurrently and merges it (see flights_handler.get_flights_many)
+
+    :param sources: dictionary: source name -> path where the XML file is located or URL of the supplier
+    :param deadline: <class 'float'> - maximum waiting time in seconds or None to wait for all sources
+    :return: <class 'tuple'> - (merged <class 'SearchResult'> or None if no source is ready,
+    dictionary: source name -> 'ok', 'failed' or 'timeout')
+    """
+    results, errors = await fetch_many_async(sources, deadline)
+    statuses = {name: errors.get(name, 'ok') for name in sources}
+    if not results:
+        return None, statuses
+    ready = [results[name] for name in sources if name in results]
+    return await asyncio.wrap_future(submit_in_context(parse_executor, merge_results, ready)), statuses
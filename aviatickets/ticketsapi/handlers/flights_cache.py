@@ -0,0 +1,94 @@
+"""
+This file contains the process-wide cache of parsed flight data.
+"""
+from collections import OrderedDict
+from os import stat
+from os.path import abspath
+from threading import Lock
+
+from ticketsapi.handlers.flights_archive import split_source
+from ticketsapi.handlers.timing import stage
+
+
+class FlightsCache:
+    """
+    LRU cache for parsed XML responses.
+
+    Entries are keyed by the absolute file path together with its mtime and size,
+    so a changed file is parsed again. Cached <class 'SearchResult'> objects are shared between callers,
+    they are never modified: handlers build new results with SearchResult.replace().
+    """
+
+    def __init__(self, max_size=8):
+        """
+        :param max_size: <class 'int'> - maximum number of parsed responses kept in memory
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(xml_file_path):
+        """
+        Builds the cache key for the file, members of archives are keyed by the archive file
+
+        :param xml_file_path: path where the XML file is located or archive member (see flights_archive)
+        :return: <class 'tuple'> - (absolute path, mtime in ns, size in bytes)
+        """
+        path = abspath(xml_file_path)
+        file_stat = stat(split_source(path)[0])
+        return path, file_stat.st_mtime_ns, file_stat.st_size
+
+    def get_or_parse(self, xml_file_path, parser):
+        """
+        Returns cached flight data for the file or parses it
+
+        :param xml_file_path: path where the XML file is located
+        :param parser: function that receives the path and returns <class 'SearchResult'>
+        :return: <class 'SearchResult'>
+        :raise FlightsError: if the file can not be parsed (see flights_parser), nothing is cached
+        """
+        try:
+            key = self.make_key(xml_file_path)
+        except OSError:
+            with stage('parse'):
+                return parser(xml_file_path)
+
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+
+        with stage('parse'):
+            data = parser(xml_file_path)
+
+        with self._lock:
+            # Older versions of the same file will never be requested again
+            for old_key in [old_key for old_key in self._entries if old_key[0] == key[0]]:
+                del self._entries[old_key]
+            self._entries[key] = data
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return data
+
+    def clear(self):
+        """
+        Removes all entries and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dictionary with cache size and hit/miss counters
+        """
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,110 @@
+"""
+This file contains the columnar (NumPy) engine for flight queries.
+
+All options of a search result are stored as arrays, so the min/max queries
+and the optimal flight search run as vectorized operations.
+NumPy is an optional dependency: without it only the 'python' engine is available.
+"""
+from ticketsapi.handlers.flights_snapshot import SnapshotOptions
+from ticketsapi.handlers.timing import stage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def is_available():
+    """
+    :return: True if NumPy is installed and the 'numpy' engine can be used
+    """
+    return np is not None
+
+
+class FlightsColumns:
+    """
+    Columns of a <class 'SearchResult'>: one array element per priced option.
+
+    Prices are stored as integers in minor units (e.g. cents), so equal prices compare exactly.
+    Columns of snapshots are read from the mapped option columns (see flights_snapshot).
+    """
+
+    def __init__(self, result):
+        """
+        :param result: <class 'SearchResult'> with flights data
+        """
+        options = result.options
+        if isinstance(options, SnapshotOptions):
+            self.read_snapshot(options.reader)
+            return
+        places = max([-option.total_amount.as_tuple().exponent for option in options] + [0])
+        self.price_scale = 10 ** places
+        self.total_price = np.fromiter(
+            (int(option.total_amount * self.price_scale) for option in options), dtype=np.int64, count=len(options)
+        )
+        self.duration = np.fromiter((option.duration for option in options), dtype=np.int64, count=len(options))
+        self.stops = np.fromiter(
+            (option.onward.stops + (option.back.stops if option.back is not None else 0) for option in options),
+            dtype=np.int32, count=len(options)
+        )
+
+    def read_snapshot(self, reader):
+        """
+        Builds the columns from the option columns of a snapshot, options are not built
+
+        :param reader: <class 'SnapshotReader'> (see flights_snapshot)
+        """
+        columns = reader.columns
+        coefficients = np.asarray(columns['total_coefficient'], dtype=np.int64)
+        exponents = np.asarray(columns['total_exponent'], dtype=np.int64)
+        places = max(-int(exponents.min()), 0) if len(exponents) else 0
+        self.price_scale = 10 ** places
+        self.total_price = coefficients * 10 ** (exponents + places)
+        # Durations and stops are read from the mapping, they are not copied
+        self.duration = np.asarray(columns['duration'])
+        self.stops = np.asarray(columns['stops'])
+
+    def get_column(self, key):
+        """
+        :param key: <class 'str'> - 'duration' or 'price'
+        :return: <class 'numpy.ndarray'>
+        """
+        return {'duration': self.duration, 'price': self.total_price}[key]
+
+    def get_by(self, key, func):
+        """
+        Returns indexes of the most expensive/cheapest, longest/fastest options
+
+        :param key: <class 'str'> - 'duration' or 'price'
+        :param func: min or max builtin function
+        :return: <class 'numpy.ndarray'> with option indexes
+        """
+        column = self.get_column(key)
+        if not len(column):
+            return column
+        extreme = column.min() if func is min else column.max()
+        return np.flatnonzero(column == extreme)
+
+    def get_optimal(self):
+        """
+        Returns indexes of the cheapest options among those whose duration
+        is less than or equal to the average duration
+
+        :return: <class 'numpy.ndarray'> with option indexes
+        """
+        if not len(self.duration):
+            return self.duration
+        mask = self.duration <= int(self.duration.sum()) / len(self.duration)
+        prices = np.where(mask, self.total_price, np.iinfo(np.int64).max)
+        return np.flatnonzero(mask & (prices == prices[np.argmin(prices)]))
+
+
+def get_columns(result):
+    """
+    Returns columns of the search result, they are built once per result
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: <class 'FlightsColumns'>
+    """
+    with stage('transform'):
+        return result.get_derived('columns', FlightsColumns)
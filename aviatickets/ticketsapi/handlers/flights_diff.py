@@ -0,0 +1,94 @@
+"""
+This file contains the full difference between two search responses.
+
+Options are matched by their segment chain (see PricedOption.get_chain_key) through a hash index,
+so the difference is found in one pass over each response. Indexes are memoized with the results,
+so polling a supplier and comparing every new response with the previous one builds one index per response.
+"""
+from ticketsapi.handlers.flights_renderer import dumps
+from ticketsapi.handlers.timing import stage
+
+CHANGES = ('added', 'removed', 'repriced')
+
+
+def build_chain_index(result):
+    """
+    :param result: <class 'SearchResult'> with flights data
+    :return: dictionary: segment chain key -> the cheapest <class 'PricedOption'> with this chain
+    """
+    index = {}
+    for option in result.options:
+        key = option.get_chain_key()
+        kept = index.get(key)
+        if kept is None or option.total_amount < kept.total_amount:
+            index[key] = option
+    return index
+
+
+def get_chain_index(result):
+    """
+    Returns the chain index of the search result, it is built once per result
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: dictionary (see build_chain_index)
+    """
+    with stage('transform'):
+        return result.get_derived('chain_index', build_chain_index)
+
+
+def iter_changes(first, second):
+    """
+    Compares all options of two search responses.
+    Options with the same segment chain are the same flights; they are repriced
+    if the total amount or the currency changed. Several options with the same chain are compared by the cheapest.
+
+    :param first: <class 'SearchResult'> - the previous response
+    :param second: <class 'SearchResult'> - the new response
+    :return: generator of (change, option, previous option): change is 'added', 'repriced' or 'removed';
+    option is None for removed options, previous option is None for added ones.
+    Added and repriced options come in the order of the new response, then removed ones
+    in the order of the previous response.
+    """
+    previous, current = get_chain_index(first), get_chain_index(second)
+    for key, option in current.items():
+        old = previous.get(key)
+        if old is None:
+            yield 'added', option, None
+        elif old.total_amount != option.total_amount or old.currency != option.currency:
+            yield 'repriced', option, old
+    for key, old in previous.items():
+        if key not in current:
+            yield 'removed', None, old
+
+
+def get_change_data(change, option, previous):
+    """
+    :return: dictionary with the change for the response (see iter_changes)
+    """
+    data = {'change': change}
+    if previous is not None:
+        data['previous_total_amount'] = str(previous.total_amount)
+        data['previous_currency'] = previous.currency
+    if option is not None:
+        data['total_amount'] = str(option.total_amount)
+        data['currency'] = option.currency
+    data['flight'] = (option or previous).as_dict()
+    return data
+
+
+def iter_difference_json(first, second):
+    """
+    Streams the full difference as a JSON document:
+    {"response": {"changes": [...], "counts": {"added": ..., "removed": ..., "repriced": ..., "unchanged": ...}}}
+
+    :param first: <class 'SearchResult'> - the previous response
+    :param second: <class 'SearchResult'> - the new response
+    :return: generator of <class 'bytes'> chunks
+    """
+    counts = dict.fromkeys(CHANGES, 0)
+    yield b'{"response": {"changes": ['
+    for change, option, previous in iter_changes(first, second):
+        yield (b', ' if any(counts.values()) else b'') + dumps(get_change_data(change, option, previous))
+        counts[change] += 1
+    counts['unchanged'] = len(get_chain_index(second)) - counts['added'] - counts['repriced']
+    yield b'], "counts": ' + dumps(counts) + b'}}'
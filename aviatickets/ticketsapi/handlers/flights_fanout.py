@@ -0,0 +1,82 @@
+"""
+This file contains fan-out to several suppliers: concurrent fetching, merging and deduplication.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from ticketsapi.handlers.timing import Counter, stage
+
+logger = logging.getLogger(__name__)
+
+failed_sources = Counter('flights_failed_sources_total', 'Fan-out sources that failed to return flight data')
+
+# Local files are parsed in threads, HTTP suppliers are requested on the supplier client loop
+parse_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'FLIGHTS_FANOUT_WORKERS', 4), thread_name_prefix='flights-parse'
+)
+
+
+def report_failure(name, source, error):
+    """
+    Logs the error of the source skipped by the fan-out and counts it
+
+    :param name: <class 'str'> - name of the source
+    :param source: <class 'str'> - path or URL
+    :param error: <class 'Exception'> raised by the source
+    """
+    failed_sources.inc()
+    logger.warning('Source %s (%s) failed: %s', name, source, error, exc_info=error)
+
+
+def fetch_many(sources, submit, deadline=None):
+    """
+    Fetches all sources concurrently and waits until all of them are ready or the deadline expires
+
+    :param sources: dictionary: source name -> path or URL
+    :param submit: function that receives a source and returns <class 'concurrent.futures.Future'>
+    with <class 'SearchResult'> (see flights_handler.submit_flights)
+    :param deadline: <class 'float'> - maximum waiting time in seconds or None to wait for all sources
+    :return: <class 'tuple'> - (dictionary: source name -> <class 'SearchResult'> for sources that are ready,
+    dictionary: source name -> status for the others: 'failed' or 'timeout')
+    """
+    # Sources are parsed in other threads (see timing.submit_in_context), this is the time of waiting for them
+    with stage('fetch'):
+        futures = {name: submit(source) for name, source in sources.items()}
+        wait(futures.values(), timeout=deadline)
+
+    results, errors = {}, {}
+    for name, future in futures.items():
+        if not future.done():
+            future.cancel()
+            errors[name] = 'timeout'
+        elif future.exception() is not None:
+            report_failure(name, sources[name], future.exception())
+            errors[name] = 'failed'
+        else:
+            results[name] = future.result()
+    return results, errors
+
+
+def merge_results(results):
+    """
+    Merges options of several search results.
+    Options with the same segment chain (see PricedOption.get_chain_key) are deduplicated,
+    the cheapest one is kept. The order of the first occurrence is preserved.
+
+    :param results: list with <class 'SearchResult'>, must not be empty
+    :return: new <class 'SearchResult'> with response data of the first result
+    """
+    with stage('transform'):
+        options = {}
+        for result in results:
+            for option in result.options:
+                key = option.get_chain_key()
+                kept = options.get(key)
+                if kept is None or option.total_amount < kept.total_amount:
+                    options[key] = option
+
+        merged = results[0].replace(options.values())
+        merged.return_tickets = max(result.return_tickets for result in results)
+        return merged
@@ -2,117 +2,479 @@
 This file contains all the logic of working with flight data (computing, etc.)
 """
 
-from datetime import datetime
-from re import findall
+import json
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from ticketsapi.handlers import flights_columns
+from ticketsapi.handlers.flights_archive import get_source_size
+from ticketsapi.handlers.flights_cache import FlightsCache
+from ticketsapi.handlers.flights_fanout import fetch_many, merge_results, parse_executor
+from ticketsapi.handlers.flights_history import record_search
+from ticketsapi.handlers.flights_model import PricedOption, SearchResult
+from ticketsapi.handlers.flights_parser import (
+    KEY_EXTRACTORS, from_xml_to_result, get_duration, get_priced_itinerary_data, get_total_amount,
+    iter_priced_itineraries
+)
+from ticketsapi.handlers.flights_refresh import get_refresh_settings, get_refresher
+from ticketsapi.handlers.flights_snapshot import is_snapshot, open_snapshot
+from ticketsapi.handlers.flights_summary import OptimalCandidates, StreamingSummary, get_summary
+from ticketsapi.handlers.single_flight import SharedResults, SingleFlight
+from ticketsapi.handlers.suppliers import FileSupplier, HttpSupplier, get_client, is_url
+from ticketsapi.handlers.timing import iter_stage, stage, submit_in_context
+
+flights_cache = FlightsCache(max_size=getattr(settings, 'FLIGHTS_CACHE_MAX_SIZE', 8))
+
+ENGINES = ('python', 'numpy')
+
+# Concurrent requests of the same source wait for one fetch
+fetch_calls = SingleFlight()
+# Concurrent requests of the same supplier share one request that does not block a thread (see submit_flights)
+fetch_futures = SingleFlight()
+_shared_results = None
+
+
+def get_supplier(source):
+    """
+    Returns the supplier for the source
 
-from ticketsapi.handlers.exc_handler import exc_handler
-from ticketsapi.handlers.flights_parser import from_xml_to_dict
+    :param source: path where the XML or snapshot file is located or URL of the supplier
+    :return: <class 'FileSupplier'> or <class 'HttpSupplier'>
+    """
+    if is_url(source):
+        return HttpSupplier(source)
+    loader = open_snapshot if is_snapshot(source) else from_xml_to_result
+    return FileSupplier(source, lambda path: flights_cache.get_or_parse(path, loader))
 
 
-def get_flights(xml_file_path):
+def is_streamed(source):
     """
-    Receives flight data
+    Large local XML files are streamed instead of being parsed and cached as a whole,
+    snapshots are never streamed: they are mapped, not parsed
 
-    :param xml_file_path: path where the XML file is located
-    :return: dictionary with flights data
+    :param source: path where the XML or snapshot file is located, archive member or URL of the supplier
+    :return: True if the size of the XML data is at least the FLIGHTS_STREAMING_MIN_SIZE setting
+    or it is unknown (see flights_archive.get_source_size)
+    :raise SourceError: if the file does not exist or can not be read
     """
-    return from_xml_to_dict(xml_file_path)
+    if is_url(source) or is_snapshot(source):
+        return False
+    size = get_source_size(source)
+    return size is None or size >= settings.FLIGHTS_STREAMING_MIN_SIZE
 
 
-@exc_handler
-def get_total_amounts(flights):
+def get_shared_results():
+    """
+    Returns the store of supplier responses shared by processes (the FLIGHTS_SHARED_RESULTS setting)
+
+    :return: <class 'SharedResults'> or None if it is not configured or not supported
+    """
+    global _shared_results
+    options = getattr(settings, 'FLIGHTS_SHARED_RESULTS', {})
+    if not options.get('DIRECTORY') or not SharedResults.is_available():
+        return None
+    if _shared_results is None or _shared_results.directory != options['DIRECTORY']:
+        _shared_results = SharedResults(options['DIRECTORY'], options.get('TTL', 2.0))
+    return _shared_results
+
+
+def fetch_flights(source):
+    """
+    Receives flight data from the source now.
+    Data of local files is cached until the file changes (see flights_cache),
+    external suppliers are requested every time (see suppliers).
+    Concurrent calls for the same source share one fetch; responses of external suppliers
+    are also shared between processes if FLIGHTS_SHARED_RESULTS is configured (see single_flight).
+    Every received response is recorded to the price history if it is configured (see flights_history).
+
+    :param source: path where the XML file is located or URL of the supplier
+    :return: <class 'SearchResult'> with flights data
+    :raise SourceError: if the file can not be read or the external supplier is unavailable
+    :raise ParseError: if the XML response is malformed
+    """
+    supplier = get_supplier(source)
+    shared = get_shared_results() if is_url(source) else None
+    if shared is not None:
+        return record_search(fetch_calls.do(source, lambda: shared.do(source, supplier.fetch)))
+    return record_search(fetch_calls.do(source, supplier.fetch))
+
+
+def get_flights(source):
     """
-    Calculates the total amount of each flight
+    Receives flight data.
+    If background refresh is enabled (the FLIGHTS_REFRESH setting), data comes from the last good snapshot
+    of the source (see flights_refresh), else it is fetched now (see fetch_flights).
+
+    :param source: path where the XML file is located or URL of the supplier
+    :return: <class 'SearchResult'> with flights data
+    :raise FlightsError: if the source can not be fetched (see fetch_flights)
+    """
+    if get_refresh_settings()['ENABLED']:
+        return get_refresher(fetch_flights).get(source)
+    return fetch_flights(source)
+
+
+def submit_flights(source):
+    """
+    Starts receiving of flight data like get_flights.
+    Requests to external suppliers run on the supplier client loop (see suppliers), so no thread waits for them;
+    like in fetch_flights, concurrent requests of the same supplier share one request and
+    the response is recorded to the price history. Other sources are received in the fan-out thread pool.
+
+    :param source: path where the XML file is located or URL of the supplier
+    :return: <class 'concurrent.futures.Future'> with <class 'SearchResult'>, it can be cancelled by the caller
+    """
+    if not is_url(source) or get_refresh_settings()['ENABLED'] or get_shared_results() is not None:
+        return submit_in_context(parse_executor, get_flights, source)
+
+    shared = fetch_futures.submit(source, lambda: get_client().submit(source))
+    # The shared future must not be cancelled by one caller, so every caller gets its own future
+    future = Future()
+
+    def done(_):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(record_search(shared.result()))
+        except Exception as error:
+            future.set_exception(error)
+
+    shared.add_done_callback(done)
+    return future
+
 
-    :param flights: dictionary with 'flights' key that contain flight data
-    :return: total amounts list that contain total amounts for all flights
+def get_flights_many(sources, deadline=None):
     """
-    total_amounts = []
-    for flight in flights['flights']:
-        amount = 0
-        for charge in flight['pricing']['service_charges']:
-            if charge['charge_type'] == 'TotalAmount':
-                amount += float(charge['price'])
-        total_amounts.append(amount)
+    Receives flight data from several sources concurrently and merges it (see flights_fanout).
+    Sources that are not ready before the deadline are skipped.
 
-    return total_amounts
+    :param sources: dictionary: source name -> path where the XML file is located or URL of the supplier
+    :param deadline: <class 'float'> - maximum waiting time in seconds or None to wait for all sources
+    :return: <class 'tuple'> - (merged <class 'SearchResult'> or None if no source is ready,
+    dictionary: source name -> 'ok', 'failed' or 'timeout')
+    """
+    results, errors = fetch_many(sources, submit_flights, deadline)
+    statuses = {name: errors.get(name, 'ok') for name in sources}
+    if not results:
+        return None, statuses
+    return merge_results([results[name] for name in sources if name in results]), statuses
 
 
-@exc_handler
-def calculate_flight_duration(flight_data):
+def get_total_amounts(flights):
     """
-    Calculates the flight duration
+    Returns the total amount of each flight
 
-    :param flight_data: dictionary that contain flight data
-    :return: <class 'datetime.timedelta'>
+    :param flights: <class 'SearchResult'> with flights data
+    :return: total amounts list (<class 'decimal.Decimal'>) that contain total amounts for all flights
     """
-    departure_time = datetime.strptime(flight_data[0]['departure_time'], '%Y-%m-%dT%H%M')
-    arrival_time = datetime.strptime(flight_data[-1]['arrival_time'], '%Y-%m-%dT%H%M')
-    return arrival_time - departure_time
+    return [option.total_amount for option in flights.options]
 
 
-@exc_handler
 def get_durations(flights):
     """
-    Calculates the duration of each flight
+    Returns the duration of each flight (onward and return itineraries together)
+
+    :param flights: <class 'SearchResult'> with flights data
+    :return: durations list that contain durations in minutes for all flights
+    """
+    return [option.duration for option in flights.options]
+
 
-    :param flights: dictionary with 'flights' key that contain flight data
-    :return: durations list that contain durations for all flights
+def get_engine(engine=None):
     """
-    durations = []
-    for flight in flights['flights']:
-        duration = calculate_flight_duration(flight['onward_itinerary'])
-        if flights['return_tickets']:
-            return_duration = calculate_flight_duration(flight['return_itinerary'])
-            duration = duration + return_duration
-        durations.append(duration)
+    Returns the name of the engine that runs flight queries
 
-    return durations
+    :param engine: <class 'str'> - 'python', 'numpy' or None to use the FLIGHTS_ENGINE setting
+    :return: <class 'str'> - 'numpy' if it was chosen and NumPy is installed, else 'python'
+    """
+    engine = engine or getattr(settings, 'FLIGHTS_ENGINE', 'python')
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine: {}'.format(engine))
+    return 'numpy' if engine == 'numpy' and flights_columns.is_available() else 'python'
 
 
-@exc_handler
-def get_by(key, flights, func):
+def get_by(key, flights, func, engine=None):
     """
     Returns the most expensive/cheapest, longest/fastest flights
 
     :param key: <class 'str'> - 'duration' or 'price'
     If you need to find the longest/fastest itineraries, then choose 'duration'.
     If you need to find the most expensive/cheapest itineraries, then choose 'price'
-    :param flights: dictionary with 'flights' key that contain flight data
+    :param flights: <class 'SearchResult'> with flights data
     :param func: <class 'builtin_function_or_method'> - only min or max builtin functions
     If you need to find the fastest or cheapest itineraries --> min
     If you need to find the longest or most expensive --> max
-    :return: dictionary with flights data
+    :param engine: <class 'str'> - 'python' or 'numpy' (see get_engine)
+    :return: new <class 'SearchResult'> with flights data, the passed one is not modified
     """
     if func not in (max, min):
         raise TypeError('Parameter func must be only min or max builtin func')
 
-    handlers = {'duration': get_durations, 'price': get_total_amounts}
-    all_values = handlers[key](flights)
-    flights['flights'] = [flights['flights'][idx] for idx, val in enumerate(all_values) if val == func(all_values)]
-    return flights
+    if get_engine(engine) == 'numpy':
+        indexes = flights_columns.get_columns(flights).get_by(key, func)
+        return flights.replace(flights.options[idx] for idx in indexes)
 
+    # All extremes are computed in one pass and memoized with the result (see flights_summary)
+    return flights.replace(flights.options[idx] for idx in get_summary(flights).get_ids(key, func))
 
-@exc_handler
-def get_optimal(flights):
+
+def get_by_streaming(key, xml_source, func):
+    """
+    Returns the most expensive/cheapest, longest/fastest flights without loading the whole response.
+    Only the price or the times of every itinerary are read (see flights_parser.KEY_EXTRACTORS),
+    itineraries are parsed as a whole only if they are not worse than the current extreme.
+
+    :param key: <class 'str'> - 'duration' or 'price' (see get_by)
+    :param xml_source: string with path to XML file or file-like object
+    :param func: <class 'builtin_function_or_method'> - only min or max builtin functions
+    :return: <class 'SearchResult'> with flights data
+    """
+    if func not in (max, min):
+        raise TypeError('Parameter func must be only min or max builtin func')
+
+    header = {}
+    get_value = KEY_EXTRACTORS[key]
+    best_value, best_options = None, []
+
+    def extract(tag, return_tickets):
+        value = get_value(tag, return_tickets)
+        if best_value is not None and value != best_value and func(value, best_value) == best_value:
+            return None
+        return value, get_priced_itinerary_data(tag, return_tickets)
+
+    def convert(item):
+        return item[0], PricedOption.from_dict(item[1])
+
+    # The document is parsed and ranked in one pass
+    with stage('parse'):
+        for value, option in iter_priced_itineraries(xml_source, header, convert, extract):
+            if best_value is None or value != best_value:
+                best_value, best_options = value, [option]
+            else:
+                best_options.append(option)
+
+    return SearchResult(tuple(best_options), **header)
+
+
+def get_optimal(flights, engine=None):
     """
     Finds the best flight option.
     First, the function finds all flights
     whose duration is less than the average duration of all flights on this itinerary.
     From this list, return flights with the lowest price.
 
-    :param flights: dictionary with 'flights' key that contain flight data
-    :return: dictionary with optimal flights
+    :param flights: <class 'SearchResult'> with flights data
+    :param engine: <class 'str'> - 'python' or 'numpy' (see get_engine)
+    :return: new <class 'SearchResult'> with optimal flights, the passed one is not modified
+    """
+    if get_engine(engine) == 'numpy':
+        indexes = flights_columns.get_columns(flights).get_optimal()
+        return flights.replace(flights.options[idx] for idx in indexes)
+
+    return flights.replace(flights.options[idx] for idx in get_summary(flights).ids['optimal'])
+
+
+def get_summary_data(flights):
+    """
+    Returns cheapest, most expensive, fastest, longest and optimal flights at once.
+    They are computed in one pass over the flights and memoized with the result.
+
+    :param flights: <class 'SearchResult'> with flights data
+    :return: dictionary with lists of flights for every metric and response data
+    """
+    summary = get_summary(flights)
+    data = {
+        name: [flights.options[idx].as_dict() for idx in ids] for name, ids in summary.ids.items()
+    }
+    data['return_tickets'] = flights.return_tickets
+    data['request_time'] = flights.request_time
+    data['response_time'] = flights.response_time
+    data['request_id'] = flights.request_id
+    return data
+
+
+def get_candidate_extractor(accepts):
+    """
+    :param accepts: function that receives the price and the duration of an itinerary
+    and returns True if the itinerary is needed
+    :return: function for iter_priced_itineraries (see flights_parser.process_events) that reads the price
+    and the duration of every itinerary and parses it as a whole only if it is needed:
+    (price, duration, dictionary with flight data or None)
+    """
+    def extract(tag, return_tickets):
+        price, duration = get_total_amount(tag, return_tickets), get_duration(tag, return_tickets)
+        return price, duration, get_priced_itinerary_data(tag, return_tickets) if accepts(price, duration) else None
+
+    return extract
+
+
+def convert_candidate(item):
+    """
+    :param item: <class 'tuple'> - (price, duration, dictionary with flight data or None)
+    :return: <class 'tuple'> - (price, duration, <class 'PricedOption'> or None)
+    """
+    price, duration, data = item
+    return price, duration, None if data is None else PricedOption.from_dict(data)
+
+
+def get_optimal_streaming(xml_source):
+    """
+    Finds the best flight option without loading the whole response (see get_optimal).
+    The XML data is read once: only prices and times are read,
+    itineraries are parsed as a whole only if they can be optimal (see flights_summary.OptimalCandidates).
+
+    :param xml_source: string with path to XML file
+    :return: <class 'SearchResult'> with optimal flights
+    """
+    header = {}
+    candidates = OptimalCandidates()
+    with stage('parse'):
+        extract = get_candidate_extractor(candidates.accepts)
+        for price, duration, option in iter_priced_itineraries(xml_source, header, convert_candidate, extract):
+            candidates.add(price, duration, option)
+
+    return SearchResult(tuple(candidates.get_options()), **header)
+
+
+def get_summary_streaming(xml_source):
+    """
+    Returns cheapest, most expensive, fastest, longest and optimal flights without loading the whole response.
+    The XML data is read once: only prices and times are read,
+    itineraries are parsed as a whole only if they can get into the summary (see flights_summary.StreamingSummary).
+
+    :param xml_source: string with path to XML file
+    :return: dictionary with lists of flights for every metric and response data (see get_summary_data)
+    """
+    header = {}
+    summary = StreamingSummary()
+    with stage('parse'):
+        extract = get_candidate_extractor(summary.accepts)
+        for price, duration, option in iter_priced_itineraries(xml_source, header, convert_candidate, extract):
+            summary.add(price, duration, option)
+
+    with stage('serialize'):
+        data = {name: [option.as_dict() for option in options] for name, options in summary.get_options().items()}
+    for key in ('return_tickets', 'request_time', 'response_time', 'request_id'):
+        data[key] = header.get(key)
+    return data
+
+
+def get_method_data(url, flights, engine=None):
+    """
+    Returns the response data of the flights method
+
+    :param url: <class 'str'> - method name: 'getAll', 'getMostExpensive', 'getCheapest', 'getLongest',
+    'getFastest', 'getOptimal' or 'getSummary'
+    :param flights: <class 'SearchResult'> with flights data
+    :param engine: <class 'str'> - 'python' or 'numpy' (see get_engine)
+    :return: dictionary with the response data
+    """
+    if url == 'getSummary':
+        with stage('serialize'):
+            return get_summary_data(flights)
+    with stage('rank'):
+        if url == 'getMostExpensive':
+            flights = get_by('price', flights, max, engine)
+        elif url == 'getCheapest':
+            flights = get_by('price', flights, min, engine)
+        elif url == 'getLongest':
+            flights = get_by('duration', flights, max, engine)
+        elif url == 'getFastest':
+            flights = get_by('duration', flights, min, engine)
+        elif url == 'getOptimal':
+            flights = get_optimal(flights, engine)
+    with stage('serialize'):
+        return flights.as_dict()
+
+
+def get_page_data(total, offset, limit):
+    """
+    Returns pagination data for the response
+
+    :param total: <class 'int'> - number of options that pass the filters
+    :param offset: <class 'int'> - number of skipped options
+    :param limit: <class 'int'> - page size or None
+    :return: dictionary with 'total', 'offset' and 'next_offset' (None on the last page)
+    """
+    next_offset = offset + limit if limit is not None and offset + limit < total else None
+    return {'total': total, 'offset': offset, 'next_offset': next_offset}
+
+
+def project_flight(flight, fields):
+    """
+    :param flight: dictionary with flight data (see PricedOption.as_dict)
+    :param fields: <class 'tuple'> with segment fields (see flights_parser.get_fields)
+    :return: new dictionary with only these fields of the segments
     """
-    durations = get_durations(flights)
-    average_time = sum([duration.total_seconds() for duration in durations]) / len(durations)
-    flights['flights'] = [
-        flight for idx, flight in enumerate(flights['flights']) if durations[idx].total_seconds() <= average_time
-    ]
-    return get_by('price', flights, min)
+    data = dict(flight)
+    for name in ('onward_itinerary', 'return_itinerary'):
+        if name in data:
+            data[name] = [{field: segment[field] for field in fields} for segment in data[name]]
+    return data
+
+
+# Keys of response data with lists of flights
+FLIGHTS_KEYS = ('flights', 'cheapest', 'most_expensive', 'fastest', 'longest', 'optimal')
+
+
+def project_response(data, fields):
+    """
+    :param data: dictionary with response data of a flights method (see get_method_data)
+    :param fields: <class 'tuple'> with segment fields or None for all fields
+    :return: the dictionary with only these fields of the segments
+    """
+    if fields is not None:
+        for key in FLIGHTS_KEYS:
+            if key in data:
+                data[key] = [project_flight(flight, fields) for flight in data[key]]
+    return data
+
+
+def iter_flights_json(xml_source, query=None, offset=0, limit=None, fields=None):
+    """
+    Streams all flights as a JSON document {"response": {...}} of the same shape as the flights_view response.
+    If filters or pagination are used, pagination data is added (see get_page_data).
+    Errors of the document (see iter_priced_itineraries) are raised after the response has started,
+    so the client receives an incomplete document.
+
+    :param xml_source: string with path to XML file or file-like object
+    :param query: <class 'FlightsQuery'> or None
+    :param offset: <class 'int'> - number of matching options to skip
+    :param limit: <class 'int'> - maximum number of options to return or None for all
+    :param fields: <class 'tuple'> with segment fields to return (see flights_parser.get_fields) or None for all.
+    Without filters only these fields are parsed, so itineraries with wrong data in other fields are not skipped.
+    :return: generator of <class 'str'> chunks
+    """
+    header = {}
+    paginate = query is not None or offset or limit is not None
+    total = 0
+    yield '{"response": {"flights": ['
+    if fields is not None and query is None:
+        def extract(tag, return_tickets):
+            return get_priced_itinerary_data(tag, return_tickets, fields)
+
+        def convert(data):
+            return data, None
+    else:
+        # Options are converted even without filters, so the same itineraries are skipped as in get_flights
+        extract = get_priced_itinerary_data
+
+        def convert(data):
+            return data, PricedOption.from_dict(data)
+    for flight, option in iter_stage('parse', iter_priced_itineraries(xml_source, header, convert, extract)):
+        if query is not None and not query.matches(option):
+            continue
+        if offset <= total and (limit is None or total < offset + limit):
+            if fields is not None and option is not None:
+                flight = project_flight(flight, fields)
+            yield (', ' if total > offset else '') + json.dumps(flight)
+        total += 1
+    if paginate:
+        header.update(get_page_data(total, offset, limit))
+    yield '], ' + json.dumps(header)[1:] + '}'
 
 
-@exc_handler
 def check_and_set_params(source1, source2, dict_to_set, set_key):
     """
     Checks the equality of source1 and source2 and adds a key and value to the dictionary
@@ -127,21 +489,19 @@ def check_and_set_params(source1, source2, dict_to_set, set_key):
         dict_to_set['second'][str(set_key)] = source2
 
 
-@exc_handler
 def get_service_charges_types(service_charges):
     """
     Returns service charge types
 
-    :param service_charges: list with dictionaries as objects that contain service charge data
+    :param service_charges: iterable of <class 'ServiceCharge'>
     :return: <class 'set'> with service charge types for flight
     """
-    return set(data['type'] for data in service_charges)
+    return set(charge.type for charge in service_charges)
 
 
-@exc_handler
 def get_difference(flights_data1, flights_data2):
     """
-    Returns the difference between two flight data dictionaries.
+    Returns the difference between two flight search results.
 
     Checks only the most important data:
     - availability of the return itinerary
@@ -149,28 +509,31 @@ def get_difference(flights_data1, flights_data2):
     - checks whether the departure and arrival airports match
     - whether the types of passengers match
 
-    :param flights_data1: dictionary with 'flights' key that contain flight data from the first file
-    :param flights_data2: dictionary with 'flights' key that contain flight data from the second file
-    :return: A dictionary that displays the difference between two flight dictionaries
+    :param flights_data1: <class 'SearchResult'> with flight data from the first file
+    :param flights_data2: <class 'SearchResult'> with flight data from the second file
+    :return: A dictionary that displays the difference between two flight search results
     """
     difference = {'first': {}, 'second': {}}
-
-    flights1 = flights_data1['flights'][0]['onward_itinerary']
-    flights2 = flights_data2['flights'][0]['onward_itinerary']
-    check_and_set_params(flights_data1['return_tickets'], flights_data2['return_tickets'], difference, 'return_itinerary')
-    check_and_set_params(flights1[0]['source'], flights2[0]['source'], difference, 'source')
-    check_and_set_params(flights1[-1]['destination'], flights2[-1]['destination'], difference, 'destination')
-
-    departure_data1 = findall(r'(.+)T', flights1[0]['departure_time'])[0]
-    departure_data2 = findall(r'(.+)T', flights2[0]['departure_time'])[0]
+    check_and_set_params(flights_data1.return_tickets, flights_data2.return_tickets, difference, 'return_itinerary')
+    if not flights_data1.options or not flights_data2.options:
+        # Nothing else can be compared
+        return difference
+
+    option1 = flights_data1.options[0]
+    option2 = flights_data2.options[0]
+    flights1 = option1.onward.flights
+    flights2 = option2.onward.flights
+    check_and_set_params(flights1[0].source, flights2[0].source, difference, 'source')
+    check_and_set_params(flights1[-1].destination, flights2[-1].destination, difference, 'destination')
+
+    departure_data1 = flights1[0].departure_time.split('T')[0]
+    departure_data2 = flights2[0].departure_time.split('T')[0]
     check_and_set_params(departure_data1, departure_data2, difference, 'departure_date')
 
-    pricing1 = flights_data1['flights'][0]['pricing']
-    pricing2 = flights_data2['flights'][0]['pricing']
-    check_and_set_params(pricing1['currency'], pricing2['currency'], difference, 'currency')
+    check_and_set_params(option1.currency, option2.currency, difference, 'currency')
 
-    type1 = sorted(list(get_service_charges_types(pricing1['service_charges'])))
-    type2 = sorted(list(get_service_charges_types(pricing2['service_charges'])))
+    type1 = sorted(list(get_service_charges_types(option1.service_charges)))
+    type2 = sorted(list(get_service_charges_types(option2.service_charges)))
     check_and_set_params(type1, type2, difference, 'type')
 
     return difference
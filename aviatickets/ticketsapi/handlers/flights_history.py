@@ -0,0 +1,499 @@
+"""
+This file contains the price history of repeated searches.
+
+Every parsed search response is recorded once (see record_search): for every route, currency
+and segment chain (see PricedOption.get_chain_key) the minimum total amount and the minimum duration
+are appended to the raw level. The series with an empty chain is the minimum of the whole route.
+
+Points of every route are kept in three levels: 'raw' (one point per search), 'hour' and 'day'.
+A level file is an append-only array of 64-bit integers, RECORD_SIZE values per point
+(see RECORD_FIELDS). Compaction (see PriceHistory.compact) merges raw points into hourly and daily
+buckets with min, so merging the same points twice gives the same buckets, and drops points older than
+the retention of their level. Retention counts from the latest search of the route, so archives
+of old responses can be recorded too. Queries merge the level with raw points that are not compacted yet,
+responses are never read again.
+
+Files are written under the lock of the route: fcntl.flock on POSIX systems, so several server processes
+can share the directory, or a process-wide lock elsewhere.
+"""
+import atexit
+import json
+import logging
+import os
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from os.path import getsize, join
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+
+from ticketsapi.handlers.files import write_atomically
+from ticketsapi.handlers.flights_ingest import get_route
+from ticketsapi.handlers.flights_model import EPOCH_ORDINAL, MINUTES_PER_DAY
+from ticketsapi.handlers.flights_snapshot import join_decimal, split_decimal
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_SETTINGS = {
+    # Directory of the history files, None disables recording
+    'DIRECTORY': None,
+    # How long points of every level are kept, seconds (None keeps them forever)
+    'RAW_RETENTION': 2 * 24 * 3600,
+    'HOURLY_RETENTION': 60 * 24 * 3600,
+    'DAILY_RETENTION': None,
+    # Minimum time between compactions of a route started by recording, seconds
+    'COMPACT_INTERVAL': 3600,
+}
+
+LEVELS = ('raw', 'hour', 'day')
+# Bucket of every level, minutes
+BUCKETS = {'raw': 1, 'hour': 60, 'day': MINUTES_PER_DAY}
+RETENTION_SETTINGS = {'raw': 'RAW_RETENTION', 'hour': 'HOURLY_RETENTION', 'day': 'DAILY_RETENTION'}
+
+RECORD_FIELDS = ('series', 'time', 'price_coefficient', 'price_exponent', 'duration')
+RECORD_SIZE = len(RECORD_FIELDS)
+RECORD_BYTES = RECORD_SIZE * array('q').itemsize
+SERIES_FILE = 'series.jsonl'
+RESPONSE_TIME_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+
+def get_history_settings():
+    """
+    :return: dictionary with the FLIGHTS_PRICE_HISTORY setting merged with DEFAULT_HISTORY_SETTINGS
+    """
+    return dict(DEFAULT_HISTORY_SETTINGS, **getattr(settings, 'FLIGHTS_PRICE_HISTORY', {}))
+
+
+def get_search_time(result):
+    """
+    :param result: <class 'SearchResult'>
+    :return: <class 'int'> - ResponseTime of the search in minutes since the epoch, the current time
+    if the response has no valid ResponseTime
+    """
+    try:
+        moment = datetime.strptime(result.response_time, RESPONSE_TIME_FORMAT)
+    except (TypeError, ValueError):
+        moment = datetime.now(timezone.utc)
+    return (moment.toordinal() - EPOCH_ORDINAL) * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+
+def get_chain_name(option):
+    """
+    :param option: <class 'PricedOption'>
+    :return: <class 'str'> - readable segment chain: 'carrier number departure arrival' for every segment,
+    segments are separated by ',' and return segments follow '/', e.g. 'EK 2524 2018-10-22T0005 2018-10-22T0130'
+    """
+    def get_itinerary_name(itinerary):
+        return ','.join(
+            ' '.join((flight.carrier_id, flight.flight_number, flight.departure_time, flight.arrival_time))
+            for flight in itinerary.flights
+        )
+
+    name = get_itinerary_name(option.onward)
+    return name if option.back is None else '{}/{}'.format(name, get_itinerary_name(option.back))
+
+
+def get_route_name(source, destination):
+    """
+    :return: <class 'str'> - name of the route files, e.g. 'DXB-BKK' (see flights_ingest.get_route)
+    """
+    return '{}-{}'.format(source, destination)
+
+
+def is_route_name(route):
+    """
+    :param route: <class 'str'> - route name
+    :return: True if the route name can be used as a file name: airport codes are letters and digits
+    """
+    source, _, destination = route.partition('-')
+    return source.isalnum() and destination.isalnum()
+
+
+def get_search_points(result):
+    """
+    Computes the points of one search
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: dictionary: route name -> dictionary: (return_tickets, currency, chain) -> [min price, min duration],
+    the chain is '' for the minimum of the route
+    """
+    routes = {}
+    for option in result.options:
+        route = get_route(option)
+        if not is_route_name(route):
+            continue
+        points = routes.setdefault(route, {})
+        for chain in ('', get_chain_name(option)):
+            point = points.get((result.return_tickets, option.currency, chain))
+            if point is None:
+                points[result.return_tickets, option.currency, chain] = [option.total_amount, option.duration]
+            else:
+                point[0] = min(point[0], option.total_amount)
+                point[1] = min(point[1], option.duration)
+    return routes
+
+
+def merge_point(buckets, key, price, duration):
+    """
+    Merges a point into the bucket with min
+
+    :param buckets: dictionary: (series id, time) -> [price, duration]
+    :param key: <class 'tuple'> - (series id, bucket time)
+    """
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = [price, duration]
+    else:
+        bucket[0] = min(bucket[0], price)
+        bucket[1] = min(bucket[1], duration)
+
+
+class PriceHistory:
+    """
+    Price history files in one directory
+    """
+
+    def __init__(self, directory, retention=None):
+        """
+        :param directory: <class 'str'> - directory of the history files
+        :param retention: dictionary: level -> retention in seconds or None,
+        the levels that are not given keep their points forever
+        """
+        self.directory = directory
+        self.retention = retention or {}
+        self._lock = Lock()
+        self._series_lock = Lock()
+        self._series = []
+        self._series_ids = {}
+        # (route, chain) -> list of series ids
+        self._chains = {}
+        self._series_size = 0
+        for level in LEVELS:
+            os.makedirs(join(directory, level), exist_ok=True)
+
+    def locked(self, name):
+        """
+        :param name: <class 'str'> - name of the lock: route name or the series file
+        :return: context manager that holds the process lock and the file lock of the name
+        """
+        return FileLock(join(self.directory, name + '.lock'), self._lock)
+
+    def get_path(self, level, route):
+        return join(self.directory, level, route + '.bin')
+
+    def get_routes(self):
+        """
+        :return: sorted list with names of the recorded routes
+        """
+        return sorted({
+            name[:-len('.bin')] for level in LEVELS for name in os.listdir(join(self.directory, level))
+            if name.endswith('.bin')
+        })
+
+    def load_series(self):
+        """
+        Reads series added by this or other processes since the last call, an incomplete last line is ignored
+        """
+        path = join(self.directory, SERIES_FILE)
+        with self._series_lock:
+            try:
+                if getsize(path) == self._series_size:
+                    return
+                with open(path, 'rb') as series_file:
+                    series_file.seek(self._series_size)
+                    data = series_file.read()
+            except FileNotFoundError:
+                return
+            data = data[:data.rfind(b'\n') + 1]
+            for line in data.splitlines():
+                key = tuple(json.loads(line))
+                self._series_ids[key] = len(self._series)
+                self._chains.setdefault((key[0], key[3]), []).append(len(self._series))
+                self._series.append(key)
+            self._series_size += len(data)
+
+    def get_series_ids(self, keys):
+        """
+        Returns ids of the series, new series are added
+
+        :param keys: iterable of <class 'tuple'> - (route, return_tickets, currency, chain)
+        :return: dictionary: key -> <class 'int'> - series id
+        """
+        keys = list(keys)
+        self.load_series()
+        if any(key not in self._series_ids for key in keys):
+            with self.locked(SERIES_FILE):
+                self.load_series()
+                new = [key for key in dict.fromkeys(keys) if key not in self._series_ids]
+                if new:
+                    path = join(self.directory, SERIES_FILE)
+                    with open(path, 'ab') as series_file:
+                        # A line torn by a crash is dropped, so line numbers stay series ids
+                        series_file.truncate(self._series_size)
+                        series_file.write(b''.join(json.dumps(key).encode() + b'\n' for key in new))
+                    self.load_series()
+        return {key: self._series_ids[key] for key in keys}
+
+    def find_series(self, route, return_tickets=None, chain=''):
+        """
+        :param route: <class 'str'> - route name (see get_route_name)
+        :param return_tickets: <class 'int'> - 0 or 1, None for both
+        :param chain: <class 'str'> - segment chain (see get_chain_name), '' for the minimum of the route
+        :return: dictionary: series id -> (route, return_tickets, currency, chain)
+        """
+        self.load_series()
+        keys = ((series_id, self._series[series_id]) for series_id in self._chains.get((route, chain), ()))
+        return {series_id: key for series_id, key in keys if return_tickets in (None, key[1])}
+
+    def read(self, level, route):
+        """
+        :return: <class 'array.array'> with the points of the level, RECORD_SIZE values per point,
+        an incomplete last point is ignored
+        """
+        records = array('q')
+        try:
+            with open(self.get_path(level, route), 'rb') as level_file:
+                data = level_file.read()
+        except FileNotFoundError:
+            return records
+        records.frombytes(data[:len(data) - len(data) % RECORD_BYTES])
+        return records
+
+    def write(self, level, route, buckets):
+        """
+        Replaces the points of the level atomically
+
+        :param buckets: dictionary: (series id, time) -> [price, duration]
+        """
+        records = array('q')
+        for (series_id, time), (price, duration) in sorted(buckets.items(), key=lambda item: item[0][1]):
+            records.extend((series_id, time) + split_decimal(price) + (duration,))
+        write_atomically(self.get_path(level, route), records.tofile)
+
+    def record(self, result):
+        """
+        Appends the points of the search to the raw level
+
+        :param result: <class 'SearchResult'> with flights data
+        :return: <class 'list'> with names of the routes of the search
+        """
+        time = get_search_time(result)
+        routes = get_search_points(result)
+        for route, points in routes.items():
+            ids = self.get_series_ids((route,) + key for key in points)
+            records = array('q')
+            for key, (price, duration) in points.items():
+                records.extend((ids[(route,) + key], time) + split_decimal(price) + (duration,))
+            with self.locked(route):
+                path = self.get_path('raw', route)
+                with open(path, 'ab') as raw_file:
+                    # A point torn by a crash is dropped
+                    size = raw_file.tell()
+                    if size % RECORD_BYTES:
+                        raw_file.truncate(size - size % RECORD_BYTES)
+                    records.tofile(raw_file)
+        return list(routes)
+
+    def compact(self, route):
+        """
+        Merges raw points into hourly and daily buckets and drops points older than the retention of their level
+
+        :param route: <class 'str'> - route name
+        :return: dictionary: level -> number of points after the compaction
+        """
+        with self.locked(route):
+            raw = self.read('raw', route)
+            if not raw:
+                return {level: len(self.read(level, route)) // RECORD_SIZE for level in LEVELS}
+            latest = max(raw[1::RECORD_SIZE])
+            levels = {'raw': self.aggregate(raw, 'raw')}
+            for level in LEVELS[1:]:
+                levels[level] = self.aggregate(self.read(level, route), level)
+                for key, (price, duration) in self.aggregate(raw, level).items():
+                    merge_point(levels[level], key, price, duration)
+                latest = max([latest] + [time for _, time in levels[level]])
+
+            counts = {}
+            for level, buckets in levels.items():
+                retention = self.retention.get(level)
+                if retention is not None:
+                    oldest = latest - retention // 60
+                    buckets = {key: value for key, value in buckets.items() if key[1] + BUCKETS[level] > oldest}
+                self.write(level, route, buckets)
+                counts[level] = len(buckets)
+            return counts
+
+    def aggregate(self, records, level, series=None, time_from=None, time_to=None):
+        """
+        Merges points into buckets of the level
+
+        :param records: <class 'array.array'> with points (see read)
+        :param level: <class 'str'> - one of LEVELS
+        :param series: set of series ids or None for all series
+        :param time_from: <class 'int'> - minutes since the epoch, points before it are skipped, or None
+        :param time_to: <class 'int'> - minutes since the epoch, points at or after it are skipped, or None
+        :return: dictionary: (series id, bucket time) -> [price, duration]
+        """
+        bucket_size = BUCKETS[level]
+        buckets = {}
+        columns = [records[index::RECORD_SIZE] for index in range(RECORD_SIZE)]
+        for series_id, time, coefficient, exponent, duration in zip(*columns):
+            if series is not None and series_id not in series:
+                continue
+            if (time_from is not None and time < time_from) or (time_to is not None and time >= time_to):
+                continue
+            merge_point(buckets, (series_id, time - time % bucket_size), join_decimal(coefficient, exponent), duration)
+        return buckets
+
+    def get_level(self, route, time_from=None):
+        """
+        Chooses the finest level that keeps the points of the range
+
+        :param route: <class 'str'> - route name
+        :param time_from: <class 'int'> - start of the range in minutes since the epoch or None
+        :return: <class 'str'> - one of LEVELS
+        """
+        if time_from is None:
+            return 'day'
+        raw = self.read('raw', route)
+        latest = max(raw[1::RECORD_SIZE]) if raw else None
+        for level in LEVELS:
+            retention = self.retention.get(level)
+            if retention is None or latest is None or time_from >= latest - retention // 60:
+                return level
+        return 'day'
+
+    def query(self, route, return_tickets=None, chain='', time_from=None, time_to=None, level=None):
+        """
+        Returns points of the series in the range
+
+        :param route: <class 'str'> - route name (see get_route_name)
+        :param return_tickets: <class 'int'> - 0 or 1, None for both
+        :param chain: <class 'str'> - segment chain (see get_chain_name), '' for the minimum of the route
+        :param time_from: <class 'int'> - start of the range in minutes since the epoch or None
+        :param time_to: <class 'int'> - end of the range (excluded) in minutes since the epoch or None
+        :param level: <class 'str'> - one of LEVELS or None to choose it by the range (see get_level)
+        :return: <class 'tuple'> - (level, list of (time, return_tickets, currency, price, duration) sorted by time),
+        the time of a point is the start of its bucket, all buckets that overlap the range are returned
+        """
+        series = self.find_series(route, return_tickets, chain)
+        level = level or self.get_level(route, time_from)
+        if not series:
+            return level, []
+        # Buckets that overlap the range are returned as a whole
+        if time_from is not None:
+            time_from -= time_from % BUCKETS[level]
+        if time_to is not None:
+            time_to += -time_to % BUCKETS[level]
+        with self.locked(route):
+            raw = self.read('raw', route)
+            records = self.read(level, route) if level != 'raw' else array('q')
+        # Raw points are merged too: the level does not have the points recorded since the last compaction
+        buckets = self.aggregate(records, level, series, time_from, time_to)
+        for key, (price, duration) in self.aggregate(raw, level, series, time_from, time_to).items():
+            merge_point(buckets, key, price, duration)
+        points = [
+            (time, series[series_id][1], series[series_id][2], price, duration)
+            for (series_id, time), (price, duration) in buckets.items()
+        ]
+        return level, sorted(points)
+
+
+class FileLock:
+    """
+    Process lock together with fcntl.flock of the lock file, if fcntl is available
+    """
+
+    def __init__(self, path, lock):
+        self.path = path
+        self.lock = lock
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            try:
+                self.file = open(self.path, 'a')
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+            except BaseException:
+                self.close()
+                raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+
+_history = None
+_history_lock = Lock()
+# Recording runs in one background thread, so requests never wait for the history files
+_executor = None
+_compacted = {}
+
+
+def get_history():
+    """
+    Returns the process-wide price history from the FLIGHTS_PRICE_HISTORY setting
+
+    :return: <class 'PriceHistory'> or None if it is not configured
+    """
+    global _history
+    options = get_history_settings()
+    if not options['DIRECTORY']:
+        return None
+    with _history_lock:
+        if _history is None or _history.directory != options['DIRECTORY']:
+            retention = {level: options[name] for level, name in RETENTION_SETTINGS.items()}
+            _history = PriceHistory(options['DIRECTORY'], retention)
+        return _history
+
+
+def write_search(history, result, compact_interval):
+    """
+    Records the search and compacts its routes at most once in compact_interval seconds
+    """
+    try:
+        for route in history.record(result):
+            now = monotonic()
+            if now - _compacted.get(route, -compact_interval) >= compact_interval:
+                _compacted[route] = now
+                history.compact(route)
+    except Exception:
+        logger.exception('The search %s was not recorded to the price history', result.request_id)
+
+
+def record_search(result):
+    """
+    Records the parsed search to the price history in background, every result is recorded once
+    (the record is memoized with the result)
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: <class 'SearchResult'> - the same result
+    """
+    history = get_history()
+    if history is None:
+        return result
+
+    def submit(_):
+        global _executor
+        with _history_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='flights-history')
+                atexit.register(_executor.shutdown)
+        return _executor.submit(write_search, history, result, get_history_settings()['COMPACT_INTERVAL'])
+
+    result.get_derived('price_history', submit)
+    return result
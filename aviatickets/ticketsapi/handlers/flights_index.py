@@ -0,0 +1,210 @@
+"""
+This file contains filtering of flights by indexes built once per search result.
+"""
+from bisect import bisect_left, bisect_right
+from decimal import Decimal, InvalidOperation
+
+from ticketsapi.handlers.flights_model import parse_timestamp
+from ticketsapi.handlers.timing import stage
+
+
+def get_via_airports(option):
+    """
+    Returns intermediate airports of the option (connections of onward and return itineraries)
+
+    :param option: <class 'PricedOption'>
+    :return: <class 'set'> with airport codes
+    """
+    airports = set(flight.destination for flight in option.onward.flights[:-1])
+    if option.back is not None:
+        airports.update(flight.destination for flight in option.back.flights[:-1])
+    return airports
+
+
+def get_carriers(option):
+    """
+    :param option: <class 'PricedOption'>
+    :return: <class 'set'> with carrier ids of all segments
+    """
+    flights = option.onward.flights + (option.back.flights if option.back is not None else ())
+    return set(flight.carrier_id for flight in flights)
+
+
+def get_stops(option):
+    """
+    :param option: <class 'PricedOption'>
+    :return: <class 'int'> - number of stops of onward and return itineraries
+    """
+    return option.onward.stops + (option.back.stops if option.back is not None else 0)
+
+
+class FlightsQuery:
+    """
+    Filters for flights. Fields that are None are not checked.
+
+    * carrier - carrier id of any segment
+    * max_stops - maximum number of stops (connections and stops of segments)
+    * departure_from, departure_to - onward departure window in minutes since the epoch (inclusive)
+    * max_price - maximum total amount
+    * via - code of an intermediate airport
+    """
+    __slots__ = ('carrier', 'max_stops', 'departure_from', 'departure_to', 'max_price', 'via')
+
+    def __init__(self, carrier=None, max_stops=None, departure_from=None, departure_to=None, max_price=None,
+                 via=None):
+        self.carrier = carrier
+        self.max_stops = max_stops
+        self.departure_from = departure_from
+        self.departure_to = departure_to
+        self.max_price = max_price
+        self.via = via
+
+    @classmethod
+    def from_params(cls, params):
+        """
+        Builds the query from request parameters.
+        Departure times use the XML format: '2018-10-22T0005'.
+
+        :param params: dictionary-like object with request parameters
+        :return: <class 'FlightsQuery'>
+        :raise ValueError: if a parameter has a wrong value
+        """
+        def get(name, convert):
+            value = params.get(name)
+            return None if value in (None, '') else convert(value)
+
+        def to_decimal(value):
+            try:
+                value = Decimal(value)
+            except InvalidOperation:
+                raise ValueError('Wrong price: {}'.format(value))
+            # NaN can not be compared with prices, infinity is not a price
+            if not value.is_finite():
+                raise ValueError('Wrong price: {}'.format(value))
+            return value
+
+        return cls(
+            carrier=get('carrier', str),
+            max_stops=get('max_stops', int),
+            departure_from=get('departure_from', parse_timestamp),
+            departure_to=get('departure_to', parse_timestamp),
+            max_price=get('max_price', to_decimal),
+            via=get('via', str)
+        )
+
+    def is_empty(self):
+        return all(getattr(self, name) is None for name in self.__slots__)
+
+    def matches(self, option):
+        """
+        Checks one option without indexes (used when the response is streamed)
+
+        :param option: <class 'PricedOption'>
+        :return: True if the option passes all filters
+        """
+        departure = option.onward.departure
+        return (
+            (self.carrier is None or self.carrier in get_carriers(option))
+            and (self.max_stops is None or get_stops(option) <= self.max_stops)
+            and (self.departure_from is None or departure >= self.departure_from)
+            and (self.departure_to is None or departure <= self.departure_to)
+            and (self.max_price is None or option.total_amount <= self.max_price)
+            and (self.via is None or self.via in get_via_airports(option))
+        )
+
+
+class SortedIndex:
+    """
+    Option ids sorted by a value, range queries use binary search
+    """
+
+    def __init__(self, values):
+        """
+        :param values: list with a value for each option
+        """
+        order = sorted(range(len(values)), key=values.__getitem__)
+        self.values = [values[idx] for idx in order]
+        self.ids = order
+
+    def get_range(self, low=None, high=None):
+        """
+        :param low: minimum value (inclusive) or None
+        :param high: maximum value (inclusive) or None
+        :return: <class 'set'> with option ids
+        """
+        start = 0 if low is None else bisect_left(self.values, low)
+        end = len(self.values) if high is None else bisect_right(self.values, high)
+        return set(self.ids[start:end])
+
+
+class FlightsIndex:
+    """
+    Indexes of one <class 'SearchResult'>: carrier -> option ids, via airport -> option ids
+    and sorted price, departure and stops arrays.
+    """
+
+    def __init__(self, result):
+        """
+        :param result: <class 'SearchResult'> with flights data
+        """
+        options = result.options
+        self.count = len(options)
+        self.by_carrier = {}
+        self.by_via = {}
+        for idx, option in enumerate(options):
+            for carrier in get_carriers(option):
+                self.by_carrier.setdefault(carrier, set()).add(idx)
+            for airport in get_via_airports(option):
+                self.by_via.setdefault(airport, set()).add(idx)
+        self.price = SortedIndex([option.total_amount for option in options])
+        self.departure = SortedIndex([option.onward.departure for option in options])
+        self.stops = SortedIndex([get_stops(option) for option in options])
+
+    def search(self, query):
+        """
+        :param query: <class 'FlightsQuery'>
+        :return: sorted list with ids of options that pass all filters
+        """
+        candidates = []
+        if query.carrier is not None:
+            candidates.append(self.by_carrier.get(query.carrier, set()))
+        if query.via is not None:
+            candidates.append(self.by_via.get(query.via, set()))
+        if query.max_stops is not None:
+            candidates.append(self.stops.get_range(high=query.max_stops))
+        if query.max_price is not None:
+            candidates.append(self.price.get_range(high=query.max_price))
+        if query.departure_from is not None or query.departure_to is not None:
+            candidates.append(self.departure.get_range(query.departure_from, query.departure_to))
+
+        if not candidates:
+            return list(range(self.count))
+        candidates.sort(key=len)
+        return sorted(candidates[0].intersection(*candidates[1:]))
+
+
+def get_index(result):
+    """
+    Returns indexes of the search result, they are built once per result
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: <class 'FlightsIndex'>
+    """
+    with stage('transform'):
+        return result.get_derived('index', FlightsIndex)
+
+
+def filter_flights(result, query, offset=0, limit=None):
+    """
+    Returns one page of options that pass the filters
+
+    :param result: <class 'SearchResult'> with flights data
+    :param query: <class 'FlightsQuery'>
+    :param offset: <class 'int'> - number of matching options to skip
+    :param limit: <class 'int'> - maximum number of options to return or None for all
+    :return: <class 'tuple'> - (new <class 'SearchResult'> with the page, total number of matching options)
+    """
+    with stage('rank'):
+        ids = range(len(result.options)) if query.is_empty() else get_index(result).search(query)
+        end = None if limit is None else offset + limit
+        return result.replace(result.options[idx] for idx in ids[offset:end]), len(ids)
@@ -0,0 +1,206 @@
+"""
+This file contains offline ingestion of archives of supplier responses.
+
+Files are split into chunks that are parsed by a process pool. Every chunk is written by its worker
+to its own output file, so the parent process only collects counters and the work scales with the number
+of processes. Completed chunks are appended to the checkpoint: an interrupted run can be resumed,
+files of completed chunks are skipped. Only one run may write to an output directory at a time.
+
+Output formats:
+* 'jsonl' - part-<chunk>.jsonl, one priced option per line (see get_option_record);
+* 'snapshot' - <source>-<destination>/part-<chunk>.snapshot for every onward route of the chunk
+(see flights_snapshot), the response data of a part is the data of its first response.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from hashlib import sha1
+from os.path import isdir, join
+from time import perf_counter
+
+from ticketsapi.handlers.errors import FlightsError
+from ticketsapi.handlers.files import write_atomically
+from ticketsapi.handlers.flights_archive import ARCHIVE_SUFFIX, SUFFIXES, get_index
+from ticketsapi.handlers.flights_parser import from_xml_to_result
+from ticketsapi.handlers.flights_renderer import dumps
+from ticketsapi.handlers.flights_snapshot import SUFFIX, write_snapshot
+
+FORMATS = ('jsonl', 'snapshot')
+# Files searched in directories: XML files, compressed XML files and archives of responses (see flights_archive)
+XML_SUFFIXES = ('.xml',) + tuple('.xml' + suffix for suffix in SUFFIXES.values()) + (ARCHIVE_SUFFIX,)
+CHECKPOINT = 'checkpoint.jsonl'
+
+
+def find_files(patterns):
+    """
+    :param patterns: list with directories (XML files, also compressed ones, and archives are searched recursively)
+    or glob patterns
+    :return: sorted list with paths of the files, archives are replaced with their members ('path.xmlar#name').
+    Archives with a damaged index are kept as they are: they fail when they are parsed.
+    """
+    paths = set()
+    for pattern in patterns:
+        if isdir(pattern):
+            for suffix in XML_SUFFIXES:
+                paths.update(glob(join(pattern, '**', '*' + suffix), recursive=True))
+        else:
+            paths.update(path for path in glob(pattern, recursive=True) if not isdir(path))
+
+    for path in [path for path in paths if path.endswith(ARCHIVE_SUFFIX)]:
+        try:
+            members = get_index(path)['members']
+        except FlightsError:
+            continue
+        paths.remove(path)
+        paths.update('{}#{}'.format(path, name) for name in members)
+    return sorted(paths)
+
+
+def get_chunk_name(paths):
+    """
+    :param paths: list with paths of the chunk files
+    :return: <class 'str'> - name of the chunk, the same for the same files
+    """
+    return sha1('\n'.join(paths).encode()).hexdigest()[:16]
+
+
+def get_route(option):
+    """
+    :param option: <class 'PricedOption'>
+    :return: <class 'str'> - onward route, e.g. 'DXB-BKK'
+    """
+    return '{}-{}'.format(option.onward.flights[0].source, option.onward.flights[-1].destination)
+
+
+def get_option_record(path, result, position, option):
+    """
+    :return: dictionary with flight data (see PricedOption.as_dict) and the response it was received in
+    """
+    record = {
+        'file': path, 'request_id': result.request_id, 'response_time': result.response_time,
+        'position': position, 'route': get_route(option), 'total_amount': str(option.total_amount),
+        'duration': option.duration
+    }
+    record.update(option.as_dict())
+    return record
+
+
+def ingest_chunk(paths, output_directory, output_format):
+    """
+    Parses the files of one chunk and writes them, runs in a worker process
+
+    :param paths: list with paths of XML files or archive members (see find_files)
+    :param output_directory: <class 'str'> - directory for the output files
+    :param output_format: <class 'str'> - 'jsonl' or 'snapshot'
+    :return: dictionary with 'files', 'failed' (list with [path, error]), 'options' and 'outputs'
+    """
+    name = get_chunk_name(paths)
+    results, failed = [], []
+    for path in paths:
+        try:
+            results.append((path, from_xml_to_result(path)))
+        except FlightsError as error:
+            failed.append([path, str(error)])
+
+    outputs = []
+    if output_format == 'jsonl':
+        outputs.append(join(output_directory, 'part-{}.jsonl'.format(name)))
+
+        def write(output):
+            for path, result in results:
+                for position, option in enumerate(result.options):
+                    output.write(dumps(get_option_record(path, result, position, option)) + b'\n')
+        write_atomically(outputs[0], write)
+    else:
+        routes = {}
+        for path, result in results:
+            for option in result.options:
+                routes.setdefault(get_route(option), (result, []))[1].append(option)
+        for route, (result, options) in sorted(routes.items()):
+            os.makedirs(join(output_directory, route), exist_ok=True)
+            outputs.append(join(output_directory, route, 'part-{}{}'.format(name, SUFFIX)))
+            write_snapshot(result.replace(options), outputs[-1])
+
+    return {
+        'files': paths, 'failed': failed, 'options': sum(len(result.options) for _, result in results),
+        'outputs': outputs
+    }
+
+
+def read_checkpoint(path):
+    """
+    :param path: <class 'str'> - path of the checkpoint file
+    :return: <class 'tuple'> - (<class 'set'> with paths of files of completed chunks (parsed or failed),
+    <class 'set'> with their output files, size of the complete lines of the checkpoint in bytes)
+    """
+    done, outputs, size = set(), set(), 0
+    try:
+        with open(path, 'rb') as checkpoint:
+            for line in checkpoint:
+                try:
+                    chunk = json.loads(line)
+                except ValueError:
+                    # The last line is incomplete if the run was killed while writing it
+                    break
+                done.update(chunk['files'])
+                outputs.update(chunk['outputs'])
+                size += len(line)
+    except FileNotFoundError:
+        pass
+    return done, outputs, size
+
+
+def remove_orphans(output_directory, outputs):
+    """
+    Removes output files of chunks that are not in the checkpoint: their files are ingested again
+
+    :param output_directory: <class 'str'> - directory for output files
+    :param outputs: <class 'set'> with output files of completed chunks
+    """
+    for path in glob(join(output_directory, 'part-*')) + glob(join(output_directory, '*', 'part-*')):
+        if path not in outputs:
+            os.remove(path)
+
+
+def ingest(patterns, output_directory, output_format='jsonl', workers=None, chunk_size=16, log=print):
+    """
+    Parses all files in a process pool and writes normalized results
+
+    :param patterns: list with directories or glob patterns (see find_files)
+    :param output_directory: <class 'str'> - directory for output files and the checkpoint
+    :param output_format: <class 'str'> - 'jsonl' or 'snapshot'
+    :param workers: <class 'int'> - number of processes or None for the number of CPUs
+    :param chunk_size: <class 'int'> - number of files parsed by a worker at once
+    :param log: function that receives progress messages
+    :return: dictionary with 'files', 'skipped', 'failed', 'options' and 'seconds'
+    """
+    if output_format not in FORMATS:
+        raise ValueError('Unknown format: {}'.format(output_format))
+    os.makedirs(output_directory, exist_ok=True)
+    checkpoint_path = join(output_directory, CHECKPOINT)
+    done, outputs, size = read_checkpoint(checkpoint_path)
+    remove_orphans(output_directory, outputs)
+    if os.path.exists(checkpoint_path):
+        os.truncate(checkpoint_path, size)
+    paths = [path for path in find_files(patterns) if path not in done]
+    chunks = [paths[start:start + chunk_size] for start in range(0, len(paths), chunk_size)]
+    log('{} files to ingest, {} skipped by the checkpoint, {} chunks'.format(len(paths), len(done), len(chunks)))
+
+    stats = {'files': 0, 'skipped': len(done), 'failed': 0, 'options': 0}
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(checkpoint_path, 'a') as checkpoint:
+        futures = [executor.submit(ingest_chunk, chunk, output_directory, output_format) for chunk in chunks]
+        for future in as_completed(futures):
+            chunk = future.result()
+            checkpoint.write(json.dumps(chunk) + '\n')
+            checkpoint.flush()
+            stats['files'] += len(chunk['files'])
+            stats['failed'] += len(chunk['failed'])
+            stats['options'] += chunk['options']
+            seconds = perf_counter() - start
+            log('{}/{} files, {} failed, {} options, {:.1f} files/s'.format(
+                stats['files'], len(paths), stats['failed'], stats['options'], stats['files'] / seconds
+            ))
+    stats['seconds'] = perf_counter() - start
+    return stats
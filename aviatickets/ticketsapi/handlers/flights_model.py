@@ -0,0 +1,295 @@
+"""
+This file contains the compact typed representation of flight data.
+
+Values are converted once, when the response is parsed:
+prices become <class 'decimal.Decimal'>, timestamps become minutes since the epoch (UTC),
+the total amount and the total duration of each option are precomputed.
+The as_dict methods return the same dictionaries as flights_parser.from_xml_to_dict.
+"""
+from datetime import date
+from decimal import Decimal
+from sys import intern
+
+from ticketsapi.handlers.single_flight import SingleFlight
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+MINUTES_PER_DAY = 24 * 60
+
+# Derived data requested by concurrent requests is built once (see SearchResult.get_derived)
+derived_calls = SingleFlight()
+
+
+def parse_timestamp(timestamp):
+    """
+    Converts an XML timestamp to minutes since the epoch
+
+    :param timestamp: <class 'str'> in '%Y-%m-%dT%H%M' format, e.g. '2018-10-22T0005'
+    :return: <class 'int'> - minutes since 1970-01-01T0000
+    """
+    days = date(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10])).toordinal() - EPOCH_ORDINAL
+    return days * MINUTES_PER_DAY + int(timestamp[11:13]) * 60 + int(timestamp[13:15])
+
+
+def format_timestamp(minutes):
+    """
+    Converts minutes since the epoch back to the XML timestamp
+
+    :param minutes: <class 'int'> - minutes since 1970-01-01T0000
+    :return: <class 'str'> in '%Y-%m-%dT%H%M' format
+    """
+    days, minutes = divmod(minutes, MINUTES_PER_DAY)
+    return '{}T{:02d}{:02d}'.format(date.fromordinal(days + EPOCH_ORDINAL).isoformat(), *divmod(minutes, 60))
+
+
+def intern_or_none(value):
+    """
+    :param value: <class 'str'> or None
+    :return: interned string or None
+    """
+    return None if value is None else intern(value)
+
+
+class Flight:
+    """
+    One flight segment
+    """
+    __slots__ = (
+        'carrier_id', 'carrier_name', 'flight_number', 'source', 'destination', 'departure', 'arrival',
+        'flight_class', 'number_of_stops', 'fare_basis', 'warning_text', 'ticket_type'
+    )
+
+    def __init__(self, carrier_id, carrier_name, flight_number, source, destination, departure, arrival,
+                 flight_class, number_of_stops, fare_basis, warning_text, ticket_type):
+        self.carrier_id = carrier_id
+        self.carrier_name = carrier_name
+        self.flight_number = flight_number
+        self.source = source
+        self.destination = destination
+        self.departure = departure
+        self.arrival = arrival
+        self.flight_class = flight_class
+        self.number_of_stops = number_of_stops
+        self.fare_basis = fare_basis
+        self.warning_text = warning_text
+        self.ticket_type = ticket_type
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: dictionary with flight data (see flights_parser.get_flight_data)
+        :return: <class 'Flight'>
+        """
+        return cls(
+            intern(data['carrier_id']), intern_or_none(data['carrier_name']), intern(data['flight_number']),
+            intern(data['source']), intern(data['destination']),
+            parse_timestamp(data['departure_time']), parse_timestamp(data['arrival_time']),
+            intern_or_none(data['class']), int(data['number_of_stops']), intern(data['fare_basis']),
+            intern_or_none(data['warning_text']), intern_or_none(data['ticket_type'])
+        )
+
+    @property
+    def departure_time(self):
+        return format_timestamp(self.departure)
+
+    @property
+    def arrival_time(self):
+        return format_timestamp(self.arrival)
+
+    def as_dict(self):
+        return {
+            'carrier_id': self.carrier_id,
+            'carrier_name': self.carrier_name,
+            'flight_number': self.flight_number,
+            'source': self.source,
+            'destination': self.destination,
+            'departure_time': self.departure_time,
+            'arrival_time': self.arrival_time,
+            'class': self.flight_class,
+            'number_of_stops': str(self.number_of_stops),
+            'fare_basis': self.fare_basis,
+            'warning_text': self.warning_text,
+            'ticket_type': self.ticket_type
+        }
+
+
+class Itinerary:
+    """
+    Chain of flight segments in one direction
+    """
+    __slots__ = ('flights', 'duration', 'stops')
+
+    def __init__(self, flights):
+        """
+        :param flights: <class 'tuple'> of <class 'Flight'>
+        """
+        self.flights = flights
+        self.duration = flights[-1].arrival - flights[0].departure
+        self.stops = len(flights) - 1 + sum(flight.number_of_stops for flight in flights)
+
+    @classmethod
+    def from_list(cls, data):
+        """
+        :param data: list with flight data dictionaries
+        :return: <class 'Itinerary'>
+        """
+        return cls(tuple(Flight.from_dict(flight) for flight in data))
+
+    @property
+    def departure(self):
+        return self.flights[0].departure
+
+    @property
+    def arrival(self):
+        return self.flights[-1].arrival
+
+    def as_list(self):
+        return [flight.as_dict() for flight in self.flights]
+
+
+class ServiceCharge:
+    """
+    One service charge of the pricing
+    """
+    __slots__ = ('type', 'charge_type', 'price')
+
+    def __init__(self, type_, charge_type, price):
+        self.type = type_
+        self.charge_type = charge_type
+        self.price = price
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: dictionary with service charge data (see flights_parser.add_service_charges)
+        :return: <class 'ServiceCharge'>
+        """
+        return cls(intern(data['type']), intern(data['charge_type']), Decimal(data['price']))
+
+    def as_dict(self):
+        return {'type': self.type, 'charge_type': self.charge_type, 'price': str(self.price)}
+
+
+class PricedOption:
+    """
+    One priced itinerary: onward and optional return itineraries with pricing
+    """
+    __slots__ = ('onward', 'back', 'currency', 'service_charges', 'total_amount', 'duration')
+
+    def __init__(self, onward, back, currency, service_charges):
+        """
+        :param onward: <class 'Itinerary'>
+        :param back: <class 'Itinerary'> or None if there is no return itinerary
+        :param currency: <class 'str'>
+        :param service_charges: <class 'tuple'> of <class 'ServiceCharge'>
+        """
+        self.onward = onward
+        self.back = back
+        self.currency = currency
+        self.service_charges = service_charges
+        self.total_amount = sum(
+            (charge.price for charge in service_charges if charge.charge_type == 'TotalAmount'), Decimal(0)
+        )
+        self.duration = onward.duration + (back.duration if back is not None else 0)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: dictionary with flight data (see flights_parser.get_priced_itinerary_data)
+        :return: <class 'PricedOption'>
+        """
+        back = data.get('return_itinerary')
+        return cls(
+            Itinerary.from_list(data['onward_itinerary']),
+            Itinerary.from_list(back) if back is not None else None,
+            intern(data['pricing']['currency']),
+            tuple(ServiceCharge.from_dict(charge) for charge in data['pricing']['service_charges'])
+        )
+
+    def get_chain_key(self):
+        """
+        Returns the key of the segment chain: options with equal keys are the same flights
+        (possibly with different prices)
+
+        :return: <class 'tuple'> of (carrier id, flight number, departure, arrival) for every segment,
+        onward segments are separated from return segments by None
+        """
+        flights = self.onward.flights + ((None,) + self.back.flights if self.back is not None else ())
+        return tuple(
+            None if flight is None else (flight.carrier_id, flight.flight_number, flight.departure, flight.arrival)
+            for flight in flights
+        )
+
+    def as_dict(self):
+        data = {'onward_itinerary': self.onward.as_list()}
+        if self.back is not None:
+            data['return_itinerary'] = self.back.as_list()
+        data['pricing'] = {
+            'currency': self.currency,
+            'service_charges': [charge.as_dict() for charge in self.service_charges]
+        }
+        return data
+
+
+class SearchResult:
+    """
+    Parsed AirFareSearchResponse.
+    Instances are shared between requests (see flights_cache) and must not be modified:
+    handlers return new instances via replace().
+    Data derived from the options (columns, indexes, etc.) is memoized in the 'derived' dictionary.
+    """
+    __slots__ = ('options', 'return_tickets', 'request_time', 'response_time', 'request_id', 'derived')
+
+    def __init__(self, options, return_tickets, request_time, response_time, request_id):
+        """
+        :param options: <class 'tuple'> of <class 'PricedOption'>
+        :param return_tickets: <class 'int'> - 1 if there are return itineraries, else 0
+        :param request_time: <class 'str'>
+        :param response_time: <class 'str'>
+        :param request_id: <class 'str'>
+        """
+        self.options = options
+        self.return_tickets = return_tickets
+        self.request_time = request_time
+        self.response_time = response_time
+        self.request_id = request_id
+        self.derived = {}
+
+    def get_derived(self, name, factory):
+        """
+        Returns memoized data derived from this result
+
+        :param name: <class 'str'> - name of the derived data
+        :param factory: function that receives this result and builds the data
+        :return: the data built by factory on the first call
+        """
+        value = self.derived.get(name)
+        if value is None:
+            value = derived_calls.do((id(self), name), lambda: self.build_derived(name, factory))
+        return value
+
+    def build_derived(self, name, factory):
+        # Another thread could build the data between the check in get_derived and the start of this call
+        value = self.derived.get(name)
+        if value is None:
+            value = self.derived[name] = factory(self)
+        return value
+
+    def __reduce__(self):
+        # Derived data is not pickled (see single_flight.SharedResults), it is built again when needed
+        return SearchResult, (self.options, self.return_tickets, self.request_time, self.response_time, self.request_id)
+
+    def replace(self, options):
+        """
+        :param options: iterable of <class 'PricedOption'>
+        :return: new <class 'SearchResult'> with the same response data and other options
+        """
+        return SearchResult(tuple(options), self.return_tickets, self.request_time, self.response_time, self.request_id)
+
+    def as_dict(self):
+        return {
+            'flights': [option.as_dict() for option in self.options],
+            'return_tickets': self.return_tickets,
+            'request_time': self.request_time,
+            'response_time': self.response_time,
+            'request_id': self.request_id
+        }
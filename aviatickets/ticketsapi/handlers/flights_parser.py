@@ -1,8 +1,31 @@
 """
 This file contains everything related to data parsing.
+
+A priced itinerary with missing or wrong data is skipped and counted, the rest of the response is used.
+A malformed document or missing response data raises ParseError.
+
+Segment fields can be projected (see get_field_getters): only the requested fields are extracted.
+Queries that need only prices and times read them with precompiled XPath expressions (see KEY_EXTRACTORS)
+and parse the whole itinerary only if it can be in the answer.
 """
+import logging
+from decimal import Decimal
+from functools import lru_cache
+
 from lxml import etree
-from ticketsapi.handlers.exc_handler import exc_handler
+from ticketsapi.handlers.errors import ITEM_ERRORS, ParseError, SourceError
+from ticketsapi.handlers.flights_archive import DECOMPRESSION_ERRORS, open_source
+from ticketsapi.handlers.flights_model import PricedOption, SearchResult, parse_timestamp
+from ticketsapi.handlers.timing import Counter
+
+logger = logging.getLogger(__name__)
+
+skipped_itineraries = Counter(
+    'flights_skipped_itineraries_total', 'Priced itineraries skipped because of missing or wrong data'
+)
+
+# Response data of the AirFareSearchResponse, the document is malformed without it
+HEADER_KEYS = ('request_time', 'response_time', 'request_id')
 
 
 def get_tickets_type(flights_tags):
@@ -13,14 +36,9 @@ def get_tickets_type(flights_tags):
     :return: <class 'int'> - returns 1 if there are return itineraries.
     If not, it returns 0
     """
-    try:
-        return 1 if flights_tags[0].find('ReturnPricedItinerary') is not None else 0
-    except TypeError as error:
-        print('In func {}: {} {}'.format(get_tickets_type.__name__, error.__class__, error))
-        return 0
+    return 1 if flights_tags[0].find('ReturnPricedItinerary') is not None else 0
 
 
-@exc_handler
 def get_flight_data(flight_tag):
     """
     Parsing flight data from xml tags
@@ -44,28 +62,68 @@ def get_flight_data(flight_tag):
     }
 
 
-@exc_handler
-def add_flight_data_to_dict(tag, itinerary_type, data, flight_number, set_key):
+# Segment field -> lookup in the Flight tag, in the order of get_flight_data
+FLIGHT_FIELDS = {
+    'carrier_id': lambda tag: tag.find('Carrier').attrib['id'],
+    'carrier_name': lambda tag: tag.find('Carrier').text,
+    'flight_number': lambda tag: tag.find('FlightNumber').text,
+    'source': lambda tag: tag.find('Source').text,
+    'destination': lambda tag: tag.find('Destination').text,
+    'departure_time': lambda tag: tag.find('DepartureTimeStamp').text,
+    'arrival_time': lambda tag: tag.find('ArrivalTimeStamp').text,
+    'class': lambda tag: tag.find('Class').text,
+    'number_of_stops': lambda tag: tag.find('NumberOfStops').text,
+    'fare_basis': lambda tag: tag.find('FareBasis').text.strip(),
+    'warning_text': lambda tag: tag.find('WarningText').text,
+    'ticket_type': lambda tag: tag.find('TicketType').text,
+}
+
+
+def get_fields(value):
     """
-    Adds flight data to the dictionary
+    :param value: <class 'str'> - comma-separated segment fields, e.g. 'carrier_id,departure_time'
+    :return: <class 'tuple'> with the fields in the order of FLIGHT_FIELDS
+    :raise ValueError: if a field is unknown
+    """
+    fields = set(value.split(','))
+    unknown = fields.difference(FLIGHT_FIELDS)
+    if unknown:
+        raise ValueError('Unknown fields: {}'.format(', '.join(sorted(unknown))))
+    return tuple(name for name in FLIGHT_FIELDS if name in fields)
+
+
+@lru_cache(maxsize=64)
+def get_field_getters(fields):
+    """
+    :param fields: <class 'tuple'> with segment fields (see get_fields)
+    :return: <class 'tuple'> of (field, lookup) pairs, built once for every set of fields
+    """
+    return tuple((name, FLIGHT_FIELDS[name]) for name in fields)
 
-    :param tag: <class 'lxml.etree._Element'> with flight data
+
+def get_itinerary_data(tag, itinerary_type, fields=None):
+    """
+    Parsing itinerary data from xml tags
+
+    :param tag: <class 'lxml.etree._Element'> with priced itinerary data
     :param itinerary_type: <class 'str'> - 'OnwardPricedItinerary' or 'ReturnPricedItinerary'
-    :param data: dictionary with 'flights' key that contain flight data
-    :param flight_number: <class 'int'> - flight order in data['flights'] list
-    :param set_key: <class 'str'> - key to set data['flights'][flight_number][set_key]
+    :param fields: <class 'tuple'> with segment fields to extract (see get_fields) or None for all fields
+    :return: list with flight data dictionaries
     """
     flight_tags = tag.find(itinerary_type).find('Flights').findall('Flight')
-    [data['flights'][flight_number][set_key].append(get_flight_data(flight_tag)) for flight_tag in flight_tags]
+    if fields is None:
+        return [get_flight_data(flight_tag) for flight_tag in flight_tags]
+    getters = get_field_getters(fields)
+    return [{name: getter(flight_tag) for name, getter in getters} for flight_tag in flight_tags]
 
 
-@exc_handler
 def add_service_charges(service_charges_tags, data):
     """
     Adds service charges data to the dictionary
 
     :param service_charges_tags: the list contains objects of class 'lxml.etree._Element'
     :param data: list to add service charges data
+    :raise ValueError: if the type, the charge type or the price is empty
     """
     for i, charge in enumerate(service_charges_tags):
         data.append({})
@@ -74,39 +132,235 @@ def add_service_charges(service_charges_tags, data):
         price = data[i]['price'] = charge.text
 
         if not type_ or not charge_type or not price:
-            raise Exception('One of the parameters was not found. Wrong data in service_charges_tags')
+            raise ValueError('One of the parameters was not found. Wrong data in service_charges_tags')
 
 
-@exc_handler
-def from_xml_to_dict(xml_file_path):
+def get_priced_itinerary_data(tag, return_tickets, fields=None):
     """
-    From XML data to the dictionary
+    Parsing one priced itinerary (PricedItineraries/Flights tag)
 
-    :param xml_file_path: string with path to XML file
-    :return: dictionary with flights data
+    :param tag: <class 'lxml.etree._Element'> with priced itinerary data
+    :param return_tickets: <class 'int'> - 1 if return itineraries must be parsed too
+    :param fields: <class 'tuple'> with segment fields to extract (see get_fields) or None for all fields
+    :return: dictionary with flight data
     """
-    doc = etree.parse(xml_file_path)
-    flights_tags = doc.find('PricedItineraries').findall('Flights')
-    data = dict()
+    flight = {'onward_itinerary': get_itinerary_data(tag, 'OnwardPricedItinerary', fields)}
+    if return_tickets:
+        flight['return_itinerary'] = get_itinerary_data(tag, 'ReturnPricedItinerary', fields)
+
+    pricing = flight['pricing'] = {'currency': tag.find('Pricing').attrib['currency']}
+    pricing['service_charges'] = []
+    add_service_charges(tag.find('Pricing').findall('ServiceCharges'), pricing['service_charges'])
+    return flight
+
+
+TOTAL_AMOUNTS = etree.XPath('Pricing/ServiceCharges[@ChargeType="TotalAmount"]/text()')
+# First departures and last arrivals of onward itineraries, and of return itineraries for return tickets
+DEPARTURES = (
+    etree.XPath('OnwardPricedItinerary/Flights/Flight[1]/DepartureTimeStamp/text()'),
+    etree.XPath('(OnwardPricedItinerary|ReturnPricedItinerary)/Flights/Flight[1]/DepartureTimeStamp/text()'),
+)
+ARRIVALS = (
+    etree.XPath('OnwardPricedItinerary/Flights/Flight[last()]/ArrivalTimeStamp/text()'),
+    etree.XPath('(OnwardPricedItinerary|ReturnPricedItinerary)/Flights/Flight[last()]/ArrivalTimeStamp/text()'),
+)
+
+
+def get_total_amount(tag, return_tickets):
+    """
+    :param tag: <class 'lxml.etree._Element'> with priced itinerary data
+    :param return_tickets: <class 'int'> - 1 if the response has return itineraries
+    :return: <class 'decimal.Decimal'> - the same value as PricedOption.total_amount
+    """
+    return sum((Decimal(price) for price in TOTAL_AMOUNTS(tag)), Decimal(0))
+
+
+def get_duration(tag, return_tickets):
+    """
+    :param tag: <class 'lxml.etree._Element'> with priced itinerary data
+    :param return_tickets: <class 'int'> - 1 if the response has return itineraries
+    :return: <class 'int'> - the same value as PricedOption.duration, minutes
+    :raise ValueError: if an itinerary has no flights
+    """
+    departures, arrivals = DEPARTURES[return_tickets](tag), ARRIVALS[return_tickets](tag)
+    if not departures or len(departures) != len(arrivals):
+        raise ValueError('Itinerary without flights')
+    return sum(parse_timestamp(arrival) - parse_timestamp(departure)
+               for departure, arrival in zip(departures, arrivals))
+
+
+# Values of get_by keys read without parsing the whole priced itinerary
+KEY_EXTRACTORS = {'price': get_total_amount, 'duration': get_duration}
+
+# Tags needed to stream priced itineraries, other tags are not reported by the parser
+STREAM_EVENTS = ('start', 'end')
+STREAM_TAGS = ('AirFareSearchResponse', 'RequestId', 'Flights')
 
-    flights = data['flights'] = []
-    data['return_tickets'] = get_tickets_type(flights_tags)
-    data['request_time'] = doc.getroot().attrib['RequestTime']
-    data['response_time'] = doc.getroot().attrib['ResponseTime']
-    data['request_id'] = doc.find('RequestId').text
 
-    for num, tag in enumerate(flights_tags):
-        flights.append({'onward_itinerary': []})
-        add_flight_data_to_dict(tag, 'OnwardPricedItinerary', data, num, 'onward_itinerary')
+def process_events(events, header, state, convert=None, extract=get_priced_itinerary_data):
+    """
+    Handles parser events and yields priced itineraries as soon as they are complete.
+    Processed tags are cleared. Itineraries with missing or wrong data are skipped,
+    their number is kept in state['skipped'].
+
+    :param events: iterable of (event, tag) pairs for STREAM_EVENTS and STREAM_TAGS
+    :param header: dictionary to fill with response data (see iter_priced_itineraries)
+    :param state: dictionary that keeps the parsing state between calls for the same document
+    :param convert: function that receives a dictionary with flight data
+    and returns the value to yield (e.g. PricedOption.from_dict), or None to yield dictionaries
+    :param extract: function that receives the priced itinerary tag and 'return_tickets'
+    and returns the data passed to convert (get_priced_itinerary_data by default), or None to skip the itinerary
+    :return: generator of dictionaries with flight data or converted values
+    """
+    for event, tag in events:
+        if event == 'start':
+            if tag.tag == 'AirFareSearchResponse':
+                header['request_time'] = tag.attrib.get('RequestTime')
+                header['response_time'] = tag.attrib.get('ResponseTime')
+            continue
+
+        if tag.tag == 'RequestId':
+            header['request_id'] = tag.text
+        elif tag.tag == 'Flights' and tag.getparent().tag == 'PricedItineraries':
+            if not state.get('started'):
+                header['return_tickets'] = get_tickets_type([tag])
+                state['started'] = True
+            try:
+                flight = extract(tag, header['return_tickets'])
+                item = flight if convert is None or flight is None else convert(flight)
+            except ITEM_ERRORS:
+                state['skipped'] = state.get('skipped', 0) + 1
+                skipped_itineraries.inc()
+            else:
+                if flight is not None:
+                    yield item
+
+            tag.clear()
+            while tag.getprevious() is not None:
+                del tag.getparent()[0]
+
+
+def finish_document(header, state, name):
+    """
+    Checks the response data when the whole document is parsed
+
+    :param header: dictionary with response data (see iter_priced_itineraries)
+    :param state: dictionary with the parsing state (see process_events)
+    :param name: <class 'str'> - path or URL of the document for messages
+    :raise ParseError: if response data is missing
+    """
+    missing = [key for key in HEADER_KEYS if header.get(key) is None]
+    if missing:
+        raise ParseError('{} does not contain {}'.format(name, ', '.join(missing)))
+    if state.get('skipped'):
+        logger.warning('Skipped %d priced itineraries with wrong data in %s', state['skipped'], name)
 
-        if data['return_tickets']:
-            flights[num]['return_itinerary'] = []
-            add_flight_data_to_dict(tag, 'ReturnPricedItinerary', data, num, 'return_itinerary')
 
-        pricing = flights[num]['pricing'] = {'currency': tag.find('Pricing').attrib['currency']}
-        pricing['service_charges'] = []
+def iter_priced_itineraries(xml_source, header=None, convert=None, extract=get_priced_itinerary_data):
+    """
+    Streams priced itineraries from XML data one at a time.
+    Processed tags are cleared, so memory usage does not depend on the document size.
+    Compressed files and archive members are decompressed while they are parsed (see flights_archive.open_source).
 
-        service_charges = tag.find('Pricing').findall('ServiceCharges')
-        add_service_charges(service_charges, pricing['service_charges'])
+    :param xml_source: string with path to XML file, compressed XML file or archive member, or file-like object
+    :param header: dictionary to fill with response data: 'return_tickets', 'request_time',
+    'response_time' and 'request_id'. 'return_tickets' is known after the first itinerary.
+    :param convert: function that converts dictionaries with flight data (see process_events) or None
+    :param extract: function that extracts data of a priced itinerary tag (see process_events)
+    :return: generator of dictionaries with flight data or converted values
+    :raise SourceError: if the file can not be read
+    :raise ParseError: if the document is malformed
+    """
+    if header is None:
+        header = {}
+    header.setdefault('return_tickets', 0)
+    state = {}
+    name = getattr(xml_source, 'name', xml_source)
+
+    xml_file = open_source(xml_source) if isinstance(xml_source, str) else xml_source
+    try:
+        context = etree.iterparse(xml_file, events=STREAM_EVENTS, tag=STREAM_TAGS)
+        yield from process_events(context, header, state, convert, extract)
+    except etree.XMLSyntaxError as error:
+        raise ParseError('{} is malformed: {}'.format(name, error)) from error
+    except DECOMPRESSION_ERRORS as error:
+        raise ParseError('{} is corrupted: {}'.format(name, error)) from error
+    except OSError as error:
+        raise SourceError('{} can not be read: {}'.format(name, error)) from error
+    finally:
+        if xml_file is not xml_source:
+            xml_file.close()
+    del context
+    finish_document(header, state, name)
+
+
+class StreamParser:
+    """
+    Incremental parser for XML data that arrives in chunks (e.g. an HTTP response body)
+    """
 
+    def __init__(self, name='<stream>'):
+        """
+        :param name: <class 'str'> - URL of the document for messages
+        """
+        self.name = name
+        self.header = {'return_tickets': 0}
+        self.options = []
+        self._state = {}
+        self._parser = etree.XMLPullParser(events=STREAM_EVENTS, tag=STREAM_TAGS)
+
+    def feed(self, chunk):
+        """
+        Parses the next chunk of the document
+
+        :param chunk: <class 'bytes'>
+        :raise lxml.etree.XMLSyntaxError: if the document is malformed
+        """
+        self._parser.feed(chunk)
+        self.options.extend(
+            process_events(self._parser.read_events(), self.header, self._state, PricedOption.from_dict)
+        )
+
+    def close(self):
+        """
+        Finishes parsing
+
+        :return: <class 'SearchResult'> with flights data
+        :raise lxml.etree.XMLSyntaxError: if the document is malformed
+        :raise ParseError: if response data is missing
+        """
+        self._parser.close()
+        self.options.extend(
+            process_events(self._parser.read_events(), self.header, self._state, PricedOption.from_dict)
+        )
+        finish_document(self.header, self._state, self.name)
+        return SearchResult(tuple(self.options), **self.header)
+
+
+def from_xml_to_dict(xml_source):
+    """
+    From XML data to the dictionary
+
+    :param xml_source: string with path to XML file, compressed XML file or archive member, or file-like object
+    :return: dictionary with flights data
+    """
+    header = {}
+    data = dict()
+    data['flights'] = list(iter_priced_itineraries(xml_source, header))
+    data['return_tickets'] = header['return_tickets']
+    data['request_time'] = header['request_time']
+    data['response_time'] = header['response_time']
+    data['request_id'] = header['request_id']
     return data
+
+
+def from_xml_to_result(xml_source):
+    """
+    From XML data to the compact typed representation
+
+    :param xml_source: string with path to XML file, compressed XML file or archive member, or file-like object
+    :return: <class 'SearchResult'> with flights data
+    """
+    header = {}
+    options = tuple(iter_priced_itineraries(xml_source, header, PricedOption.from_dict))
+    return SearchResult(options, **header)
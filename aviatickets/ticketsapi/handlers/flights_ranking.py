@@ -0,0 +1,127 @@
+"""
+This file contains multi-criteria ranking of flights: weighted top-K and the Pareto frontier.
+"""
+from heapq import nsmallest
+
+from ticketsapi.handlers import flights_columns
+from ticketsapi.handlers.timing import stage
+
+CRITERIA = ('price', 'duration', 'stops')
+
+
+def get_criteria_values(result):
+    """
+    Returns values of all ranking criteria
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: dictionary: criterion name -> list with a value for each option
+    """
+    options = result.options
+    return {
+        'price': [float(option.total_amount) for option in options],
+        'duration': [option.duration for option in options],
+        'stops': [option.onward.stops + (option.back.stops if option.back is not None else 0) for option in options]
+    }
+
+
+def normalize(values):
+    """
+    Scales values to the [0, 1] range
+
+    :param values: list with numbers
+    :return: list with scaled values (all zeros if the values are equal)
+    """
+    low, high = min(values), max(values)
+    if high == low:
+        return [0.0] * len(values)
+    return [(value - low) / (high - low) for value in values]
+
+
+def get_scores(result, weights):
+    """
+    Calculates the weighted score of each option, the lower the better.
+    Each criterion is normalized to [0, 1] first, so the weights do not depend on units.
+
+    :param result: <class 'SearchResult'> with flights data
+    :param weights: dictionary: criterion name ('price', 'duration', 'stops') -> weight
+    :return: list with a score for each option
+    """
+    scores = [0.0] * len(result.options)
+    for criterion, values in get_criteria_values(result).items():
+        weight = weights.get(criterion, 0)
+        if weight:
+            scores = [score + weight * value for score, value in zip(scores, normalize(values))]
+    return scores
+
+
+def get_scores_numpy(result, weights):
+    """
+    Vectorized version of get_scores
+
+    :param result: <class 'SearchResult'> with flights data
+    :param weights: dictionary: criterion name -> weight
+    :return: <class 'numpy.ndarray'> with a score for each option
+    """
+    np = flights_columns.np
+    columns = flights_columns.get_columns(result)
+    values = {'price': columns.total_price, 'duration': columns.duration, 'stops': columns.stops}
+    scores = np.zeros(len(result.options))
+    for criterion in CRITERIA:
+        weight = weights.get(criterion, 0)
+        column = values[criterion]
+        if weight and len(column):
+            low, high = column.min(), column.max()
+            if high != low:
+                scores += weight * (column - low) / (high - low)
+    return scores
+
+
+def get_top(result, k, weights, engine='python'):
+    """
+    Returns k options with the best (lowest) weighted score.
+    Uses heap (python) or partition (numpy) selection, so the whole result is never sorted.
+    Options with equal scores keep their order in the response.
+
+    :param result: <class 'SearchResult'> with flights data
+    :param k: <class 'int'> - number of options to return
+    :param weights: dictionary: criterion name -> weight (see get_scores)
+    :param engine: <class 'str'> - 'python' or 'numpy'
+    :return: new <class 'SearchResult'> with options ordered from the best
+    """
+    with stage('rank'):
+        count = len(result.options)
+        if engine == 'numpy':
+            np = flights_columns.np
+            scores = get_scores_numpy(result, weights)
+            if 0 < k < count:
+                # Every option tied with the k-th score is kept, so the first ones win like in the python engine
+                indexes = np.flatnonzero(scores <= scores[np.argpartition(scores, k - 1)[k - 1]])
+            else:
+                indexes = np.arange(count if k > 0 else 0)
+            indexes = indexes[np.lexsort((indexes, scores[indexes]))][:k]
+        else:
+            scores = get_scores(result, weights)
+            indexes = nsmallest(k, range(count), key=lambda idx: (scores[idx], idx))
+        return result.replace(result.options[idx] for idx in indexes)
+
+
+def get_pareto_frontier(result):
+    """
+    Returns options that are not dominated by price and duration:
+    there is no other option that is both not more expensive and not longer, and better in one of them.
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: new <class 'SearchResult'> with frontier options ordered by price
+    """
+    with stage('rank'):
+        ordered = sorted(result.options, key=lambda option: (option.total_amount, option.duration))
+        frontier = []
+        best_duration = None
+        for option in ordered:
+            if best_duration is None or option.duration < best_duration:
+                frontier.append(option)
+                best_duration = option.duration
+            elif option.duration == best_duration and option.total_amount == frontier[-1].total_amount:
+                # Same price and duration as the last frontier option: not dominated either
+                frontier.append(option)
+        return result.replace(frontier)
@@ -0,0 +1,196 @@
+"""
+This file contains background refresh of flight data with stale-while-revalidate semantics.
+
+Requests are served from the last good snapshot of every source. A snapshot older than INTERVAL
+is still served while a background thread fetches a new one; a snapshot older than MAX_STALENESS
+is never served: the request waits for the source. A worker thread refreshes the configured sources
+every INTERVAL seconds, so requests usually never wait for suppliers or the parser.
+"""
+import atexit
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from django.conf import settings
+
+from ticketsapi.handlers.errors import FlightsError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_SETTINGS = {
+    'ENABLED': False,
+    # Snapshots younger than this are fresh, seconds. The worker refreshes sources with this interval
+    'INTERVAL': 60,
+    # Snapshots older than this are not served, seconds
+    'MAX_STALENESS': 600,
+    # Sources refreshed by the worker, None for all FLIGHTS_SOURCES
+    'SOURCES': None,
+    # Number of threads that refresh sources at the same time
+    'WORKERS': 4,
+}
+
+
+def get_refresh_settings():
+    """
+    :return: dictionary with the FLIGHTS_REFRESH setting merged with DEFAULT_REFRESH_SETTINGS
+    """
+    return dict(DEFAULT_REFRESH_SETTINGS, **getattr(settings, 'FLIGHTS_REFRESH', {}))
+
+
+class Snapshot:
+    """
+    Flight data of one source and the time it was received
+    """
+    __slots__ = ('result', 'fetched')
+
+    def __init__(self, result, fetched):
+        """
+        :param result: <class 'SearchResult'> with flights data
+        :param fetched: <class 'float'> - time.monotonic() value when the data was received
+        """
+        self.result = result
+        self.fetched = fetched
+
+
+class SnapshotRefresher:
+    """
+    Keeps the last good snapshot of every source and refreshes snapshots in background threads
+    """
+
+    def __init__(self, fetch, interval=60, max_staleness=600, workers=4):
+        """
+        :param fetch: function that receives a source and returns <class 'SearchResult'>
+        :param interval: <class 'float'> - age of fresh snapshots, seconds
+        :param max_staleness: <class 'float'> - maximum age of served snapshots, seconds
+        :param workers: <class 'int'> - number of threads that refresh sources
+        """
+        self.fetch = fetch
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self._snapshots = {}
+        self._refreshing = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flights-refresh')
+        self._stopped = Event()
+        self._thread = None
+
+    def get(self, source):
+        """
+        Returns flight data of the source: the snapshot if it is not older than max_staleness
+        (a stale one is refreshed in background), else data fetched now
+
+        :param source: path where the XML file is located or URL of the supplier
+        :return: <class 'SearchResult'> with flights data
+        :raise FlightsError: if there is no snapshot to serve and the source can not be fetched
+        """
+        snapshot = self._snapshots.get(source)
+        if snapshot is not None:
+            age = monotonic() - snapshot.fetched
+            if age < self.interval:
+                return snapshot.result
+            if age < self.max_staleness:
+                self.refresh_async(source)
+                return snapshot.result
+        return self.refresh(source)
+
+    def refresh(self, source):
+        """
+        Fetches the source and saves the snapshot
+
+        :param source: path where the XML file is located or URL of the supplier
+        :return: <class 'SearchResult'> with flights data
+        """
+        result = self.fetch(source)
+        with self._lock:
+            self._snapshots[source] = Snapshot(result, monotonic())
+        return result
+
+    def refresh_async(self, source):
+        """
+        Starts refreshing of the source in background, if it is not being refreshed already
+
+        :param source: path where the XML file is located or URL of the supplier
+        """
+        with self._lock:
+            if source in self._refreshing:
+                return
+            self._refreshing.add(source)
+        self._executor.submit(self._refresh_in_background, source)
+
+    def _refresh_in_background(self, source):
+        try:
+            self.refresh(source)
+        except FlightsError as error:
+            # The last good snapshot is served until it is too old
+            logger.warning('Refresh of %s failed: %s', source, error)
+        finally:
+            with self._lock:
+                self._refreshing.discard(source)
+
+    def start(self, sources):
+        """
+        Starts the worker thread that refreshes the sources every interval, the first time at once
+
+        :param sources: list with paths of XML files or URLs of suppliers
+        """
+        def run():
+            while True:
+                for source in sources:
+                    self.refresh_async(source)
+                if self._stopped.wait(self.interval):
+                    return
+
+        self._thread = Thread(target=run, name='flights-refresh-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the worker thread and waits for running refreshes
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown()
+
+    def get_ages(self):
+        """
+        :return: dictionary: source -> age of its snapshot in seconds
+        """
+        now = monotonic()
+        with self._lock:
+            return {source: now - snapshot.fetched for source, snapshot in self._snapshots.items()}
+
+
+_refresher = None
+_refresher_lock = Lock()
+
+
+def get_refresher(fetch):
+    """
+    Returns the process-wide refresher, it is created and started at first use
+    from the FLIGHTS_REFRESH setting
+
+    :param fetch: function that receives a source and returns <class 'SearchResult'>
+    :return: <class 'SnapshotRefresher'>
+    """
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None:
+            options = get_refresh_settings()
+            _refresher = SnapshotRefresher(
+                fetch, options['INTERVAL'], options['MAX_STALENESS'], options['WORKERS']
+            )
+            sources = options['SOURCES']
+            if sources is None:
+                sources = list(settings.FLIGHTS_SOURCES.values())
+            _refresher.start(sources)
+            atexit.register(_refresher.stop)
+        return _refresher
+
+
+def get_snapshot_ages():
+    """
+    :return: dictionary: source -> age of its snapshot in seconds, empty if the refresher is not running
+    """
+    return _refresher.get_ages() if _refresher is not None else {}
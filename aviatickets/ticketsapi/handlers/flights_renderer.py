@@ -0,0 +1,137 @@
+"""
+This file contains fast serialization of flight responses.
+
+orjson is used if it is installed (the FLIGHTS_JSON_SERIALIZER setting), otherwise the standard json module.
+Responses that do not depend on request parameters are serialized once, compressed on demand
+and served with ETag / If-None-Match support.
+"""
+import gzip
+import json
+from hashlib import sha1
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+from ticketsapi.handlers.timing import stage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compressors by Content-Encoding, in the order of preference
+COMPRESSORS = (
+    ('br', lambda body: brotli.compress(body)),
+    ('gzip', lambda body: gzip.compress(body, compresslevel=6)),
+)
+
+
+def dumps(data):
+    """
+    Serializes data to JSON
+
+    :param data: dictionary with JSON-compatible values
+    :return: <class 'bytes'>
+    """
+    serializer = getattr(settings, 'FLIGHTS_JSON_SERIALIZER', 'auto')
+    with stage('serialize'):
+        if orjson is not None and serializer in ('auto', 'orjson'):
+            return orjson.dumps(data)
+        return json.dumps(data).encode()
+
+
+def json_response(data, status=200):
+    """
+    :param data: dictionary with JSON-compatible values
+    :param status: <class 'int'> - HTTP status
+    :return: <class 'django.http.HttpResponse'> with JSON body
+    """
+    return HttpResponse(dumps(data), content_type='application/json', status=status)
+
+
+def get_available_encodings():
+    """
+    :return: list with names of encodings that can be used for pre-compression
+    """
+    encodings = getattr(settings, 'FLIGHTS_PRECOMPRESS', ('br', 'gzip'))
+    return [name for name, _ in COMPRESSORS if name in encodings and (name != 'br' or brotli is not None)]
+
+
+def choose_encoding(request):
+    """
+    Chooses the best encoding accepted by the client
+
+    :param request: <class 'django.http.HttpRequest'>
+    :return: <class 'str'> - name of the encoding or None for the identity
+    """
+    accepted = [
+        value.split(';')[0].strip() for value in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')
+    ]
+    for name in get_available_encodings():
+        if name in accepted:
+            return name
+    return None
+
+
+class RenderedResponse:
+    """
+    JSON body serialized once, with its ETag and compressed versions created on first use
+    """
+    __slots__ = ('body', 'etag', 'encoded')
+
+    def __init__(self, data):
+        """
+        :param data: dictionary with JSON-compatible values
+        """
+        self.body = dumps(data)
+        self.etag = '"{}"'.format(sha1(self.body).hexdigest())
+        self.encoded = {}
+
+    def get_body(self, encoding):
+        """
+        :param encoding: <class 'str'> - name of the encoding or None for the identity
+        :return: <class 'bytes'> - body in the encoding
+        """
+        if encoding is None:
+            return self.body
+        body = self.encoded.get(encoding)
+        if body is None:
+            with stage('compress'):
+                body = self.encoded[encoding] = dict(COMPRESSORS)[encoding](self.body)
+        return body
+
+    def to_response(self, request):
+        """
+        :param request: <class 'django.http.HttpRequest'>
+        :return: <class 'django.http.HttpResponse'>: 304 if the client has the same version (If-None-Match),
+        else 200 with the body in the best accepted encoding
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if self.etag in [value.strip() for value in if_none_match.split(',')] or if_none_match.strip() == '*':
+            response = HttpResponseNotModified()
+        else:
+            encoding = choose_encoding(request)
+            response = HttpResponse(self.get_body(encoding), content_type='application/json')
+            if encoding is not None:
+                response['Content-Encoding'] = encoding
+        response['ETag'] = self.etag
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
+def get_rendered(result, name, build):
+    """
+    Returns the serialized response memoized with the search result
+
+    :param result: <class 'SearchResult'> the response depends on
+    :param name: <class 'str'> - name of the response (e.g. the method name)
+    :param build: function that receives the result and returns data to serialize
+    :return: <class 'RenderedResponse'>
+    """
+    return result.get_derived('rendered:' + name, lambda flights: RenderedResponse(build(flights)))
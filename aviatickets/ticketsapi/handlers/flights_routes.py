@@ -0,0 +1,202 @@
+"""
+This file contains the search of routes over stored flight segments (connection scan).
+
+Segments of all stored search responses (see flights_store) form one timetable: distinct flights sorted
+by departure. A query scans the flights departing after the requested time once. A flight is reachable
+if it departs from the origin, or from an airport where a reachable flight arrived from min_layover
+to max_layover minutes before its departure. The fewest legs to reach every flight are kept, so one scan
+answers both the earliest-arrival and the fewest-stops query.
+
+Routes are schedules: segments are not priced, fares are known only for itineraries sent by suppliers.
+"""
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from ticketsapi.handlers.flights_model import Flight, Itinerary
+from ticketsapi.handlers.single_flight import SingleFlight
+from ticketsapi.handlers.timing import stage
+from ticketsapi.models import SearchResponse, Segment
+
+# Defaults of the route queries, minutes
+MIN_LAYOVER = 45
+MAX_LAYOVER = 24 * 60
+# Flights departing later than this after the requested departure are not scanned
+MAX_DURATION = 3 * 24 * 60
+MAX_LEGS = 4
+
+OPTIMIZE = ('arrival', 'stops')
+
+SEGMENT_FIELDS = (
+    'carrier_id', 'carrier_name', 'flight_number', 'source', 'destination', 'departure', 'arrival',
+    'flight_class', 'number_of_stops', 'fare_basis', 'warning_text', 'ticket_type'
+)
+
+
+class Timetable:
+    """
+    Distinct flights sorted by departure
+    """
+
+    def __init__(self, flights):
+        """
+        :param flights: iterable of <class 'Flight'>, the same flight of several itineraries
+        (carrier, flight number, source airport and departure) is kept once
+        """
+        distinct = {}
+        for flight in flights:
+            if flight.arrival > flight.departure:
+                distinct.setdefault((flight.carrier_id, flight.flight_number, flight.source, flight.departure), flight)
+        self.flights = sorted(distinct.values(), key=lambda flight: (flight.departure, flight.arrival))
+        self.departures = [flight.departure for flight in self.flights]
+
+    def __len__(self):
+        return len(self.flights)
+
+    def find_route(self, source, destination, departure_from, departure_to=None, min_layover=MIN_LAYOVER,
+                   max_layover=MAX_LAYOVER, max_legs=MAX_LEGS, optimize='arrival', max_duration=MAX_DURATION):
+        """
+        Finds the route with the earliest arrival or with the fewest stops
+
+        :param source: <class 'str'> - departure airport
+        :param destination: <class 'str'> - arrival airport
+        :param departure_from: <class 'int'> - earliest departure, minutes since the epoch
+        :param departure_to: <class 'int'> - latest departure or None for any departure in max_duration
+        :param min_layover: <class 'int'> - minimum time between the arrival and the next departure, minutes
+        :param max_layover: <class 'int'> - maximum time between the arrival and the next departure, minutes
+        :param max_legs: <class 'int'> - maximum number of flights in the route
+        :param optimize: <class 'str'> - 'arrival': the earliest arrival, then the fewest legs;
+        'stops': the fewest legs, then the earliest arrival
+        :param max_duration: <class 'int'> - only flights departing before departure_from + max_duration are used
+        :return: <class 'Itinerary'> or None if there is no route
+        """
+        if optimize not in OPTIMIZE:
+            raise ValueError('Unknown optimization: {}'.format(optimize))
+        if departure_to is None:
+            departure_to = departure_from + max_duration
+
+        flights = self.flights
+        # Airport -> arrival times of reachable flights (sorted) and their indexes
+        arrivals = {}
+        # Index of a reachable flight -> (legs, index of the previous flight or None)
+        labels = {}
+        best = None
+        horizon = departure_from + max_duration
+
+        for idx in range(bisect_left(self.departures, departure_from), len(flights)):
+            flight = flights[idx]
+            if flight.departure > horizon:
+                break
+            if flight.destination == source:
+                continue
+
+            legs, previous = None, None
+            if flight.source == source:
+                if flight.departure <= departure_to:
+                    legs = 1
+            elif flight.source in arrivals:
+                times, ids = arrivals[flight.source]
+                start = bisect_left(times, flight.departure - max_layover)
+                for position in range(start, bisect_right(times, flight.departure - min_layover)):
+                    candidate = labels[ids[position]][0]
+                    if candidate < max_legs and (legs is None or candidate + 1 < legs):
+                        legs, previous = candidate + 1, ids[position]
+            if legs is None:
+                continue
+
+            labels[idx] = (legs, previous)
+            if flight.destination == destination:
+                key = (flight.arrival, legs) if optimize == 'arrival' else (legs, flight.arrival)
+                if best is None or key < best[0]:
+                    best = (key, idx)
+                    # Flights departing after the best arrival can not arrive earlier
+                    if optimize == 'arrival' or legs == 1:
+                        horizon = min(horizon, flight.arrival)
+                    else:
+                        max_legs = legs
+                continue
+            # Routes continuing this flight have more legs than the best route
+            if legs >= max_legs:
+                continue
+
+            times, ids = arrivals.setdefault(flight.destination, ([], []))
+            position = bisect_right(times, flight.arrival)
+            times.insert(position, flight.arrival)
+            ids.insert(position, idx)
+
+        if best is None:
+            return None
+        route, idx = [], best[1]
+        while idx is not None:
+            route.append(flights[idx])
+            idx = labels[idx][1]
+        return Itinerary(tuple(reversed(route)))
+
+
+def load_timetable():
+    """
+    :return: <class 'Timetable'> with segments of all stored search responses
+    """
+    segments = Segment.objects.values_list(*SEGMENT_FIELDS).iterator()
+    return Timetable(Flight(*values) for values in segments)
+
+
+# (version of the stored responses, timetable, time of the last version check)
+_timetable = None
+_timetable_lock = Lock()
+timetable_calls = SingleFlight()
+
+
+def get_timetable():
+    """
+    Returns the timetable of stored segments, it is built again when search responses are stored or deleted.
+    Stored responses are checked for changes at most once per FLIGHTS_ROUTES_CHECK_INTERVAL seconds,
+    or at once when this process stores or deletes them (see expire_timetable). Responses stored
+    by other processes less than the interval ago may be missing.
+
+    :return: <class 'Timetable'>
+    """
+    global _timetable
+    interval = getattr(settings, 'FLIGHTS_ROUTES_CHECK_INTERVAL', 1.0)
+    with _timetable_lock:
+        if _timetable is not None and monotonic() - _timetable[2] < interval:
+            return _timetable[1]
+
+    checked = monotonic()
+    version = tuple(SearchResponse.objects.aggregate(count=Count('id'), last=Max('id')).values())
+    with _timetable_lock:
+        if _timetable is not None and _timetable[0] == version:
+            _timetable = (version, _timetable[1], checked)
+            return _timetable[1]
+
+    def build():
+        global _timetable
+        with stage('transform'):
+            timetable = load_timetable()
+        with _timetable_lock:
+            _timetable = (version, timetable, checked)
+        return timetable
+
+    return timetable_calls.do(('timetable', version), build)
+
+
+def expire_timetable():
+    """
+    Makes the next get_timetable call check the stored responses for changes
+    """
+    global _timetable
+    with _timetable_lock:
+        if _timetable is not None:
+            _timetable = (_timetable[0], _timetable[1], float('-inf'))
+
+
+@receiver((post_save, post_delete), sender=SearchResponse)
+def on_responses_changed(**kwargs):
+    # Segments of a stored response are saved in the same transaction (see flights_store.store_result)
+    transaction.on_commit(expire_timetable)
@@ -0,0 +1,322 @@
+"""
+This file contains the binary snapshot format of parsed search responses.
+
+A snapshot is written once from a parsed response (see the convert_snapshots command) and opened with mmap:
+processes that open the same snapshot share one physical copy of it, and no XML is parsed.
+
+Layout: magic, header length (uint32), JSON header, then columns aligned to 8 bytes.
+Every column is an array of fixed-width values (see OPTION_COLUMNS, SEGMENT_COLUMNS, CHARGE_COLUMNS),
+strings are stored as ids into the string table: 'string_offsets' (n + 1 values) and 'string_data' (UTF-8).
+Prices are stored exactly as a decimal coefficient and exponent.
+Options are built from the columns when they are accessed (see SnapshotOptions).
+The columnar engine reads prices, durations and stops straight from the option columns (see flights_columns).
+"""
+import json
+import mmap
+import sys
+from array import array
+from decimal import Decimal
+
+from ticketsapi.handlers.errors import ParseError, SourceError
+from ticketsapi.handlers.files import write_atomically
+from ticketsapi.handlers.flights_model import Flight, Itinerary, PricedOption, SearchResult, ServiceCharge
+
+MAGIC = b'AFSNAP\x00\x01'
+SUFFIX = '.snapshot'
+# String id of None
+NO_STRING = 0xFFFFFFFF
+ALIGNMENT = 8
+
+# Column name -> array typecode
+OPTION_COLUMNS = (
+    ('total_coefficient', 'q'), ('total_exponent', 'b'), ('duration', 'q'), ('stops', 'i'), ('currency', 'I'),
+    ('segment_start', 'I'), ('onward_count', 'H'), ('back_count', 'H'), ('charge_start', 'I'), ('charge_count', 'H'),
+)
+SEGMENT_COLUMNS = (
+    ('carrier_id', 'I'), ('carrier_name', 'I'), ('flight_number', 'I'), ('source', 'I'), ('destination', 'I'),
+    ('departure', 'q'), ('arrival', 'q'), ('flight_class', 'I'), ('number_of_stops', 'i'), ('fare_basis', 'I'),
+    ('warning_text', 'I'), ('ticket_type', 'I'),
+)
+CHARGE_COLUMNS = (('type', 'I'), ('charge_type', 'I'), ('price_coefficient', 'q'), ('price_exponent', 'b'))
+STRING_COLUMNS = (('string_offsets', 'I'), ('string_data', 'B'))
+ALL_COLUMNS = OPTION_COLUMNS + SEGMENT_COLUMNS + CHARGE_COLUMNS + STRING_COLUMNS
+HEADER_KEYS = ('byteorder', 'return_tickets', 'request_time', 'response_time', 'request_id', 'options', 'columns')
+
+
+def is_snapshot(source):
+    """
+    :param source: path where the file is located or URL of the supplier
+    :return: True if the source is a snapshot file
+    """
+    return source.endswith(SUFFIX)
+
+
+def split_decimal(value):
+    """
+    :param value: <class 'decimal.Decimal'>
+    :return: <class 'tuple'> - (integer coefficient, exponent), Decimal(coefficient).scaleb(exponent) == value
+    """
+    sign, digits, exponent = value.as_tuple()
+    coefficient = int(''.join(map(str, digits))) if digits else 0
+    return -coefficient if sign else coefficient, exponent
+
+
+def join_decimal(coefficient, exponent):
+    """
+    :return: <class 'decimal.Decimal'> with the same digits as the value passed to split_decimal
+    """
+    return Decimal(coefficient).scaleb(exponent)
+
+
+class StringTable:
+    """
+    Collects distinct strings and assigns ids to them
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, value):
+        """
+        :param value: <class 'str'> or None
+        :return: <class 'int'> - id of the string
+        """
+        if value is None:
+            return NO_STRING
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+
+def write_snapshot(result, path):
+    """
+    Writes the search result as a snapshot.
+    The file is replaced atomically, so processes that have the old snapshot mapped keep a valid copy.
+
+    :param result: <class 'SearchResult'> with flights data
+    :param path: <class 'str'> - path of the snapshot file
+    """
+    strings = StringTable()
+    columns = {name: array(typecode) for name, typecode in OPTION_COLUMNS + SEGMENT_COLUMNS + CHARGE_COLUMNS}
+
+    for option in result.options:
+        coefficient, exponent = split_decimal(option.total_amount)
+        columns['total_coefficient'].append(coefficient)
+        columns['total_exponent'].append(exponent)
+        columns['duration'].append(option.duration)
+        columns['stops'].append(option.onward.stops + (option.back.stops if option.back is not None else 0))
+        columns['currency'].append(strings.add(option.currency))
+        columns['segment_start'].append(len(columns['departure']))
+        columns['onward_count'].append(len(option.onward.flights))
+        columns['back_count'].append(len(option.back.flights) if option.back is not None else 0)
+        columns['charge_start'].append(len(columns['type']))
+        columns['charge_count'].append(len(option.service_charges))
+
+        for flight in option.onward.flights + (option.back.flights if option.back is not None else ()):
+            for name in ('carrier_id', 'carrier_name', 'flight_number', 'source', 'destination', 'flight_class',
+                         'fare_basis', 'warning_text', 'ticket_type'):
+                columns[name].append(strings.add(getattr(flight, name)))
+            columns['departure'].append(flight.departure)
+            columns['arrival'].append(flight.arrival)
+            columns['number_of_stops'].append(flight.number_of_stops)
+
+        for charge in option.service_charges:
+            coefficient, exponent = split_decimal(charge.price)
+            columns['type'].append(strings.add(charge.type))
+            columns['charge_type'].append(strings.add(charge.charge_type))
+            columns['price_coefficient'].append(coefficient)
+            columns['price_exponent'].append(exponent)
+
+    encoded = [value.encode() for value in strings.strings]
+    columns['string_offsets'] = array('I', [0])
+    for value in encoded:
+        columns['string_offsets'].append(columns['string_offsets'][-1] + len(value))
+    columns['string_data'] = array('B', b''.join(encoded))
+
+    header = {
+        'byteorder': sys.byteorder,
+        'return_tickets': result.return_tickets,
+        'request_time': result.request_time,
+        'response_time': result.response_time,
+        'request_id': result.request_id,
+        'options': len(result.options),
+        'columns': {},
+    }
+    # Offsets depend on the header length, so they are computed relative to the end of the header
+    offset = 0
+    for name, column in columns.items():
+        offset += -offset % ALIGNMENT
+        header['columns'][name] = [offset, column.typecode, len(column)]
+        offset += len(column) * column.itemsize
+
+    header_data = json.dumps(header).encode()
+    start = len(MAGIC) + 4 + len(header_data)
+    padding = -start % ALIGNMENT
+
+    def write(snapshot_file):
+        snapshot_file.write(MAGIC + len(header_data).to_bytes(4, 'little') + header_data + b'\0' * padding)
+        position = 0
+        for name, column in columns.items():
+            column_offset = header['columns'][name][0]
+            snapshot_file.write(b'\0' * (column_offset - position))
+            snapshot_file.write(column.tobytes())
+            position = column_offset + len(column) * column.itemsize
+
+    write_atomically(path, write)
+
+
+class SnapshotReader:
+    """
+    Memory-mapped snapshot: columns are memoryviews of the mapping, nothing is copied
+    except the decoded string table
+    """
+
+    def __init__(self, path):
+        """
+        :param path: <class 'str'> - path of the snapshot file
+        :raise SourceError: if the file can not be read
+        :raise ParseError: if the file is not a snapshot or it is damaged
+        """
+        try:
+            with open(path, 'rb') as snapshot_file:
+                self.mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as error:
+            raise SourceError('{} can not be read: {}'.format(path, error)) from error
+        except ValueError as error:
+            # Empty files can not be mapped
+            raise ParseError('{} is empty'.format(path)) from error
+
+        if self.mapping[:len(MAGIC)] != MAGIC:
+            raise ParseError('{} is not a flights snapshot'.format(path))
+        header_length = int.from_bytes(self.mapping[len(MAGIC):len(MAGIC) + 4], 'little')
+        start = len(MAGIC) + 4
+        if start + header_length > len(self.mapping):
+            raise ParseError('{} is truncated'.format(path))
+        try:
+            self.header = json.loads(self.mapping[start:start + header_length].decode())
+        except ValueError as error:
+            raise ParseError('{} has a malformed header: {}'.format(path, error)) from error
+        if not isinstance(self.header, dict) or not isinstance(self.header.get('columns'), dict):
+            raise ParseError('{} has a malformed header: no columns'.format(path))
+        missing = [key for key in HEADER_KEYS if key not in self.header]
+        missing += [name for name, _ in ALL_COLUMNS if name not in self.header['columns']]
+        if missing:
+            raise ParseError('{} has a malformed header: no {}'.format(path, ', '.join(missing)))
+        if self.header['byteorder'] != sys.byteorder:
+            raise ParseError('{} was written on a {} endian system'.format(path, self.header['byteorder']))
+        start += header_length
+        start += -start % ALIGNMENT
+
+        view = memoryview(self.mapping)
+        self.columns = {}
+        for name, typecode in ALL_COLUMNS:
+            try:
+                offset, column_typecode, length = self.header['columns'][name]
+                end = start + offset + length * array(typecode).itemsize
+                valid = column_typecode == typecode and offset >= 0 and length >= 0
+            except (ValueError, TypeError) as error:
+                raise ParseError('{} has a malformed column {}: {}'.format(path, name, error)) from error
+            if not valid:
+                raise ParseError('{} has a malformed column {}'.format(path, name))
+            if end > len(self.mapping):
+                raise ParseError('{} is truncated'.format(path))
+            self.columns[name] = view[start + offset:end].cast(typecode)
+        if any(len(self.columns[name]) != self.header['options'] for name, _ in OPTION_COLUMNS):
+            raise ParseError('{} has a malformed header: wrong number of options'.format(path))
+
+        offsets, data = self.columns['string_offsets'], self.columns['string_data']
+        try:
+            self.strings = [
+                sys.intern(bytes(data[offsets[idx]:offsets[idx + 1]]).decode()) for idx in range(len(offsets) - 1)
+            ]
+        except UnicodeDecodeError as error:
+            raise ParseError('{} has a malformed string table: {}'.format(path, error)) from error
+
+    def get_string(self, string_id):
+        return None if string_id == NO_STRING else self.strings[string_id]
+
+    def get_flight(self, idx):
+        """
+        :param idx: <class 'int'> - index of the segment
+        :return: <class 'Flight'>
+        """
+        columns, get_string = self.columns, self.get_string
+        return Flight(
+            get_string(columns['carrier_id'][idx]), get_string(columns['carrier_name'][idx]),
+            get_string(columns['flight_number'][idx]), get_string(columns['source'][idx]),
+            get_string(columns['destination'][idx]), columns['departure'][idx], columns['arrival'][idx],
+            get_string(columns['flight_class'][idx]), columns['number_of_stops'][idx],
+            get_string(columns['fare_basis'][idx]), get_string(columns['warning_text'][idx]),
+            get_string(columns['ticket_type'][idx])
+        )
+
+    def get_option(self, idx):
+        """
+        :param idx: <class 'int'> - index of the priced option
+        :return: <class 'PricedOption'>
+        """
+        columns = self.columns
+        start, onward_count = columns['segment_start'][idx], columns['onward_count'][idx]
+        back_count = columns['back_count'][idx]
+        onward = Itinerary(tuple(self.get_flight(segment) for segment in range(start, start + onward_count)))
+        back = None
+        if back_count:
+            start += onward_count
+            back = Itinerary(tuple(self.get_flight(segment) for segment in range(start, start + back_count)))
+        charge_start = columns['charge_start'][idx]
+        charges = tuple(
+            ServiceCharge(
+                self.get_string(columns['type'][charge]), self.get_string(columns['charge_type'][charge]),
+                join_decimal(columns['price_coefficient'][charge], columns['price_exponent'][charge])
+            )
+            for charge in range(charge_start, charge_start + columns['charge_count'][idx])
+        )
+        return PricedOption(onward, back, self.get_string(columns['currency'][idx]), charges)
+
+
+class SnapshotOptions:
+    """
+    Read-only sequence of the priced options of a snapshot.
+    Options are built on access and are not kept, so the process holds only the shared mapping.
+    """
+    __slots__ = ('reader',)
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.header['options']
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return tuple(self.reader.get_option(position) for position in range(*idx.indices(len(self))))
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('option index out of range')
+        return self.reader.get_option(idx)
+
+    def __iter__(self):
+        return (self.reader.get_option(idx) for idx in range(len(self)))
+
+    def __bool__(self):
+        return len(self) > 0
+
+
+def open_snapshot(path):
+    """
+    Opens the snapshot as a search result.
+    Handlers use it like a parsed response; derived data (columns, indexes, etc.) is built from it as usual.
+
+    :param path: <class 'str'> - path of the snapshot file
+    :return: <class 'SearchResult'> with <class 'SnapshotOptions'>
+    """
+    reader = SnapshotReader(path)
+    header = reader.header
+    return SearchResult(
+        SnapshotOptions(reader), header['return_tickets'], header['request_time'], header['response_time'],
+        header['request_id']
+    )
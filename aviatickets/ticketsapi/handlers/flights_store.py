@@ -0,0 +1,153 @@
+"""
+This file contains the database store of search results.
+
+Parsed responses are saved with bulk_create in one transaction, so many searches can be queried
+with indexed SQL (route, departure date, total amount, duration) instead of scanning XML files.
+"""
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min
+
+from ticketsapi.handlers.flights_model import EPOCH_ORDINAL, MINUTES_PER_DAY
+from ticketsapi.models import PricedItinerary, SearchResponse, Segment, ServiceCharge
+
+# Columns of PricedItinerary for get_stored_by keys
+ORDER_FIELDS = {'price': 'total_amount', 'duration': 'duration'}
+
+
+def get_date(minutes):
+    """
+    :param minutes: <class 'int'> - minutes since the epoch
+    :return: <class 'datetime.date'>
+    """
+    return date.fromordinal(minutes // MINUTES_PER_DAY + EPOCH_ORDINAL)
+
+
+def iter_segments(itinerary_id, option):
+    """
+    :param itinerary_id: <class 'int'> - id of the stored option
+    :param option: <class 'PricedOption'>
+    :return: generator of <class 'Segment'> for onward and return flights
+    """
+    itineraries = ((False, option.onward),) + (((True, option.back),) if option.back is not None else ())
+    for is_return, itinerary in itineraries:
+        last = len(itinerary.flights) - 1
+        for position, flight in enumerate(itinerary.flights):
+            yield Segment(
+                itinerary_id=itinerary_id, is_return=is_return, position=position, is_connection=position < last,
+                carrier_id=flight.carrier_id, carrier_name=flight.carrier_name, flight_number=flight.flight_number,
+                source=flight.source, destination=flight.destination, departure=flight.departure,
+                arrival=flight.arrival, flight_class=flight.flight_class, number_of_stops=flight.number_of_stops,
+                fare_basis=flight.fare_basis, warning_text=flight.warning_text, ticket_type=flight.ticket_type
+            )
+
+
+def store_result(result, source='', batch_size=None):
+    """
+    Saves the search result in one transaction
+
+    :param result: <class 'SearchResult'> with flights data
+    :param source: <class 'str'> - path or URL the result was received from
+    :param batch_size: <class 'int'> - rows per INSERT or None for the FLIGHTS_STORE_BATCH_SIZE setting
+    :return: <class 'SearchResponse'>
+    """
+    batch_size = batch_size or getattr(settings, 'FLIGHTS_STORE_BATCH_SIZE', 1000)
+    with transaction.atomic():
+        response = SearchResponse.objects.create(
+            source=source, request_id=result.request_id, request_time=result.request_time,
+            response_time=result.response_time, return_tickets=result.return_tickets
+        )
+        PricedItinerary.objects.bulk_create((
+            PricedItinerary(
+                response=response, position=position, source=option.onward.flights[0].source,
+                destination=option.onward.flights[-1].destination, departure=option.onward.departure,
+                departure_date=get_date(option.onward.departure), currency=option.currency,
+                total_amount=option.total_amount, duration=option.duration,
+                stops=option.onward.stops + (option.back.stops if option.back is not None else 0)
+            )
+            for position, option in enumerate(result.options)
+        ), batch_size=batch_size)
+
+        # Primary keys of bulk-created rows are not returned by every database backend
+        ids = dict(PricedItinerary.objects.filter(response=response).values_list('position', 'id'))
+        Segment.objects.bulk_create((
+            segment
+            for position, option in enumerate(result.options) for segment in iter_segments(ids[position], option)
+        ), batch_size=batch_size)
+        ServiceCharge.objects.bulk_create((
+            ServiceCharge(itinerary_id=ids[position], type=charge.type, charge_type=charge.charge_type,
+                          price=charge.price)
+            for position, option in enumerate(result.options) for charge in option.service_charges
+        ), batch_size=batch_size)
+    return response
+
+
+def get_stored_options(source=None, destination=None, date=None, query=None):
+    """
+    Builds the query of stored options
+
+    :param source: <class 'str'> - onward departure airport or None
+    :param destination: <class 'str'> - onward arrival airport or None
+    :param date: <class 'datetime.date'> - onward departure date (UTC) or None
+    :param query: <class 'FlightsQuery'> with filters or None
+    :return: <class 'django.db.models.QuerySet'> of <class 'PricedItinerary'>
+    """
+    options = PricedItinerary.objects.all()
+    if source is not None:
+        options = options.filter(source=source)
+    if destination is not None:
+        options = options.filter(destination=destination)
+    if date is not None:
+        options = options.filter(departure_date=date)
+    if query is None:
+        return options
+
+    if query.max_stops is not None:
+        options = options.filter(stops__lte=query.max_stops)
+    if query.departure_from is not None:
+        options = options.filter(departure__gte=query.departure_from)
+    if query.departure_to is not None:
+        options = options.filter(departure__lte=query.departure_to)
+    if query.max_price is not None:
+        options = options.filter(total_amount__lte=query.max_price)
+    # Subqueries instead of joins: an option with several matching segments is returned once
+    if query.carrier is not None:
+        options = options.filter(id__in=Segment.objects.filter(carrier_id=query.carrier).values('itinerary_id'))
+    if query.via is not None:
+        options = options.filter(
+            id__in=Segment.objects.filter(destination=query.via, is_connection=True).values('itinerary_id')
+        )
+    return options
+
+
+def get_stored_by(key, options, func):
+    """
+    Returns stored options with the minimum or maximum total amount or duration
+
+    :param key: <class 'str'> - 'duration' or 'price'
+    :param options: <class 'django.db.models.QuerySet'> of <class 'PricedItinerary'> (see get_stored_options)
+    :param func: min or max builtin function
+    :return: <class 'django.db.models.QuerySet'> of <class 'PricedItinerary'>
+    """
+    if func not in (max, min):
+        raise TypeError('Parameter func must be only min or max builtin func')
+    field = ORDER_FIELDS[key]
+    value = options.aggregate(value=(Min if func is min else Max)(field))['value']
+    return options.filter(**{field: value}) if value is not None else options.none()
+
+
+def load_options(options):
+    """
+    Loads stored options with their segments and service charges in three queries
+
+    :param options: <class 'django.db.models.QuerySet'> of <class 'PricedItinerary'>
+    :return: list with dictionaries of flight data (see PricedOption.as_dict) with the 'request_id' key
+    """
+    data = []
+    for itinerary in options.select_related('response').prefetch_related('segments', 'service_charges'):
+        flight = itinerary.to_option().as_dict()
+        flight['request_id'] = itinerary.response.request_id
+        data.append(flight)
+    return data
@@ -0,0 +1,213 @@
+"""
+This file contains the summary of a search result: cheapest, most expensive, fastest, longest
+and optimal flights computed in one pass over the options.
+Streamed responses are summarized in one pass over the XML data too (see StreamingSummary).
+"""
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+from ticketsapi.handlers.timing import stage
+
+
+class FlightsSummary:
+    """
+    Ids of the options for every summary metric.
+
+    Extremes keep all options with the extreme value.
+    The optimal flights are the cheapest among flights whose duration is less than or equal to the average
+    (see flights_handler.get_optimal). The average is known only at the end of the pass,
+    so the pass keeps the cheapest options for every distinct duration and the second step
+    walks over distinct durations only.
+    """
+
+    def __init__(self, result):
+        """
+        :param result: <class 'SearchResult'> with flights data
+        """
+        cheapest, most_expensive, fastest, longest = Extreme(min), Extreme(max), Extreme(min), Extreme(max)
+        by_duration = {}
+        total_duration = 0
+
+        for idx, option in enumerate(result.options):
+            price, duration = option.total_amount, option.duration
+            cheapest.add(price, idx)
+            most_expensive.add(price, idx)
+            fastest.add(duration, idx)
+            longest.add(duration, idx)
+            total_duration += duration
+            cheapest_for_duration = by_duration.get(duration)
+            if cheapest_for_duration is None:
+                cheapest_for_duration = by_duration[duration] = Extreme(min)
+            cheapest_for_duration.add(price, idx)
+
+        optimal = Extreme(min)
+        if result.options:
+            average_time = total_duration / len(result.options)
+            for duration, extreme in by_duration.items():
+                if duration <= average_time:
+                    for idx in extreme.ids:
+                        optimal.add(extreme.value, idx)
+
+        self.ids = {
+            'cheapest': cheapest.ids,
+            'most_expensive': most_expensive.ids,
+            'fastest': fastest.ids,
+            'longest': longest.ids,
+            'optimal': sorted(optimal.ids)
+        }
+
+    def get_ids(self, key, func):
+        """
+        :param key: <class 'str'> - 'duration' or 'price'
+        :param func: min or max builtin function
+        :return: list with ids of options with the extreme value
+        """
+        names = {
+            ('price', min): 'cheapest', ('price', max): 'most_expensive',
+            ('duration', min): 'fastest', ('duration', max): 'longest'
+        }
+        return self.ids[names[(key, func)]]
+
+
+class Extreme:
+    """
+    Keeps ids of all options with the minimum or maximum value
+    """
+    __slots__ = ('func', 'value', 'ids')
+
+    def __init__(self, func):
+        """
+        :param func: min or max builtin function
+        """
+        self.func = func
+        self.value = None
+        self.ids = []
+
+    def accepts(self, value):
+        """
+        :return: True if an option with the value would be kept
+        """
+        return self.value is None or value == self.value or self.func(value, self.value) == value
+
+    def add(self, value, idx):
+        if self.value is None or (value != self.value and self.func(value, self.value) == value):
+            self.value, self.ids = value, [idx]
+        elif value == self.value:
+            self.ids.append(idx)
+
+
+class OptimalCandidates:
+    """
+    Finds the optimal flights (see FlightsSummary) in one pass over a streamed response.
+
+    The average duration is known only at the end, so options that can be optimal for any average are kept:
+    the options such that no option with a shorter or equal duration is cheaper.
+    The price and the duration of an itinerary are read before it is parsed (see accepts),
+    so other itineraries are never parsed as a whole.
+    """
+    __slots__ = ('durations', 'prices', 'options', 'count', 'total_duration')
+
+    def __init__(self):
+        # Kept options sorted by duration, their prices do not increase
+        self.durations, self.prices, self.options = [], [], []
+        self.count = 0
+        self.total_duration = 0
+
+    def accepts(self, price, duration):
+        """
+        :param price: <class 'decimal.Decimal'> - total amount of the option
+        :param duration: <class 'int'> - duration of the option, minutes
+        :return: True if the option can be optimal
+        """
+        idx = bisect_right(self.durations, duration)
+        return idx == 0 or self.prices[idx - 1] >= price
+
+    def add(self, price, duration, option):
+        """
+        Counts the option for the average duration and keeps it if it can be optimal
+
+        :param price: <class 'decimal.Decimal'> - total amount of the option
+        :param duration: <class 'int'> - duration of the option, minutes
+        :param option: <class 'PricedOption'> or None if the itinerary was not parsed
+        """
+        self.count += 1
+        self.total_duration += duration
+        if option is None or not self.accepts(price, duration):
+            return
+        # Kept options that are not shorter and more expensive can not be optimal any more
+        start = end = bisect_left(self.durations, duration)
+        while end < len(self.prices) and self.prices[end] > price:
+            end += 1
+        self.durations[start:end] = [duration]
+        self.prices[start:end] = [price]
+        self.options[start:end] = [(self.count, option)]
+
+    def get_options(self):
+        """
+        :return: list with the optimal <class 'PricedOption'> in the order of the response
+        """
+        if not self.count:
+            return []
+        end = bisect_right(self.durations, self.total_duration / self.count)
+        if not end:
+            return []
+        cheapest = self.prices[end - 1]
+        optimal = [item for price, item in zip(self.prices[:end], self.options[:end]) if price == cheapest]
+        return [option for _, option in sorted(optimal, key=itemgetter(0))]
+
+
+class StreamingSummary:
+    """
+    Summary of a streamed response computed in one pass over the XML data (see flights_handler.get_summary_streaming).
+    Itineraries are parsed as a whole only if they can get into the summary (see accepts).
+    """
+    EXTREMES = {
+        'cheapest': ('price', min), 'most_expensive': ('price', max),
+        'fastest': ('duration', min), 'longest': ('duration', max)
+    }
+
+    def __init__(self):
+        self.extremes = {name: Extreme(func) for name, (_, func) in self.EXTREMES.items()}
+        self.optimal = OptimalCandidates()
+
+    def accepts(self, price, duration):
+        """
+        :param price: <class 'decimal.Decimal'> - total amount of the option
+        :param duration: <class 'int'> - duration of the option, minutes
+        :return: True if the option can get into the summary
+        """
+        values = {'price': price, 'duration': duration}
+        return self.optimal.accepts(price, duration) or any(
+            self.extremes[name].accepts(values[key]) for name, (key, _) in self.EXTREMES.items()
+        )
+
+    def add(self, price, duration, option):
+        """
+        :param price: <class 'decimal.Decimal'> - total amount of the option
+        :param duration: <class 'int'> - duration of the option, minutes
+        :param option: <class 'PricedOption'> or None if the itinerary was not parsed
+        """
+        self.optimal.add(price, duration, option)
+        if option is not None:
+            values = {'price': price, 'duration': duration}
+            for name, (key, _) in self.EXTREMES.items():
+                self.extremes[name].add(values[key], option)
+
+    def get_options(self):
+        """
+        :return: dictionary: metric name -> list with <class 'PricedOption'> in the order of the response
+        """
+        options = {name: extreme.ids for name, extreme in self.extremes.items()}
+        options['optimal'] = self.optimal.get_options()
+        return options
+
+
+def get_summary(result):
+    """
+    Returns the summary of the search result, it is computed once per result
+
+    :param result: <class 'SearchResult'> with flights data
+    :return: <class 'FlightsSummary'>
+    """
+    with stage('transform'):
+        return result.get_derived('summary', FlightsSummary)
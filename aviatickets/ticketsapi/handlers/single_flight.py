@@ -0,0 +1,165 @@
+"""
+This file contains coalescing of concurrent identical computations (single flight).
+
+Threads that request the same key while it is being computed wait for the first one and share its result.
+SharedResults does the same for processes of one host: the first process computes the result under
+a file lock and saves it for a short time, the others load it instead of computing it again.
+"""
+import os
+import pickle
+from hashlib import sha1
+from os.path import join
+from threading import Event, Lock
+from time import time
+
+from ticketsapi.handlers.files import write_atomically
+from ticketsapi.handlers.timing import Counter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+coalesced_calls = Counter('flights_coalesced_calls_total', 'Computations shared with a concurrent identical request')
+
+
+class Call:
+    """
+    One in-flight computation
+    """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key across threads of the process
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._futures = {}
+        self._lock = Lock()
+
+    def do(self, key, func):
+        """
+        Runs the function, or waits for the running call with the same key and returns its result
+
+        :param key: hashable key of the computation
+        :param func: function without arguments
+        :return: result of the function
+        :raise: the exception of the function, in every waiting thread
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = Call()
+
+        if not is_leader:
+            coalesced_calls.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def submit(self, key, start):
+        """
+        Starts the call, or returns the future of the running call with the same key.
+        Unlike do, the caller is not blocked, e.g. the future can be awaited on an event loop.
+
+        :param key: hashable key of the computation
+        :param start: function without arguments that starts the call and returns <class 'concurrent.futures.Future'>
+        :return: <class 'concurrent.futures.Future'> shared by all callers, it must not be cancelled by them
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                coalesced_calls.inc()
+                return future
+            future = self._futures[key] = start()
+        future.add_done_callback(lambda _: self.forget(key, future))
+        return future
+
+    def forget(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+
+class SharedResults:
+    """
+    Coalesces calls with the same key across processes of the host:
+    results are pickled to a directory and reused for ttl seconds.
+    Requires fcntl (POSIX), see is_available.
+    """
+
+    def __init__(self, directory, ttl=2.0):
+        """
+        :param directory: <class 'str'> - directory for lock files and results, it must not be writable by others
+        :param ttl: <class 'float'> - how long a saved result is reused, seconds
+        """
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def is_available():
+        return fcntl is not None
+
+    def load(self, path):
+        """
+        :param path: <class 'str'> - path of the saved result
+        :return: the result or None if it does not exist or is older than ttl
+        """
+        try:
+            if time() - os.stat(path).st_mtime > self.ttl:
+                return None
+            with open(path, 'rb') as result_file:
+                return pickle.load(result_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, path, result):
+        """
+        Saves the result atomically, so other processes never read a partial file
+        """
+        write_atomically(path, lambda result_file: pickle.dump(result, result_file, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def do(self, key, func):
+        """
+        Returns the result saved by any process less than ttl seconds ago, or runs the function under the lock
+
+        :param key: <class 'str'> - key of the computation
+        :param func: function without arguments that returns a picklable result
+        :return: result of the function
+        """
+        name = sha1(key.encode()).hexdigest()
+        path = join(self.directory, name + '.pickle')
+        with open(join(self.directory, name + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                result = self.load(path)
+                if result is not None:
+                    coalesced_calls.inc()
+                    return result
+                result = func()
+                self.save(path, result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
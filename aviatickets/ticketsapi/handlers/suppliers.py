@@ -0,0 +1,201 @@
+"""
+This file contains suppliers of flight data: local XML files and external XML servers.
+
+HTTP suppliers share one SupplierClient: an asyncio event loop in a background thread
+with a pooled keep-alive aiohttp session. The response body is fed to the parser chunk by chunk,
+so it is never kept in memory as a whole.
+"""
+import asyncio
+import atexit
+from threading import Lock, Thread
+
+from django.conf import settings
+from lxml import etree
+
+from ticketsapi.handlers.errors import SourceError
+from ticketsapi.handlers.flights_parser import StreamParser
+from ticketsapi.handlers.timing import stage
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+DEFAULT_CLIENT_SETTINGS = {
+    # Total time of one request including reading the body, seconds
+    'TIMEOUT': 30,
+    'CONNECT_TIMEOUT': 5,
+    # Size of the connection pool
+    'MAX_CONNECTIONS': 100,
+    # Maximum number of requests to suppliers in flight at the same time
+    'MAX_CONCURRENCY': 20,
+    # How long idle connections are kept open, seconds
+    'KEEPALIVE_TIMEOUT': 30,
+    'CHUNK_SIZE': 64 * 1024,
+}
+
+
+class SupplierError(SourceError):
+    """
+    The supplier is unavailable or returned a wrong response
+    """
+
+
+def is_url(source):
+    """
+    :param source: <class 'str'> - path to XML file or URL of the supplier
+    :return: True if the source is an HTTP(S) URL
+    """
+    return source.startswith(('http://', 'https://'))
+
+
+class SupplierClient:
+    """
+    Asynchronous HTTP client for XML suppliers.
+
+    The client owns an event loop running in a daemon thread, so it can be used from synchronous views
+    (see fetch) and the connection pool is kept between requests.
+    """
+
+    def __init__(self, **options):
+        """
+        :param options: client settings, see DEFAULT_CLIENT_SETTINGS
+        """
+        if aiohttp is None:
+            raise SupplierError('aiohttp is required to request external suppliers')
+        self.settings = dict(DEFAULT_CLIENT_SETTINGS, **options)
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self.loop.run_forever, name='supplier-client', daemon=True)
+        self._thread.start()
+        self._session = None
+        self._semaphore = None
+
+    async def get_session(self):
+        """
+        Creates the session on the client loop at first use
+
+        :return: <class 'aiohttp.ClientSession'>
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.settings['MAX_CONNECTIONS'], keepalive_timeout=self.settings['KEEPALIVE_TIMEOUT']
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.settings['TIMEOUT'], connect=self.settings['CONNECT_TIMEOUT']
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.settings['MAX_CONCURRENCY'])
+        return self._session
+
+    async def fetch_async(self, url, params=None):
+        """
+        Requests the supplier and parses the response while it is being received.
+        Must be awaited on the client loop (see fetch and submit).
+
+        :param url: <class 'str'> - URL of the supplier
+        :param params: dictionary with query parameters or None
+        :return: <class 'SearchResult'> with flights data
+        :raise SupplierError: if the request failed or timed out
+        :raise ParseError: if the response does not contain required response data
+        """
+        session = await self.get_session()
+        async with self._semaphore:
+            try:
+                async with session.get(url, params=params) as response:
+                    if response.status != 200:
+                        raise SupplierError('Supplier {} returned HTTP {}'.format(url, response.status))
+                    parser = StreamParser(url)
+                    async for chunk in response.content.iter_chunked(self.settings['CHUNK_SIZE']):
+                        parser.feed(chunk)
+                    return parser.close()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                raise SupplierError('Supplier {} is unavailable: {!r}'.format(url, error))
+            except etree.XMLSyntaxError as error:
+                raise SupplierError('Supplier {} returned wrong XML: {}'.format(url, error))
+
+    def submit(self, url, params=None):
+        """
+        Starts the request on the client loop
+
+        :param url: <class 'str'> - URL of the supplier
+        :param params: dictionary with query parameters or None
+        :return: <class 'concurrent.futures.Future'> with <class 'SearchResult'>
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetch_async(url, params), self.loop)
+
+    def fetch(self, url, params=None):
+        """
+        Requests the supplier and waits for the parsed response
+
+        :param url: <class 'str'> - URL of the supplier
+        :param params: dictionary with query parameters or None
+        :return: <class 'SearchResult'> with flights data
+        """
+        return self.submit(url, params).result()
+
+    def close(self):
+        """
+        Closes pooled connections and stops the loop
+        """
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self.loop).result()
+            self._session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+_client = None
+_client_lock = Lock()
+
+
+def get_client():
+    """
+    Returns the process-wide supplier client, it is created at first use
+    from the FLIGHTS_SUPPLIER_CLIENT setting
+
+    :return: <class 'SupplierClient'>
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SupplierClient(**getattr(settings, 'FLIGHTS_SUPPLIER_CLIENT', {}))
+            atexit.register(_client.close)
+        return _client
+
+
+class FileSupplier:
+    """
+    Supplier that reads a local XML file
+    """
+
+    def __init__(self, path, loader):
+        """
+        :param path: <class 'str'> - path where the XML file is located
+        :param loader: function that receives the path and returns <class 'SearchResult'>
+        """
+        self.path = path
+        self.loader = loader
+
+    def fetch(self):
+        return self.loader(self.path)
+
+
+class HttpSupplier:
+    """
+    Supplier that requests an external XML server
+    """
+
+    def __init__(self, url, params=None, client=None):
+        """
+        :param url: <class 'str'> - URL of the supplier
+        :param params: dictionary with query parameters or None
+        :param client: <class 'SupplierClient'> or None for the process-wide client
+        """
+        self.url = url
+        self.params = params
+        self.client = client
+
+    def fetch(self):
+        # The response is received and parsed on the client loop at the same time
+        with stage('fetch'):
+            return (self.client or get_client()).fetch(self.url, self.params)
@@ -0,0 +1,297 @@
+"""
+This file contains per-stage timing of requests: parse, transform, rank and serialize.
+
+Stages are measured only inside a request started by TimingMiddleware (FLIGHTS_TIMING_ENABLED setting).
+Otherwise stage() returns a shared no-op context manager, so instrumented code costs one ContextVar lookup.
+Stage times are exclusive: time of a nested stage is not counted in the enclosing one.
+Jobs submitted with submit_in_context measure their stages in the request too: they run in parallel,
+so their time overlaps the stage that waits for them. Stages of a streamed body are measured while it is sent.
+"""
+from bisect import bisect_left
+from contextvars import ContextVar, copy_context
+from threading import Lock, local
+from time import perf_counter
+
+# Upper bounds of histogram buckets, seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = ContextVar('flights_timings', default=None)
+
+
+class NullStage:
+    """
+    Context manager that does nothing, used when timing is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """
+    Context manager that measures one stage of the current request
+    """
+    __slots__ = ('timings', 'name', 'start', 'children')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        self.timings.stack.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = perf_counter() - self.start
+        self.timings.stack.pop()
+        self.timings.add(self.name, duration - self.children)
+        if self.timings.stack:
+            self.timings.stack[-1].children += duration
+        return False
+
+
+class RequestTimings:
+    """
+    Stage times of one request
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.start = perf_counter()
+        self._local = local()
+        self._lock = Lock()
+
+    @property
+    def stack(self):
+        """
+        :return: <class 'list'> with open stages of the current thread
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def add(self, name, duration):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + duration
+
+    def total(self):
+        return perf_counter() - self.start
+
+
+def stage(name):
+    """
+    Measures a stage of the current request:
+
+        with stage('parse'):
+            ...
+
+    :param name: <class 'str'> - 'parse', 'transform', 'rank', 'serialize', etc.
+    :return: context manager
+    """
+    timings = _current.get()
+    if timings is None:
+        return NULL_STAGE
+    return Stage(timings, name)
+
+
+def iter_stage(name, iterable):
+    """
+    Measures getting of every item of the iterable as a stage of the current request,
+    the time between the items (e.g. of sending a streamed body) is not counted
+
+    :param name: <class 'str'> - name of the stage
+    :param iterable: iterable, e.g. a streaming parser
+    :return: generator with the items
+    """
+    iterator, end = iter(iterable), object()
+    while True:
+        with stage(name):
+            item = next(iterator, end)
+        if item is end:
+            return
+        yield item
+
+
+def start_request():
+    """
+    Starts timing of the request in the current context
+
+    :return: <class 'tuple'> - (<class 'RequestTimings'>, token to pass to finish_request)
+    """
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def finish_request(token):
+    """
+    Stops timing of the request in the current context
+
+    :param token: token returned by start_request
+    """
+    _current.reset(token)
+
+
+def submit_in_context(executor, func, *args):
+    """
+    Submits the function to the executor in a copy of the current context,
+    so its stages are measured in the current request
+
+    :param executor: <class 'concurrent.futures.Executor'>
+    :param func: function to call
+    :param args: arguments of the function
+    :return: <class 'concurrent.futures.Future'>
+    """
+    return executor.submit(copy_context().run, func, *args)
+
+
+def iter_in_request(iterable, timings, on_close):
+    """
+    Iterates the body of a streamed response measuring its stages in the request,
+    the body is produced after the request is finished
+
+    :param iterable: iterable with chunks of the body
+    :param timings: <class 'RequestTimings'> of the request
+    :param on_close: function called when the body is exhausted or closed
+    :return: generator with the chunks
+    """
+    iterator = iter(iterable)
+    try:
+        while True:
+            token = _current.set(timings)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _current.reset(token)
+            yield chunk
+    finally:
+        on_close()
+
+
+def format_server_timing(timings, total):
+    """
+    :param timings: <class 'RequestTimings'>
+    :param total: <class 'float'> - total time of the request, seconds
+    :return: <class 'str'> - value of the Server-Timing header, durations in ms
+    """
+    metrics = ['{};dur={:.3f}'.format(name, duration * 1000) for name, duration in timings.stages.items()]
+    metrics.append('total;dur={:.3f}'.format(total * 1000))
+    return ', '.join(metrics)
+
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus format, one series per label values
+    """
+
+    def __init__(self, name, documentation, label_names, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, label_values, value):
+        """
+        :param label_values: <class 'tuple'> with values of the labels
+        :param value: <class 'float'> - observed value, seconds
+        """
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            idx = bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series['counts'][idx] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def format_labels(self, label_values, extra=''):
+        labels = ['{}="{}"'.format(name, value) for name, value in zip(self.label_names, label_values)]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}'
+
+    def expose(self):
+        """
+        :return: list with lines in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['counts']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, self.format_labels(label_values, 'le="{}"'.format(bound)), cumulative
+                    ))
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, self.format_labels(label_values, 'le="+Inf"'), series['count']
+                ))
+                lines.append('{}_sum{} {}'.format(self.name, self.format_labels(label_values), series['sum']))
+                lines.append('{}_count{} {}'.format(self.name, self.format_labels(label_values), series['count']))
+        return lines
+
+
+class Counter:
+    """
+    Counter in the Prometheus format
+    """
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, value=1):
+        with self._lock:
+            self.value += value
+
+    def expose(self):
+        """
+        :return: list with lines in the Prometheus text format
+        """
+        return expose_value(self.name, self.documentation, 'counter', self.value)
+
+
+stage_histogram = Histogram(
+    'flights_stage_duration_seconds', 'Time spent in request stages', ('method', 'stage')
+)
+
+
+def expose_value(name, documentation, metric_type, value):
+    """
+    :param name: <class 'str'> - name of the metric
+    :param documentation: <class 'str'> - description of the metric
+    :param metric_type: <class 'str'> - 'counter' or 'gauge'
+    :param value: number
+    :return: list with lines in the Prometheus text format
+    """
+    return ['# HELP {} {}'.format(name, documentation), '# TYPE {} {}'.format(name, metric_type),
+            '{} {}'.format(name, value)]
+
+
+def expose_values(name, documentation, metric_type, label_name, values):
+    """
+    :param name: <class 'str'> - name of the metric
+    :param documentation: <class 'str'> - description of the metric
+    :param metric_type: <class 'str'> - 'counter' or 'gauge'
+    :param label_name: <class 'str'> - name of the label
+    :param values: dictionary: label value -> number
+    :return: list with lines in the Prometheus text format
+    """
+    lines = ['# HELP {} {}'.format(name, documentation), '# TYPE {} {}'.format(name, metric_type)]
+    lines += ['{}{{{}="{}"}} {}'.format(name, label_name, label, value) for label, value in sorted(values.items())]
+    return lines
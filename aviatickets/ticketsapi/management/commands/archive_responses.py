@@ -0,0 +1,67 @@
+"""
+Compresses XML responses or writes them to an archive with random access (see handlers.flights_archive).
+
+    $ python manage.py archive_responses 0 1 --compression xz
+    $ python manage.py archive_responses /data/responses --output /data/responses-2018-10-22.xmlar
+
+Without --output every file is compressed next to it (RS_1.xml -> RS_1.xml.xz).
+With --output the files are written to one archive, a response is read from it as
+'/data/responses-2018-10-22.xmlar#RS_1.xml' (the name is the path relative to the common directory of the files).
+Archives among the sources are read member by member, so they can be written to a new archive
+(e.g. with another compression), their members are named 'old.xmlar/RS_1.xml'.
+"""
+import os
+from os.path import commonpath, dirname, getsize, relpath
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ticketsapi.handlers.errors import FlightsError
+from ticketsapi.handlers.flights_archive import (
+    ARCHIVE_SUFFIX, COMPRESSIONS, compress_file, is_available, split_source, write_archive
+)
+from ticketsapi.handlers.flights_ingest import find_files
+
+
+class Command(BaseCommand):
+    help = 'Compresses XML responses or writes them to an archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+', help='Keys of FLIGHTS_SOURCES, paths, directories or glob patterns')
+        parser.add_argument('--output', help='Path of the archive, files are compressed one by one if it is not given')
+        parser.add_argument('--compression', choices=COMPRESSIONS, default='gzip')
+        parser.add_argument('--level', type=int, help='Compression level')
+
+    def handle(self, *args, **options):
+        compression = options['compression']
+        if not is_available(compression):
+            raise CommandError('The zstandard package is required for zstd')
+        paths = find_files([settings.FLIGHTS_SOURCES.get(source, source) for source in options['sources']])
+        if not paths:
+            raise CommandError('No files found')
+
+        start = perf_counter()
+        try:
+            if options['output'] is None:
+                members = [path for path in paths if split_source(path)[1] is not None]
+                if members:
+                    raise CommandError('Archive members can only be written to an archive: {}'.format(members[0]))
+                for path in paths:
+                    compressed_path = compress_file(path, compression, options['level'])
+                    self.stdout.write('{}: {} -> {} bytes'.format(path, getsize(path), getsize(compressed_path)))
+                return
+
+            if not options['output'].endswith(ARCHIVE_SUFFIX):
+                raise CommandError('The archive name must end with {}'.format(ARCHIVE_SUFFIX))
+            # 'old.xmlar#RS_1.xml' is named as if the old archive was a directory
+            names = [path.replace(ARCHIVE_SUFFIX + '#', ARCHIVE_SUFFIX + os.sep) for path in paths]
+            directory = commonpath(names) if len(names) > 1 else dirname(names[0])
+            members = [(relpath(name, directory), path) for name, path in zip(names, paths)]
+            index = write_archive(options['output'], members, compression, options['level'])
+        except (FlightsError, ValueError) as error:
+            raise CommandError(str(error))
+        self.stdout.write('{} responses, {} -> {} bytes written to {} in {:.2f} s'.format(
+            len(index), sum(member[3] for member in index), getsize(options['output']), options['output'],
+            perf_counter() - start
+        ))
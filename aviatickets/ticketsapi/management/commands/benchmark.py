@@ -0,0 +1,75 @@
+"""
+Benchmarks of the parser, the handlers and the flights views on synthetic responses.
+
+    $ python manage.py benchmark --sizes 1000,10000,100000 --output bench.json
+    $ python manage.py benchmark --sizes 1000,10000 --compare bench.json --threshold 0.2
+
+Results are saved as JSON, so runs of different versions can be compared.
+"""
+import json
+import platform
+from datetime import datetime
+from tempfile import TemporaryDirectory
+
+import lxml
+from django.core.management.base import BaseCommand, CommandError
+
+from ticketsapi.benchmarks.runner import compare, run_benchmarks
+from ticketsapi.handlers import flights_columns
+
+
+class Command(BaseCommand):
+    help = 'Runs benchmarks on synthetic AirFareSearchResponse documents and saves results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='1000,10000', help='Comma-separated numbers of priced options, e.g. 1000,1000000'
+        )
+        parser.add_argument('--parts', default='parser,handlers,views', help='Benchmark groups to run')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of every handler benchmark')
+        parser.add_argument('--requests', type=int, default=50, help='Requests of every view benchmark')
+        parser.add_argument('--directory', help='Directory for the generated documents (temporary by default)')
+        parser.add_argument('--output', help='Path of the JSON file with results')
+        parser.add_argument('--label', default='', help='Label of the run, e.g. a version or a commit')
+        parser.add_argument('--compare', help='JSON file with results of a previous run')
+        parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown for --compare')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('Wrong --sizes: {}'.format(options['sizes']))
+        parts = options['parts'].split(',')
+
+        if options['directory']:
+            records = self.run(sizes, options['directory'], parts, options)
+        else:
+            with TemporaryDirectory() as directory:
+                records = self.run(sizes, directory, parts, options)
+
+        run = {
+            'label': options['label'],
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'lxml': lxml.__version__,
+            'numpy': flights_columns.np.__version__ if flights_columns.is_available() else None,
+            'records': records
+        }
+        for record in records:
+            self.stdout.write(' '.join('{}={}'.format(key, value) for key, value in record.items()))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(run, output, indent=2)
+
+        if options['compare']:
+            with open(options['compare']) as previous:
+                regressions = compare(records, json.load(previous)['records'], options['threshold'])
+            for key, name, old, new, ratio in regressions:
+                self.stderr.write('Regression {} {}: {:.6g} -> {:.6g} (x{:.2f})'.format(key, name, old, new, ratio))
+            if regressions:
+                raise CommandError('{} regressions found'.format(len(regressions)))
+
+    def run(self, sizes, directory, parts, options):
+        return run_benchmarks(
+            sizes, directory, options['repeat'], options['requests'], parts, log=self.stdout.write
+        )
@@ -0,0 +1,39 @@
+"""
+Converts XML responses to binary snapshots that are served without parsing (see handlers.flights_snapshot).
+
+    $ python manage.py convert_snapshots 0 1
+    $ python manage.py convert_snapshots /data/responses/RS_1.xml --output-dir /data/snapshots
+
+The snapshot of RS_1.xml is written as RS_1.snapshot; point FLIGHTS_SOURCES to it to serve it.
+"""
+from os.path import basename, dirname, join, splitext
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ticketsapi.handlers.errors import FlightsError
+from ticketsapi.handlers.flights_parser import from_xml_to_result
+from ticketsapi.handlers.flights_snapshot import SUFFIX, write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Parses XML responses and writes them as binary snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+', help='Keys of FLIGHTS_SOURCES or paths of XML files')
+        parser.add_argument('--output-dir', help='Directory for the snapshots (directory of the XML file by default)')
+
+    def handle(self, *args, **options):
+        for source in options['sources']:
+            path = settings.FLIGHTS_SOURCES.get(source, source)
+            snapshot_path = join(options['output_dir'] or dirname(path), splitext(basename(path))[0] + SUFFIX)
+            start = perf_counter()
+            try:
+                result = from_xml_to_result(path)
+            except FlightsError as error:
+                raise CommandError(str(error))
+            write_snapshot(result, snapshot_path)
+            self.stdout.write('{}: {} options written to {} in {:.2f} s'.format(
+                path, len(result.options), snapshot_path, perf_counter() - start
+            ))
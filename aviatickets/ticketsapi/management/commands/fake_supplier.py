@@ -0,0 +1,70 @@
+"""
+Local fake XML supplier: serves the bundled XML files over HTTP with configurable latency.
+
+    $ python manage.py fake_supplier --port 8081 --latency 300 --jitter 100
+
+Files are available by name, e.g. http://127.0.0.1:8081/RS_Via-3.xml
+"""
+import asyncio
+import random
+from os import listdir
+from os.path import isfile, join
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+def create_app(directory, latency=0, jitter=0, chunk_size=64 * 1024):
+    """
+    Creates the fake supplier application
+
+    :param directory: <class 'str'> - directory with XML files
+    :param latency: <class 'int'> - delay before the response, ms
+    :param jitter: <class 'int'> - random addition to the delay from 0 to jitter, ms
+    :param chunk_size: <class 'int'> - size of response body chunks, bytes
+    :return: <class 'aiohttp.web.Application'>
+    """
+    files = {name: join(directory, name) for name in listdir(directory) if isfile(join(directory, name))}
+
+    async def handle(request):
+        path = files.get(request.match_info['name'])
+        if path is None:
+            raise web.HTTPNotFound()
+
+        await asyncio.sleep((latency + random.uniform(0, jitter)) / 1000)
+        response = web.StreamResponse(headers={'Content-Type': 'application/xml'})
+        await response.prepare(request)
+        with open(path, 'rb') as xml_file:
+            for chunk in iter(lambda: xml_file.read(chunk_size), b''):
+                await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/{name}', handle)
+    return app
+
+
+class Command(BaseCommand):
+    help = 'Runs a local fake XML supplier that serves the bundled XML files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=int, default=0, help='Delay before each response, ms')
+        parser.add_argument('--jitter', type=int, default=0, help='Random addition to the delay, ms')
+        parser.add_argument(
+            '--directory', default=join(settings.BASE_DIR, 'ticketsapi', 'xml_files'),
+            help='Directory with XML files to serve'
+        )
+
+    def handle(self, *args, **options):
+        if web is None:
+            raise CommandError('aiohttp is required to run the fake supplier')
+        app = create_app(options['directory'], options['latency'], options['jitter'])
+        web.run_app(app, host=options['host'], port=options['port'], print=self.stdout.write)
@@ -0,0 +1,34 @@
+"""
+Parses archives of XML responses in a process pool and writes normalized results (see handlers.flights_ingest).
+
+    $ python manage.py ingest_flights /data/responses --output /data/ingested
+    $ python manage.py ingest_flights '/data/2018-10-*/*.xml' --output /data/routes --format snapshot --workers 8
+
+Run the same command again to resume an interrupted run: files of completed chunks are skipped.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from ticketsapi.handlers.flights_ingest import FORMATS, ingest
+
+
+class Command(BaseCommand):
+    help = 'Parses directories or glob patterns of XML responses in parallel and writes JSONL or snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('patterns', nargs='+', help='Directories with XML files or glob patterns')
+        parser.add_argument('--output', required=True, help='Directory for the results and the checkpoint')
+        parser.add_argument('--format', default='jsonl', choices=FORMATS, help='Output format')
+        parser.add_argument('--workers', type=int, help='Number of processes (the number of CPUs by default)')
+        parser.add_argument('--chunk-size', type=int, default=16, help='Files parsed by a worker at once')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or (options['workers'] is not None and options['workers'] < 1):
+            raise CommandError('--chunk-size and --workers must be positive')
+        stats = ingest(
+            options['patterns'], options['output'], options['format'], options['workers'], options['chunk_size'],
+            log=self.stdout.write
+        )
+        self.stdout.write('{} files ingested, {} failed, {} options in {:.2f} s ({:.1f} files/s)'.format(
+            stats['files'], stats['failed'], stats['options'], stats['seconds'],
+            stats['files'] / stats['seconds'] if stats['seconds'] else 0
+        ))
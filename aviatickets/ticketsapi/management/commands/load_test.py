@@ -0,0 +1,48 @@
+"""
+Load test of the flights views: concurrent searches to the WSGI and ASGI applications of one process,
+sources are served by the fake supplier with latency (see benchmarks.load).
+
+    $ python manage.py load_test --url /flights.getCheapest --requests 1000 --concurrency 200 --threads 8
+    $ python manage.py load_test --apps asgi --latency 500 --output load.json
+
+The WSGI application processes at most --threads searches at the same time,
+the ASGI application awaits the supplier, so it processes up to --concurrency searches.
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ticketsapi.benchmarks.load import APPLICATIONS, run_load_test
+from ticketsapi.management.commands.fake_supplier import web
+
+
+class Command(BaseCommand):
+    help = 'Sends concurrent searches to the WSGI and ASGI applications and compares them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='/flights.getCheapest', help='Path with the query string')
+        parser.add_argument('--apps', default=','.join(APPLICATIONS), help='Applications to test: wsgi, asgi')
+        parser.add_argument('--requests', type=int, default=500, help='Requests to every application')
+        parser.add_argument('--concurrency', type=int, default=100, help='Requests sent at the same time (ASGI)')
+        parser.add_argument('--threads', type=int, default=8, help='Worker threads of the WSGI application')
+        parser.add_argument('--latency', type=int, default=300, help='Latency of the fake supplier, ms')
+        parser.add_argument('--jitter', type=int, default=0, help='Random addition to the latency, ms')
+        parser.add_argument('--directory', help='Directory with XML files served by the fake supplier')
+        parser.add_argument('--output', help='Path of the JSON file with results')
+
+    def handle(self, *args, **options):
+        if web is None:
+            raise CommandError('aiohttp is required to run the fake supplier')
+        apps = options['apps'].split(',')
+        if any(app not in APPLICATIONS for app in apps):
+            raise CommandError('Wrong --apps: {}'.format(options['apps']))
+
+        records = run_load_test(
+            options['url'], apps, options['requests'], options['concurrency'], options['threads'],
+            options['latency'], options['jitter'], options['directory'], log=self.stdout.write
+        )
+        for record in records:
+            self.stdout.write(' '.join('{}={}'.format(key, value) for key, value in record.items()))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(records, output, indent=2)
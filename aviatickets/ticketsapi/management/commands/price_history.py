@@ -0,0 +1,56 @@
+"""
+Records XML responses or snapshots to the price history and compacts it (see handlers.flights_history).
+FLIGHTS_PRICE_HISTORY['DIRECTORY'] must be set.
+
+    $ python manage.py price_history 0 1
+    $ python manage.py price_history /data/archive --compact
+    $ python manage.py price_history --compact
+
+Directories are searched for XML files recursively. Routes of the recorded responses are compacted
+if --compact is given; without sources --compact compacts all routes.
+"""
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ticketsapi.handlers.errors import FlightsError
+from ticketsapi.handlers.flights_history import get_history
+from ticketsapi.handlers.flights_ingest import find_files
+from ticketsapi.handlers.flights_parser import from_xml_to_result
+from ticketsapi.handlers.flights_snapshot import is_snapshot, open_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Records search responses to the price history and compacts it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='*', help='Keys of FLIGHTS_SOURCES, paths, directories or glob patterns')
+        parser.add_argument('--compact', action='store_true', help='Merge raw points into hourly and daily points')
+
+    def handle(self, *args, **options):
+        history = get_history()
+        if history is None:
+            raise CommandError("FLIGHTS_PRICE_HISTORY['DIRECTORY'] is not set")
+
+        start = perf_counter()
+        patterns = [settings.FLIGHTS_SOURCES.get(source, source) for source in options['sources']]
+        routes = set()
+        for path in find_files(patterns):
+            try:
+                result = open_snapshot(path) if is_snapshot(path) else from_xml_to_result(path)
+            except FlightsError as error:
+                self.stderr.write('{}: {}'.format(path, error))
+                continue
+            routes.update(history.record(result))
+        if options['sources']:
+            self.stdout.write('{} routes recorded in {:.2f} s'.format(len(routes), perf_counter() - start))
+        else:
+            routes = history.get_routes()
+
+        if options['compact']:
+            for route in sorted(routes):
+                counts = history.compact(route)
+                self.stdout.write('{}: {}'.format(route, ', '.join(
+                    '{} {}'.format(count, level) for level, count in counts.items()
+                )))
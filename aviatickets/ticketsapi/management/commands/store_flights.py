@@ -0,0 +1,35 @@
+"""
+Saves XML responses to the database, so they can be queried by the stored.* methods.
+
+    $ python manage.py store_flights 0 1
+    $ python manage.py store_flights /data/responses/RS_1.xml /data/responses/RS_2.xml --batch-size 5000
+"""
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ticketsapi.handlers.errors import FlightsError
+from ticketsapi.handlers.flights_parser import from_xml_to_result
+from ticketsapi.handlers.flights_store import store_result
+
+
+class Command(BaseCommand):
+    help = 'Parses XML responses and saves them to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+', help='Keys of FLIGHTS_SOURCES or paths of XML files')
+        parser.add_argument('--batch-size', type=int, help='Rows per INSERT (FLIGHTS_STORE_BATCH_SIZE by default)')
+
+    def handle(self, *args, **options):
+        for source in options['sources']:
+            path = settings.FLIGHTS_SOURCES.get(source, source)
+            start = perf_counter()
+            try:
+                result = from_xml_to_result(path)
+            except FlightsError as error:
+                raise CommandError(str(error))
+            response = store_result(result, path, options['batch_size'])
+            self.stdout.write('{}: {} options saved as response {} in {:.2f} s'.format(
+                path, len(result.options), response.id, perf_counter() - start
+            ))
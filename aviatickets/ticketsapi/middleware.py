@@ -0,0 +1,107 @@
+"""
+This file contains the middleware that measures request stages (see handlers.timing).
+"""
+import asyncio
+import json
+import logging
+
+from django.conf import settings
+
+from ticketsapi.handlers.timing import (
+    finish_request, format_server_timing, iter_in_request, stage_histogram, start_request
+)
+
+logger = logging.getLogger('ticketsapi.timing')
+
+
+def get_method_label(request):
+    """
+    :param request: <class 'django.http.HttpRequest'>
+    :return: <class 'str'> - name of the view with the method, e.g. 'flights_view.getAll',
+    or 'unmatched' if no view was found (the number of labels must not depend on requested URLs)
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return '.'.join([match.url_name or match.func.__name__] + [str(arg) for arg in match.args])
+
+
+class TimingMiddleware:
+    """
+    Measures stages of every request if the FLIGHTS_TIMING_ENABLED setting is True:
+    adds the Server-Timing header, updates the stage histograms
+    and writes a log line to the 'ticketsapi.timing' logger if FLIGHTS_TIMING_LOG is True.
+    Works in both WSGI and ASGI applications, so async views are not switched to a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks the instance as a coroutine function for Django, the same way as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not getattr(settings, 'FLIGHTS_TIMING_ENABLED', False):
+            return self.get_response(request)
+
+        timings, token = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            finish_request(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        if not getattr(settings, 'FLIGHTS_TIMING_ENABLED', False):
+            return await self.get_response(request)
+
+        timings, token = start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            finish_request(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        """
+        :param request: <class 'django.http.HttpRequest'>
+        :param response: <class 'django.http.HttpResponse'>
+        :param timings: <class 'RequestTimings'> of the request
+        :return: the response with the Server-Timing header
+        """
+        response['Server-Timing'] = format_server_timing(timings, timings.total())
+        if response.streaming:
+            # The header has only the stages before the body, the histograms and the log get the whole request
+            response.streaming_content = iter_in_request(
+                response.streaming_content, timings, lambda: self.record(request, response, timings)
+            )
+        else:
+            self.record(request, response, timings)
+        return response
+
+    def record(self, request, response, timings):
+        """
+        Updates the stage histograms and writes the log line
+
+        :param request: <class 'django.http.HttpRequest'>
+        :param response: <class 'django.http.HttpResponse'>
+        :param timings: <class 'RequestTimings'> of the request
+        """
+        total = timings.total()
+        method = get_method_label(request)
+        for name, duration in timings.stages.items():
+            stage_histogram.observe((method, name), duration)
+        stage_histogram.observe((method, 'total'), total)
+
+        if getattr(settings, 'FLIGHTS_TIMING_LOG', False):
+            logger.info(json.dumps({
+                'method': method,
+                'path': request.path,
+                'status': response.status_code,
+                'stages_ms': {name: round(duration * 1000, 3) for name, duration in timings.stages.items()},
+                'total_ms': round(total * 1000, 3),
+            }))
@@ -0,0 +1,103 @@
+# Generated by Django 2.1.6 on 2026-10-18 19:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticketsapi', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PricedItinerary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('source', models.CharField(max_length=10)),
+                ('destination', models.CharField(max_length=10)),
+                ('departure', models.BigIntegerField()),
+                ('departure_date', models.DateField()),
+                ('currency', models.CharField(max_length=3)),
+                ('total_amount', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('duration', models.PositiveIntegerField()),
+                ('stops', models.PositiveSmallIntegerField()),
+            ],
+            options={
+                'ordering': ('response', 'position'),
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchResponse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=500)),
+                ('request_id', models.CharField(db_index=True, max_length=100)),
+                ('request_time', models.CharField(max_length=50)),
+                ('response_time', models.CharField(max_length=50)),
+                ('return_tickets', models.PositiveSmallIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ServiceCharge',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=50)),
+                ('charge_type', models.CharField(max_length=50)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('itinerary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='service_charges', to='ticketsapi.priceditinerary')),
+            ],
+            options={
+                'ordering': ('itinerary', 'id'),
+            },
+        ),
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_return', models.BooleanField()),
+                ('position', models.PositiveSmallIntegerField()),
+                ('is_connection', models.BooleanField()),
+                ('carrier_id', models.CharField(db_index=True, max_length=10)),
+                ('carrier_name', models.CharField(max_length=200, null=True)),
+                ('flight_number', models.CharField(max_length=10)),
+                ('source', models.CharField(max_length=10)),
+                ('destination', models.CharField(db_index=True, max_length=10)),
+                ('departure', models.BigIntegerField()),
+                ('arrival', models.BigIntegerField()),
+                ('flight_class', models.CharField(max_length=10, null=True)),
+                ('number_of_stops', models.PositiveSmallIntegerField()),
+                ('fare_basis', models.CharField(max_length=50)),
+                ('warning_text', models.CharField(max_length=500, null=True)),
+                ('ticket_type', models.CharField(max_length=10, null=True)),
+                ('itinerary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='ticketsapi.priceditinerary')),
+            ],
+            options={
+                'ordering': ('itinerary', 'is_return', 'position'),
+            },
+        ),
+        migrations.AddField(
+            model_name='priceditinerary',
+            name='response',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='itineraries', to='ticketsapi.searchresponse'),
+        ),
+        migrations.AddIndex(
+            model_name='priceditinerary',
+            index=models.Index(fields=['source', 'destination', 'departure_date'], name='ticketsapi__source_fde443_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='priceditinerary',
+            index=models.Index(fields=['departure'], name='ticketsapi__departu_15e5e6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='priceditinerary',
+            index=models.Index(fields=['total_amount'], name='ticketsapi__total_a_831a29_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='priceditinerary',
+            index=models.Index(fields=['duration'], name='ticketsapi__duratio_b6c8c6_idx'),
+        ),
+    ]
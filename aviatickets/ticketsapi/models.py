@@ -1,5 +1,121 @@
 from django.db import models
 
+from ticketsapi.handlers import flights_model
+
 
 class Method(models.Model):
     url = models.URLField()
+
+
+class SearchResponse(models.Model):
+    """
+    Stored AirFareSearchResponse (see handlers.flights_store)
+    """
+    source = models.CharField(max_length=500)
+    request_id = models.CharField(max_length=100, db_index=True)
+    request_time = models.CharField(max_length=50)
+    response_time = models.CharField(max_length=50)
+    return_tickets = models.PositiveSmallIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class PricedItinerary(models.Model):
+    """
+    One priced option of a stored response.
+    Route, departure, total amount, duration and stops are copied from the segments and the pricing,
+    so queries do not need joins.
+    """
+    response = models.ForeignKey(SearchResponse, on_delete=models.CASCADE, related_name='itineraries')
+    # Position of the option in the response
+    position = models.PositiveIntegerField()
+    source = models.CharField(max_length=10)
+    destination = models.CharField(max_length=10)
+    # Onward departure in minutes since the epoch and its date (UTC)
+    departure = models.BigIntegerField()
+    departure_date = models.DateField()
+    currency = models.CharField(max_length=3)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2)
+    # Onward and return itineraries together, minutes
+    duration = models.PositiveIntegerField()
+    stops = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ('response', 'position')
+        indexes = [
+            models.Index(fields=['source', 'destination', 'departure_date']),
+            models.Index(fields=['departure']),
+            models.Index(fields=['total_amount']),
+            models.Index(fields=['duration']),
+        ]
+
+    def to_option(self):
+        """
+        Builds the in-memory option, segments and service charges must be prefetched
+        (see flights_store.load_options)
+
+        :return: <class 'flights_model.PricedOption'>
+        """
+        onward, back = [], []
+        for segment in self.segments.all():
+            (back if segment.is_return else onward).append(segment.to_flight())
+        return flights_model.PricedOption(
+            flights_model.Itinerary(tuple(onward)),
+            flights_model.Itinerary(tuple(back)) if back else None,
+            self.currency,
+            tuple(charge.to_charge() for charge in self.service_charges.all())
+        )
+
+
+class Segment(models.Model):
+    """
+    One flight segment of a stored option
+    """
+    itinerary = models.ForeignKey(PricedItinerary, on_delete=models.CASCADE, related_name='segments')
+    is_return = models.BooleanField()
+    position = models.PositiveSmallIntegerField()
+    # True if the passenger changes flights at the destination (see flights_index.get_via_airports)
+    is_connection = models.BooleanField()
+    carrier_id = models.CharField(max_length=10, db_index=True)
+    carrier_name = models.CharField(max_length=200, null=True)
+    flight_number = models.CharField(max_length=10)
+    source = models.CharField(max_length=10)
+    destination = models.CharField(max_length=10, db_index=True)
+    departure = models.BigIntegerField()
+    arrival = models.BigIntegerField()
+    flight_class = models.CharField(max_length=10, null=True)
+    number_of_stops = models.PositiveSmallIntegerField()
+    fare_basis = models.CharField(max_length=50)
+    warning_text = models.CharField(max_length=500, null=True)
+    ticket_type = models.CharField(max_length=10, null=True)
+
+    class Meta:
+        ordering = ('itinerary', 'is_return', 'position')
+
+    def to_flight(self):
+        """
+        :return: <class 'flights_model.Flight'>
+        """
+        return flights_model.Flight(
+            self.carrier_id, self.carrier_name, self.flight_number, self.source, self.destination,
+            self.departure, self.arrival, self.flight_class, self.number_of_stops, self.fare_basis,
+            self.warning_text, self.ticket_type
+        )
+
+
+class ServiceCharge(models.Model):
+    """
+    One service charge of a stored option
+    """
+    itinerary = models.ForeignKey(PricedItinerary, on_delete=models.CASCADE, related_name='service_charges')
+    type = models.CharField(max_length=50)
+    charge_type = models.CharField(max_length=50)
+    price = models.DecimalField(max_digits=14, decimal_places=2)
+
+    class Meta:
+        ordering = ('itinerary', 'id')
+
+    def to_charge(self):
+        """
+        :return: <class 'flights_model.ServiceCharge'>
+        """
+        return flights_model.ServiceCharge(self.type, self.charge_type, self.price)
@@ -1,3 +1,1194 @@
-from django.test import TestCase
+"""
+This file contains the tests of the flights API and its handlers.
 
-# Create your tests here.
+    $ python manage.py test ticketsapi
+"""
+import gzip
+import json
+import lzma
+import os
+import shutil
+from concurrent.futures import Future
+from decimal import Decimal
+from os.path import basename, join
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import sleep
+from unittest import skipUnless
+from unittest.mock import patch
+from urllib.parse import quote, urlencode
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, override_settings
+
+from ticketsapi.handlers import flights_columns
+from ticketsapi.handlers.errors import ParseError, SourceError
+from ticketsapi.handlers.files import write_atomically
+from ticketsapi.handlers.flights_archive import (
+    COMPRESSIONS, compress_file, get_index, get_source_size, is_available, write_archive
+)
+from ticketsapi.handlers.flights_cache import FlightsCache
+from ticketsapi.handlers.flights_diff import get_chain_index, iter_difference_json
+from ticketsapi.handlers.flights_fanout import failed_sources
+from ticketsapi.handlers.flights_handler import (
+    flights_cache, get_by_streaming, get_method_data, get_optimal_streaming, get_summary_data, get_summary_streaming,
+    is_streamed
+)
+from ticketsapi.handlers.flights_history import (
+    LEVELS, RECORD_SIZE, PriceHistory, get_chain_name, get_history, get_search_points
+)
+from ticketsapi.handlers.flights_ingest import CHECKPOINT, get_route, ingest
+from ticketsapi.handlers.flights_model import Flight, PricedOption, ServiceCharge, format_timestamp, parse_timestamp
+from ticketsapi.handlers.flights_parser import (
+    from_xml_to_dict, from_xml_to_result, iter_priced_itineraries, skipped_itineraries
+)
+from ticketsapi.handlers.flights_ranking import get_pareto_frontier, get_scores, get_top
+from ticketsapi.handlers.flights_refresh import SnapshotRefresher
+from ticketsapi.handlers.flights_renderer import brotli, dumps
+from ticketsapi.handlers.flights_routes import Timetable
+from ticketsapi.handlers.flights_snapshot import open_snapshot, write_snapshot
+from ticketsapi.handlers.flights_store import store_result
+from ticketsapi.handlers.single_flight import SharedResults, SingleFlight, coalesced_calls
+from ticketsapi.views import flights_async_view, flights_difference_async_view
+
+# Method -> (key, func) of get_by
+METHODS = {
+    'getCheapest': ('price', min), 'getMostExpensive': ('price', max),
+    'getFastest': ('duration', min), 'getLongest': ('duration', max),
+}
+# Key of the getSummary response -> method
+SUMMARY_KEYS = {
+    'cheapest': 'getCheapest', 'most_expensive': 'getMostExpensive', 'fastest': 'getFastest',
+    'longest': 'getLongest', 'optimal': 'getOptimal'
+}
+
+
+def get_json(response):
+    """
+    :param response: response of the test client, streamed responses are read as a whole
+    :return: decoded JSON body
+    """
+    body = b''.join(response.streaming_content) if response.streaming else response.content
+    return json.loads(body)
+
+
+def get_baseline_flights(url, data):
+    """
+    Computes the method response from the parsed dictionaries like the first version of the handlers did
+
+    :param url: <class 'str'> - method, e.g. 'getCheapest'
+    :param data: dictionary with flights data (see flights_parser.from_xml_to_dict)
+    :return: list with flights of the response
+    """
+    def get_duration(itinerary):
+        return parse_timestamp(itinerary[-1]['arrival_time']) - parse_timestamp(itinerary[0]['departure_time'])
+
+    flights = data['flights']
+    values = {
+        'price': [
+            sum(Decimal(charge['price']) for charge in flight['pricing']['service_charges']
+                if charge['charge_type'] == 'TotalAmount')
+            for flight in flights
+        ],
+        'duration': [
+            get_duration(flight['onward_itinerary']) +
+            (get_duration(flight['return_itinerary']) if 'return_itinerary' in flight else 0)
+            for flight in flights
+        ],
+    }
+    if url == 'getOptimal':
+        average_time = sum(values['duration']) / len(flights)
+        ids = [idx for idx, duration in enumerate(values['duration']) if duration <= average_time]
+        cheapest = min(values['price'][idx] for idx in ids)
+        return [flights[idx] for idx in ids if values['price'][idx] == cheapest]
+    key, func = METHODS[url]
+    extreme = func(values[key])
+    return [flight for flight, value in zip(flights, values[key]) if value == extreme]
+
+
+def make_flight(flight_number, source, destination, departure, arrival):
+    """
+    :return: <class 'Flight'> of the test timetable
+    """
+    return Flight(
+        'XX', 'Test Air', flight_number, source, destination, parse_timestamp(departure), parse_timestamp(arrival),
+        'Y', 0, 'Y', None, 'E'
+    )
+
+
+class ParamsTests(TestCase):
+    """
+    Wrong request parameters are rejected with 400
+    """
+
+    def assert_bad_request(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400, url)
+        self.assertEqual(get_json(response), {'error': 'Bad Request (400)'})
+
+    def test_non_finite_max_price(self):
+        for value in ('NaN', 'nan', 'sNaN', 'Infinity', '-Infinity', 'inf'):
+            self.assert_bad_request('/flights.getAll?max_price={}'.format(value))
+            self.assert_bad_request('/stored.getAll?max_price={}'.format(value))
+
+    def test_wrong_deadline(self):
+        for value in ('inf', '-inf', 'nan', '-1', 'x'):
+            self.assert_bad_request('/flights.getAll?sources=0,1&deadline={}'.format(value))
+
+    def test_non_finite_weights(self):
+        for criterion in ('price', 'duration', 'stops'):
+            for value in ('nan', 'inf', '-inf', 'Infinity'):
+                self.assert_bad_request('/flights.getTop?{}={}'.format(criterion, value))
+
+    def test_unknown_fields(self):
+        self.assert_bad_request('/flights.getAll?fields=carrier_id,price')
+
+    def test_unknown_engine(self):
+        self.assert_bad_request('/flights.getCheapest?engine=fortran')
+
+    def test_unknown_sources(self):
+        self.assert_bad_request('/flights.getAll?sources=0,9')
+
+    def test_wrong_route_params(self):
+        url = '/routes.getEarliestArrival?source=DXB&destination=BKK'
+        self.assert_bad_request(url)
+        self.assert_bad_request(url + '&departure_from=2018-10-22T0000&max_layover=10')
+        self.assert_bad_request(url + '&departure_from=2018-10-22T0000&max_legs=0')
+
+    @override_settings(FLIGHTS_FANOUT_MAX_DEADLINE=0.5)
+    def test_deadline_is_capped(self):
+        response = self.client.get('/flights.getAll?sources=0,1&deadline=100000000000')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_json(response)['response']['sources'], {'0': 'ok', '1': 'ok'})
+
+
+class FieldsTests(TestCase):
+    """
+    Segments of flights contain only the requested fields, the rest of the response is not changed
+    """
+
+    def assert_projected(self, projected, full, fields):
+        """
+        :param projected: list with flights of the response with the 'fields' parameter
+        :param full: list with flights of the same response without it
+        :param fields: list with the requested fields in the response order
+        """
+        self.assertEqual(len(projected), len(full))
+        for flight, expected in zip(projected, full):
+            for name in ('onward_itinerary', 'return_itinerary'):
+                self.assertEqual(name in flight, name in expected)
+                if name in flight:
+                    segments = [{field: segment[field] for field in fields} for segment in expected.pop(name)]
+                    self.assertEqual(flight.pop(name), segments)
+            self.assertEqual(flight, expected)
+
+    def test_fields(self):
+        # Fields are returned in the order of the segment data, not of the parameter
+        fields = ['carrier_id', 'departure_time', 'arrival_time']
+        paths = ['/flights.{}?return=1'.format(url) for url in ('getAll', 'getCheapest', 'getOptimal', 'getSummary')]
+        paths.append('/flights.getAll?sources=0,1')
+        for streaming_min_size in (0, 2 ** 40):
+            with override_settings(FLIGHTS_STREAMING_MIN_SIZE=streaming_min_size):
+                for path in paths:
+                    full = get_json(self.client.get(path))['response']
+                    projected = get_json(self.client.get(path + '&fields=arrival_time,carrier_id,departure_time'))
+                    projected = projected['response']
+                    for key in ('flights',) + tuple(SUMMARY_KEYS):
+                        if key in full:
+                            self.assertEqual(list(projected[key][0]['onward_itinerary'][0]), fields, (path, key))
+                            self.assert_projected(projected.pop(key), full.pop(key), fields)
+                    self.assertEqual(projected, full, path)
+
+
+class EnginesTests(TestCase):
+    """
+    The python, numpy and streaming engines return the same flights as the first version of the handlers
+    """
+
+    def test_handlers(self):
+        engines = ('python', 'numpy') if flights_columns.is_available() else ('python',)
+        for path in settings.FLIGHTS_SOURCES.values():
+            data = from_xml_to_dict(path)
+            result = from_xml_to_result(path)
+            self.assertEqual([option.as_dict() for option in result.options], data['flights'])
+
+            for url in SUMMARY_KEYS.values():
+                expected = get_baseline_flights(url, data)
+                for engine in engines:
+                    self.assertEqual(get_method_data(url, result, engine)['flights'], expected, (path, url, engine))
+                if url == 'getOptimal':
+                    streamed = get_optimal_streaming(path)
+                else:
+                    streamed = get_by_streaming(METHODS[url][0], path, METHODS[url][1])
+                self.assertEqual([option.as_dict() for option in streamed.options], expected, (path, url))
+
+            summary = get_summary_streaming(path)
+            self.assertEqual(summary, get_summary_data(result))
+            for key, url in SUMMARY_KEYS.items():
+                self.assertEqual(summary[key], get_baseline_flights(url, data), (path, key))
+
+    def test_streamed_views(self):
+        urls = ['/flights.getAll', '/flights.getAll?max_stops=1&limit=5'] + [
+            '/flights.{}?return={}'.format(url, return_flights)
+            for url in list(SUMMARY_KEYS.values()) + ['getSummary'] for return_flights in settings.FLIGHTS_SOURCES
+        ]
+        for url in urls:
+            response = get_json(self.client.get(url))
+            with override_settings(FLIGHTS_STREAMING_MIN_SIZE=0):
+                self.assertEqual(get_json(self.client.get(url)), response, url)
+
+
+class FanoutTests(TestCase):
+    """
+    Sources are merged, failed sources are skipped, logged and counted
+    """
+
+    def test_failed_source(self):
+        sources = dict(settings.FLIGHTS_SOURCES, missing='/nonexistent/RS.xml')
+        failed = failed_sources.value
+        with override_settings(FLIGHTS_SOURCES=sources):
+            with self.assertLogs('ticketsapi.handlers.flights_fanout', 'WARNING') as logs:
+                response = get_json(self.client.get('/flights.getAll?sources=0,missing'))['response']
+        self.assertEqual(response['sources'], {'0': 'ok', 'missing': 'failed'})
+        self.assertEqual(len(response['flights']), len(from_xml_to_dict(settings.FLIGHTS_SOURCES['0'])['flights']))
+        self.assertEqual(failed_sources.value, failed + 1)
+        self.assertIsNotNone(logs.records[0].exc_info)
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('flights_failed_sources_total {}'.format(failed + 1), metrics)
+
+
+class AsyncViewsTests(SimpleTestCase):
+    """
+    Async views used by the ASGI application return the same responses as the sync views
+    """
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+
+    def get_async(self, view, path, *args):
+        """
+        :param view: async view function
+        :param path: <class 'str'> - path with the query string
+        :return: <class 'django.http.HttpResponse'>
+        """
+        return async_to_sync(view)(self.factory.get(path), *args)
+
+    def assert_same_response(self, view, path, *args):
+        response = self.get_async(view, path, *args)
+        expected = self.client.get(path)
+        self.assertEqual(response.status_code, expected.status_code, path)
+        self.assertEqual(get_json(response), get_json(expected), path)
+        return response
+
+    def test_flights(self):
+        for url in list(METHODS) + ['getOptimal', 'getSummary', 'getAll']:
+            for query in ('return=0', 'return=1&fields=carrier_id,departure_time', 'return=2'):
+                self.assert_same_response(flights_async_view, '/flights.{}?{}'.format(url, query), url)
+        self.assert_same_response(flights_async_view, '/flights.getAll?return=1&max_stops=0&limit=5', 'getAll')
+
+        response = self.get_async(flights_async_view, '/flights.getAll?sources=0,1', 'getAll')
+        expected = get_json(self.client.get('/flights.getAll?sources=0,1'))['response']
+        self.assertEqual(get_json(response)['response']['flights'], expected['flights'])
+
+        response = async_to_sync(flights_async_view)(self.factory.post('/flights.getAll'), 'getAll')
+        self.assertEqual(response.status_code, 405)
+
+    @override_settings(FLIGHTS_STREAMING_MIN_SIZE=0)
+    def test_streamed_flights(self):
+        for url in ('getAll', 'getCheapest', 'getSummary'):
+            response = self.assert_same_response(flights_async_view, '/flights.{}'.format(url), url)
+            # Only the body of 'getAll' is written while the file is parsed
+            self.assertEqual(response.streaming, url == 'getAll', url)
+
+    def test_difference(self):
+        for query in ('', '?first=1&second=0', '?first=0&second=1&mode=full', '?mode=short'):
+            self.assert_same_response(flights_difference_async_view, '/flights.getDifference' + query)
+
+
+class ErrorsTests(TestCase):
+    """
+    Itineraries with wrong data are skipped and counted, fatal errors are turned into responses with their status
+    """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        with open(settings.FLIGHTS_SOURCES['0'], encoding='utf-8') as xml_file:
+            self.data = xml_file.read()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_file(self, name, data):
+        path = join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(data)
+        return path
+
+    def test_skipped_itineraries(self):
+        expected = from_xml_to_result(settings.FLIGHTS_SOURCES['0']).options
+        path = self.write_file('RS.xml', self.data.replace(
+            '<DepartureTimeStamp>2018-10-27T0005', '<DepartureTimeStamp>27.10.2018 00:05', 1
+        ))
+        skipped = skipped_itineraries.value
+        with self.assertLogs('ticketsapi.handlers.flights_parser', 'WARNING'):
+            result = from_xml_to_result(path)
+        self.assertEqual(skipped_itineraries.value, skipped + 1)
+        self.assertEqual([option.as_dict() for option in result.options], [option.as_dict() for option in expected[1:]])
+        with self.assertLogs('ticketsapi.handlers.flights_parser', 'WARNING'):
+            options = list(iter_priced_itineraries(path, convert=PricedOption.from_dict))
+        self.assertEqual(len(options), len(expected) - 1)
+        self.assertEqual(skipped_itineraries.value, skipped + 2)
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('flights_skipped_itineraries_total {}'.format(skipped + 2), metrics)
+
+    def test_error_statuses(self):
+        snapshot = join(self.directory.name, 'empty.snapshot')
+        open(snapshot, 'wb').close()
+        sources = {
+            '0': join(self.directory.name, 'missing.xml'),
+            '1': self.write_file('truncated.xml', self.data[:len(self.data) // 2]),
+            '2': self.write_file('no_request_id.xml', self.data.replace('<RequestId>123ABCD</RequestId>', '')),
+            '3': snapshot,
+        }
+        statuses = {'0': 502, '1': 422, '2': 422, '3': 422}
+        errors = {502: 'Bad Gateway (502)', 422: 'Unprocessable Entity (422)'}
+        with override_settings(FLIGHTS_SOURCES=sources), self.assertLogs('ticketsapi.views', 'WARNING'):
+            for name, status_code in statuses.items():
+                for engine in ('python', 'numpy'):
+                    for streaming_min_size in (0, 2 ** 40):
+                        with override_settings(FLIGHTS_STREAMING_MIN_SIZE=streaming_min_size):
+                            response = self.client.get('/flights.getCheapest?return={}&engine={}'.format(name, engine))
+                        self.assertEqual(response.status_code, status_code, (name, engine, streaming_min_size))
+                        self.assertEqual(get_json(response), {'error': errors[status_code]})
+
+
+class RenderingTests(TestCase):
+    """
+    Responses are served with ETag and in the best encoding accepted by the client
+    """
+
+    def test_etag(self):
+        url = '/flights.getCheapest'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+        for if_none_match in (etag, '"other", {}'.format(etag), '*'):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual((response.status_code, response.content, response['ETag']), (304, b'', etag))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        # Other data has another ETag
+        self.assertNotEqual(self.client.get(url + '?return=0')['ETag'], etag)
+
+    def test_encodings(self):
+        url = '/flights.getAll'
+        response = self.client.get(url)
+        body, etag = response.content, response['ETag']
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        decompressors = {'gzip': gzip.decompress}
+        if brotli is not None:
+            decompressors['br'] = brotli.decompress
+        accepted = {'gzip': 'gzip', 'gzip;q=1.0, identity': 'gzip', 'deflate': None, 'identity': None}
+        if brotli is not None:
+            accepted.update({'br': 'br', 'gzip, br': 'br'})
+        for accept_encoding, encoding in accepted.items():
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertEqual(response.get('Content-Encoding'), encoding, accept_encoding)
+            content = response.content if encoding is None else decompressors[encoding](response.content)
+            self.assertEqual((content, response['ETag']), (body, etag))
+
+        with override_settings(FLIGHTS_PRECOMPRESS=('gzip',)):
+            self.assertEqual(self.client.get(url, HTTP_ACCEPT_ENCODING='br, gzip')['Content-Encoding'], 'gzip')
+        with override_settings(FLIGHTS_PRECOMPRESS=()):
+            self.assertFalse(self.client.get(url, HTTP_ACCEPT_ENCODING='br, gzip').has_header('Content-Encoding'))
+
+    def test_serializers(self):
+        data = {'response': from_xml_to_dict(settings.FLIGHTS_SOURCES['1'])}
+        for serializer in ('auto', 'orjson', 'json'):
+            with override_settings(FLIGHTS_JSON_SERIALIZER=serializer):
+                self.assertEqual(json.loads(dumps(data)), data, serializer)
+
+
+class RankingTests(TestCase):
+    """
+    Both engines return the same best options, ties are broken by the order of the options
+    """
+
+    def test_ties(self):
+        result = from_xml_to_result(settings.FLIGHTS_SOURCES['1'])
+        count = len(result.options)
+        for weights in ({'stops': 1}, {'price': 1, 'stops': 1}, {'price': 1, 'duration': 1}, {}):
+            scores = get_scores(result, weights)
+            ordered = sorted(range(count), key=lambda idx: (scores[idx], idx))
+            for k in (0, 1, 2, 5, count - 1, count, count + 1):
+                expected = [result.options[idx] for idx in ordered[:k]]
+                engines = ('python', 'numpy') if flights_columns.is_available() else ('python',)
+                for engine in engines:
+                    self.assertEqual(list(get_top(result, k, weights, engine).options), expected, (weights, k, engine))
+
+    def test_top_view(self):
+        result = from_xml_to_result(settings.FLIGHTS_SOURCES['1'])
+        weights = {'price': 2, 'duration': 1, 'stops': 1}
+        top = get_top(result, 5, weights)
+        response = get_json(self.client.get('/flights.getTop?k=5&price=2&duration=1&stops=1'))['response']
+        self.assertEqual(response, top.as_dict())
+        # The best scores are returned from the best
+        scores = get_scores(result, weights)
+        self.assertEqual([scores[result.options.index(option)] for option in top.options], sorted(scores)[:5])
+
+        # Every option of the frontier is not dominated by another option
+        frontier = get_pareto_frontier(result).options
+        for option in frontier:
+            self.assertFalse(any(
+                other.total_amount <= option.total_amount and other.duration <= option.duration and
+                (other.total_amount, other.duration) != (option.total_amount, option.duration)
+                for other in result.options
+            ))
+        response = get_json(self.client.get('/flights.getTop?k=1000&pareto=1&duration=0'))['response']
+        self.assertEqual(response['flights'], [option.as_dict() for option in frontier])
+
+
+class DifferenceTests(TestCase):
+    """
+    The full difference matches options by their segment chains
+    """
+
+    @staticmethod
+    def reprice(option, delta):
+        """
+        :return: <class 'PricedOption'> with the same segments and the total amount changed by delta
+        """
+        charges = tuple(ServiceCharge(charge.type, charge.charge_type, charge.price + delta)
+                        for charge in option.service_charges)
+        return PricedOption(option.onward, option.back, option.currency, charges)
+
+    def test_changes(self):
+        result = from_xml_to_result(settings.FLIGHTS_SOURCES['0'])
+        options = list(get_chain_index(result).values())
+        first = result.replace(options[:-1])
+        # Only the cheapest of the options with the same chain is compared
+        second = result.replace([self.reprice(options[0], 1)] + options[2:] + [self.reprice(options[2], 100)])
+
+        response = json.loads(b''.join(iter_difference_json(first, second)))['response']
+        self.assertEqual(response['counts'], {
+            'added': 1, 'removed': 1, 'repriced': 1, 'unchanged': len(options) - 3
+        })
+        self.assertEqual([change['change'] for change in response['changes']], ['repriced', 'added', 'removed'])
+        repriced, added, removed = response['changes']
+        option = self.reprice(options[0], 1)
+        self.assertEqual(repriced['flight'], option.as_dict())
+        self.assertEqual(
+            (repriced['previous_total_amount'], repriced['total_amount']),
+            (str(options[0].total_amount), str(option.total_amount))
+        )
+        self.assertEqual(added['flight'], options[-1].as_dict())
+        self.assertNotIn('previous_total_amount', added)
+        self.assertEqual(removed['flight'], options[1].as_dict())
+        self.assertNotIn('total_amount', removed)
+
+    def test_full_mode(self):
+        chains = {name: len(get_chain_index(from_xml_to_result(source)))
+                  for name, source in settings.FLIGHTS_SOURCES.items()}
+        response = get_json(self.client.get('/flights.getDifference?first=0&second=0&mode=full'))['response']
+        self.assertEqual(response, {'changes': [], 'counts': {
+            'added': 0, 'removed': 0, 'repriced': 0, 'unchanged': chains['0']
+        }})
+        response = get_json(self.client.get('/flights.getDifference?first=0&second=1&mode=full'))['response']
+        self.assertEqual(response['counts'], {
+            'added': chains['1'], 'removed': chains['0'], 'repriced': 0, 'unchanged': 0
+        })
+        self.assertEqual(len(response['changes']), chains['0'] + chains['1'])
+        self.assertEqual(self.client.get('/flights.getDifference?mode=short').status_code, 400)
+
+
+@override_settings(FLIGHTS_TIMING_ENABLED=True, FLIGHTS_TIMING_LOG=True)
+class TimingTests(TestCase):
+    """
+    Stages of pool threads and of streamed bodies are measured in the request
+    """
+
+    def setUp(self):
+        flights_cache.clear()
+
+    def get_stages(self, url):
+        with self.assertLogs('ticketsapi.timing', 'INFO') as logs:
+            response = self.client.get(url)
+            get_json(response)
+            response.close()
+        return response.get('Server-Timing', ''), json.loads(logs.records[-1].getMessage())['stages_ms']
+
+    def test_pool_stages(self):
+        header, stages = self.get_stages('/flights.getAll?sources=0,1')
+        self.assertIn('parse;dur=', header)
+        self.assertIn('parse', stages)
+
+    @override_settings(FLIGHTS_STREAMING_MIN_SIZE=0)
+    def test_streamed_stages(self):
+        header, stages = self.get_stages('/flights.getAll')
+        # The body is parsed after the headers are sent
+        self.assertNotIn('parse;dur=', header)
+        self.assertIn('parse', stages)
+
+
+class CacheTests(SimpleTestCase):
+    """
+    Parsed files are kept until they change or are evicted by the least recently used order
+    """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.parsed = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def parse(self, path):
+        self.parsed.append(basename(path))
+        return from_xml_to_result(path)
+
+    def write_file(self, name, data):
+        path = join(self.directory.name, name)
+        with open(path, 'wb') as output:
+            output.write(data)
+        return path
+
+    def test_lru(self):
+        with open(settings.FLIGHTS_SOURCES['0'], 'rb') as xml_file:
+            data = xml_file.read()
+        paths = {name: self.write_file(name, data) for name in ('a.xml', 'b.xml', 'c.xml')}
+        cache = FlightsCache(max_size=2)
+        results = [cache.get_or_parse(paths[name], self.parse) for name in ('a.xml', 'b.xml', 'a.xml', 'c.xml')]
+        self.assertIs(results[0], results[2])
+        # b.xml was used least recently
+        cache.get_or_parse(paths['a.xml'], self.parse)
+        cache.get_or_parse(paths['b.xml'], self.parse)
+        self.assertEqual(self.parsed, ['a.xml', 'b.xml', 'c.xml', 'b.xml'])
+        self.assertEqual(cache.stats(), {'size': 2, 'max_size': 2, 'hits': 2, 'misses': 4})
+        cache.clear()
+        self.assertEqual(cache.stats(), {'size': 0, 'max_size': 2, 'hits': 0, 'misses': 0})
+
+    def test_changed_file(self):
+        with open(settings.FLIGHTS_SOURCES['0'], 'rb') as xml_file:
+            data = xml_file.read()
+        path = self.write_file('RS.xml', data)
+        cache = FlightsCache()
+        first = cache.get_or_parse(path, self.parse)
+        self.assertIs(cache.get_or_parse(path, self.parse), first)
+
+        # The same size with a new mtime
+        file_stat = os.stat(path)
+        os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+        second = cache.get_or_parse(path, self.parse)
+        self.assertIsNot(second, first)
+
+        # A new size with the same mtime
+        file_stat = os.stat(path)
+        self.write_file('RS.xml', data.replace(b'<RequestId>123ABCD</RequestId>', b'<RequestId>123ABCDE</RequestId>'))
+        os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        third = cache.get_or_parse(path, self.parse)
+        self.assertEqual((third.request_id, second.request_id), ('123ABCDE', '123ABCD'))
+        self.assertIs(cache.get_or_parse(path, self.parse), third)
+        # Older versions of the file are dropped
+        self.assertEqual(cache.stats(), {'size': 1, 'max_size': 8, 'hits': 2, 'misses': 3})
+
+        # Missing files are not cached
+        with self.assertRaises(SourceError):
+            cache.get_or_parse(join(self.directory.name, 'missing.xml'), self.parse)
+        self.assertEqual((len(self.parsed), cache.stats()['size']), (4, 1))
+
+
+class RefreshTests(SimpleTestCase):
+    """
+    Stale snapshots are served while they are refreshed in background, too old ones are not served
+    """
+
+    def setUp(self):
+        self.now = 0.0
+        self.fetched = []
+        # Values returned or raised by the next fetches
+        self.values = []
+        self.allowed = Event()
+        self.allowed.set()
+        self.refresher = SnapshotRefresher(self.fetch, interval=60, max_staleness=600, workers=1)
+        self.addCleanup(self.refresher.stop)
+        patcher = patch('ticketsapi.handlers.flights_refresh.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, source):
+        self.allowed.wait()
+        self.fetched.append(source)
+        value = self.values.pop(0)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def wait_refreshed(self):
+        # The only worker runs the submitted refreshes in order
+        self.refresher._executor.submit(lambda: None).result()
+
+    def test_stale_while_refresh(self):
+        self.values = ['first', 'second']
+        self.assertEqual(self.refresher.get('RS.xml'), 'first')
+        self.now = 59.0
+        self.assertEqual(self.refresher.get('RS.xml'), 'first')
+        self.assertEqual(self.fetched, ['RS.xml'])
+
+        # The stale snapshot is served at once and refreshed by one background fetch
+        self.now = 100.0
+        self.allowed.clear()
+        self.assertEqual([self.refresher.get('RS.xml') for _ in range(3)], ['first'] * 3)
+        self.allowed.set()
+        self.wait_refreshed()
+        self.assertEqual(self.fetched, ['RS.xml'] * 2)
+        self.assertEqual(self.refresher.get('RS.xml'), 'second')
+        self.assertEqual(self.refresher.get_ages(), {'RS.xml': 0.0})
+
+    def test_failed_refresh(self):
+        self.values = ['first', SourceError('Bad Gateway'), SourceError('Bad Gateway'), 'second']
+        self.refresher.get('RS.xml')
+        self.now = 100.0
+        with self.assertLogs('ticketsapi.handlers.flights_refresh', 'WARNING'):
+            self.assertEqual(self.refresher.get('RS.xml'), 'first')
+            self.wait_refreshed()
+        self.assertEqual(self.refresher.get_ages(), {'RS.xml': 100.0})
+
+        # The last good snapshot is too old, the request waits for the source
+        self.now = 700.0
+        with self.assertRaises(SourceError):
+            self.refresher.get('RS.xml')
+        self.assertEqual(self.refresher.get('RS.xml'), 'second')
+        self.assertEqual(len(self.fetched), 4)
+
+
+class SingleFlightTests(SimpleTestCase):
+    """
+    Concurrent identical computations run once and share their result
+    """
+
+    def test_do(self):
+        single_flight = SingleFlight()
+        started, release = Event(), Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(None)
+            started.set()
+            release.wait()
+            return object()
+
+        coalesced = coalesced_calls.value
+        threads = [Thread(target=lambda: results.append(single_flight.do('RS.xml', compute))) for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        # The others wait for the first call
+        for _ in range(500):
+            if coalesced_calls.value == coalesced + 3:
+                break
+            sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(calls), coalesced_calls.value), (1, coalesced + 3))
+        self.assertEqual(len(set(map(id, results))), 1)
+
+        # Finished calls are not shared, errors are raised in the caller
+        def fail():
+            calls.append(None)
+            raise SourceError('Bad Gateway')
+
+        with self.assertRaises(SourceError):
+            single_flight.do('RS.xml', fail)
+        self.assertEqual(len(calls), 2)
+
+    def test_submit(self):
+        single_flight = SingleFlight()
+        future = single_flight.submit('RS.xml', Future)
+        self.assertIs(single_flight.submit('RS.xml', Future), future)
+        future.set_result('first')
+        self.assertIsNot(single_flight.submit('RS.xml', Future), future)
+
+    @skipUnless(SharedResults.is_available(), 'fcntl is not available')
+    def test_shared_results(self):
+        result = from_xml_to_result(settings.FLIGHTS_SOURCES['1'])
+        calls = []
+
+        def compute():
+            calls.append(None)
+            return result
+
+        with TemporaryDirectory() as directory:
+            # Another process uses another instance with the same directory
+            first, second = SharedResults(directory), SharedResults(directory)
+            self.assertIs(first.do('RS.xml', compute), result)
+            loaded = second.do('RS.xml', compute)
+            self.assertEqual(len(calls), 1)
+            self.assertIsNot(loaded, result)
+            self.assertEqual(loaded.as_dict(), result.as_dict())
+            self.assertEqual(loaded.options[0].total_amount, result.options[0].total_amount)
+            self.assertEqual(sorted(name.split('.')[1] for name in os.listdir(directory)), ['lock', 'pickle'])
+
+            # Results older than ttl are computed again
+            for name in os.listdir(directory):
+                os.utime(join(directory, name), (0, 0))
+            self.assertIs(second.do('RS.xml', compute), result)
+            self.assertEqual(len(calls), 2)
+
+
+class SnapshotTests(SimpleTestCase):
+    """
+    Snapshots keep parsed responses exactly, damaged snapshots are rejected
+    """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = join(self.directory.name, 'response.snapshot')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        for source in settings.FLIGHTS_SOURCES.values():
+            result = from_xml_to_result(source)
+            write_snapshot(result, self.path)
+            snapshot = open_snapshot(self.path)
+            self.assertEqual(snapshot.as_dict(), result.as_dict())
+            if not flights_columns.is_available():
+                continue
+            # Columns of snapshots are read from the mapping, not from the options
+            columns, snapshot_columns = flights_columns.get_columns(result), flights_columns.get_columns(snapshot)
+            for name in ('total_price', 'duration', 'stops'):
+                self.assertEqual(getattr(snapshot_columns, name).tolist(), getattr(columns, name).tolist(), name)
+            for url in SUMMARY_KEYS.values():
+                self.assertEqual(get_method_data(url, snapshot, 'numpy'), get_method_data(url, result, 'python'))
+
+    def test_damaged_snapshot(self):
+        write_snapshot(from_xml_to_result(settings.FLIGHTS_SOURCES['1']), self.path)
+        with open(self.path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        header_length = int.from_bytes(data[8:12], 'little')
+        header = json.loads(data[12:12 + header_length])
+
+        def replace_header(**values):
+            changed = json.dumps(dict(header, **values)).encode()
+            return data[:8] + len(changed).to_bytes(4, 'little') + changed + data[12 + header_length:]
+
+        damaged_files = (
+            b'', data[:4], data[:20], data[:len(data) // 2], b'NOTSNAP!' + data[8:],
+            replace_header(request_id=None, columns={}), replace_header(options=header['options'] + 1),
+            replace_header(columns=dict(header['columns'], duration=[0, 'q'])),
+            data[:8] + b'\x02\x00\x00\x00[]' + data[14:],
+        )
+        for damaged in damaged_files:
+            with open(self.path, 'wb') as snapshot_file:
+                snapshot_file.write(damaged)
+            with self.assertRaises(ParseError, msg=damaged[:20]):
+                open_snapshot(self.path)
+        with self.assertRaises(SourceError):
+            open_snapshot(join(self.directory.name, 'missing.snapshot'))
+
+
+class ArchiveTests(SimpleTestCase):
+    """
+    Compressed files and archive members are parsed like plain XML files
+    """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.sources = []
+        for source in settings.FLIGHTS_SOURCES.values():
+            self.sources.append(join(self.directory.name, basename(source)))
+            shutil.copy(source, self.sources[-1])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_compressed_files(self):
+        for source in self.sources:
+            expected = from_xml_to_dict(source)
+            for compression in COMPRESSIONS:
+                if is_available(compression):
+                    self.assertEqual(from_xml_to_dict(compress_file(source, compression)), expected, compression)
+
+    def test_source_size(self):
+        source = self.sources[0]
+        size = os.path.getsize(source)
+        for compression in COMPRESSIONS:
+            if is_available(compression):
+                # gzip stores only the size of the last member modulo 4 GiB, so it is not used
+                expected = None if compression == 'gzip' else size
+                self.assertEqual(get_source_size(compress_file(source, compression)), expected, compression)
+        with open(source, 'rb') as xml_file:
+            data = xml_file.read()
+        path = join(self.directory.name, 'streams.xml.xz')
+        with open(path, 'wb') as compressed_file:
+            compressed_file.write(lzma.compress(data) + b'\x00' * 4 + lzma.compress(data[:100]))
+        self.assertEqual(get_source_size(path), size + 100)
+        with open(path, 'wb') as compressed_file:
+            compressed_file.write(lzma.compress(data)[:-10])
+        self.assertIsNone(get_source_size(path))
+
+        # Compressed files of unknown size are streamed whatever their size is
+        with override_settings(FLIGHTS_STREAMING_MIN_SIZE=size + 1):
+            self.assertFalse(is_streamed(source))
+            self.assertFalse(is_streamed(source + '.xz'))
+            self.assertTrue(is_streamed(source + '.gz'))
+            self.assertTrue(is_streamed(path))
+
+    def test_archive(self):
+        path = join(self.directory.name, 'responses.xmlar')
+        members = [(basename(source), source) for source in self.sources]
+        write_archive(path, members, 'xz')
+        self.assertEqual(list(get_index(path)['members']), [name for name, _ in members])
+        for name, source in members:
+            self.assertEqual(from_xml_to_dict('{}#{}'.format(path, name)), from_xml_to_dict(source))
+        with self.assertRaises(SourceError):
+            from_xml_to_result(path + '#missing.xml')
+        with self.assertRaises(ValueError):
+            write_archive(path, members + members[:1])
+
+    def test_damaged_data(self):
+        path = compress_file(self.sources[0], 'gzip')
+        with open(path, 'rb') as compressed_file:
+            data = compressed_file.read()
+        with open(path, 'wb') as compressed_file:
+            compressed_file.write(data[:len(data) // 2])
+        with self.assertRaises(ParseError):
+            from_xml_to_result(path)
+
+        path = join(self.directory.name, 'responses.xmlar')
+        write_archive(path, [('RS.xml', self.sources[0])])
+        with open(path, 'rb') as archive:
+            data = archive.read()
+        with open(path, 'wb') as archive:
+            archive.write(data[:-10])
+        with self.assertRaises(ParseError):
+            from_xml_to_result(path + '#RS.xml')
+
+
+class FilesTests(SimpleTestCase):
+    """
+    Files are replaced atomically, failed writes leave the old file and no temporary files
+    """
+
+    def test_write_atomically(self):
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'data.bin')
+            write_atomically(path, lambda output: output.write(b'old'))
+
+            def write(output):
+                output.write(b'partial')
+                raise OSError('No space left on device')
+
+            with self.assertRaises(OSError):
+                write_atomically(path, write)
+            self.assertEqual(os.listdir(directory), ['data.bin'])
+            with open(path, 'rb') as data_file:
+                self.assertEqual(data_file.read(), b'old')
+
+
+class IngestTests(SimpleTestCase):
+    """
+    Ingestion writes every option once and resumes from the checkpoint
+    """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.input = join(self.directory.name, 'input')
+        self.output = join(self.directory.name, 'output')
+        os.makedirs(self.input)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_records(self):
+        records = []
+        for name in sorted(os.listdir(self.output)):
+            if name.startswith('part-'):
+                with open(join(self.output, name)) as part:
+                    records.extend(json.loads(line) for line in part)
+        return records
+
+    def test_resume(self):
+        one_way, with_return = settings.FLIGHTS_SOURCES['0'], settings.FLIGHTS_SOURCES['1']
+        shutil.copy(one_way, join(self.input, 'RS_1.xml'))
+        stats = ingest([self.input], self.output, workers=1, chunk_size=1, log=[].append)
+        self.assertEqual((stats['files'], stats['skipped'], stats['failed']), (1, 0, 0))
+
+        # An interrupted run leaves an output without a checkpoint line and an incomplete checkpoint line
+        with open(join(self.output, 'part-orphan.jsonl'), 'w') as orphan:
+            orphan.write('{}\n')
+        with open(join(self.output, CHECKPOINT), 'a') as checkpoint:
+            checkpoint.write('{"files": ["')
+        write_archive(join(self.input, 'more.xmlar'), [('RS_2.xml', with_return), ('RS_3.xml', one_way)])
+        with open(join(self.input, 'broken.xml'), 'w') as broken:
+            broken.write('<AirFareSearchResponse>')
+
+        stats = ingest([self.input], self.output, workers=1, chunk_size=2, log=[].append)
+        self.assertEqual((stats['files'], stats['skipped'], stats['failed']), (3, 1, 1))
+        one_way_count, with_return_count = len(from_xml_to_dict(one_way)['flights']), len(
+            from_xml_to_dict(with_return)['flights']
+        )
+        self.assertEqual(stats['options'], one_way_count + with_return_count)
+        records = self.read_records()
+        self.assertEqual(len(records), 2 * one_way_count + with_return_count)
+        self.assertEqual(
+            {record['file'] for record in records},
+            {join(self.input, name) for name in ('RS_1.xml', 'more.xmlar#RS_2.xml', 'more.xmlar#RS_3.xml')}
+        )
+
+        stats = ingest([self.input], self.output, workers=1, log=[].append)
+        self.assertEqual((stats['files'], stats['skipped']), (0, 4))
+        self.assertEqual(len(self.read_records()), len(records))
+
+
+class HistoryTests(TestCase):
+    """
+    The price history keeps the minimum of every bucket and drops points older than the retention
+    """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        result = from_xml_to_result(settings.FLIGHTS_SOURCES['0'])
+        self.result = result.replace(option for option in result.options if get_route(option) == 'DXB-BKK')
+        self.options = self.result.options
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_search(self, options, response_time):
+        """
+        :param options: iterable of <class 'PricedOption'> of the search
+        :param response_time: <class 'str'> - ResponseTime of the search, e.g. '22-10-2018 10:05:00'
+        :return: <class 'SearchResult'>
+        """
+        result = self.result.replace(options)
+        result.response_time = response_time
+        return result
+
+    def test_round_trip(self):
+        history = PriceHistory(self.directory.name)
+        self.assertEqual(history.record(self.make_search(self.options, '22-10-2018 10:05:00')), ['DXB-BKK'])
+        time = parse_timestamp('2018-10-22T1005')
+        cheapest = min(option.total_amount for option in self.options)
+        fastest = min(option.duration for option in self.options)
+        self.assertEqual(history.query('DXB-BKK', level='raw'), ('raw', [(time, 0, 'SGD', cheapest, fastest)]))
+
+        option = self.options[-1]
+        points = history.query('DXB-BKK', chain=get_chain_name(option), level='raw')[1]
+        self.assertEqual(points, [(time, 0, 'SGD', option.total_amount, option.duration)])
+        self.assertEqual(history.query('DXB-BKK', return_tickets=1, level='raw'), ('raw', []))
+        # Another instance reads the same files
+        self.assertEqual(PriceHistory(self.directory.name).query('DXB-BKK', level='raw'), history.query(
+            'DXB-BKK', level='raw'
+        ))
+
+    def test_compaction(self):
+        history = PriceHistory(self.directory.name)
+        cheapest = min(self.options, key=lambda option: (option.total_amount, option.duration))
+        fastest = min(self.options, key=lambda option: (option.duration, option.total_amount))
+        self.assertNotEqual(cheapest.duration, fastest.duration)
+        expensive = max(self.options, key=lambda option: option.total_amount)
+        history.record(self.make_search([cheapest], '22-10-2018 10:05:00'))
+        history.record(self.make_search([fastest], '22-10-2018 10:40:00'))
+        history.record(self.make_search([expensive], '22-10-2018 11:10:00'))
+
+        hour, day = parse_timestamp('2018-10-22T1000'), parse_timestamp('2018-10-22T0000')
+        expected = {
+            'hour': [(hour, 0, 'SGD', cheapest.total_amount, fastest.duration),
+                     (hour + 60, 0, 'SGD', expensive.total_amount, expensive.duration)],
+            'day': [(day, 0, 'SGD', cheapest.total_amount, fastest.duration)],
+        }
+        for _ in range(2):
+            # Raw points are merged into the levels before and after the compaction, merging twice changes nothing
+            for level, points in expected.items():
+                self.assertEqual(history.query('DXB-BKK', level=level), (level, points))
+            # Every search has a point of the route minimum and a point of its chain
+            self.assertEqual(history.compact('DXB-BKK'), {'raw': 6, 'hour': 5, 'day': 4})
+
+    def test_retention(self):
+        history = PriceHistory(self.directory.name, {'raw': 3600, 'hour': 24 * 3600})
+        for response_time in ('20-10-2018 10:05:00', '22-10-2018 10:05:00', '22-10-2018 10:50:00'):
+            history.record(self.make_search(self.options[:1], response_time))
+        history.compact('DXB-BKK')
+        times = {level: [point[0] for point in history.query('DXB-BKK', level=level)[1]] for level in LEVELS}
+        self.assertEqual(times, {
+            'raw': [parse_timestamp('2018-10-22T1005'), parse_timestamp('2018-10-22T1050')],
+            'hour': [parse_timestamp('2018-10-22T1000')],
+            'day': [parse_timestamp('2018-10-20T0000'), parse_timestamp('2018-10-22T0000')],
+        })
+        # The finest level that keeps the range is chosen
+        self.assertEqual(history.query('DXB-BKK', time_from=parse_timestamp('2018-10-22T1000'))[0], 'raw')
+        self.assertEqual(history.query('DXB-BKK', time_from=parse_timestamp('2018-10-21T1200'))[0], 'hour')
+        self.assertEqual(history.query('DXB-BKK', time_from=parse_timestamp('2018-10-19T0000'))[0], 'day')
+
+    def test_concurrent_record(self):
+        # Every thread has its own instance, like processes sharing the directory
+        searches = [
+            self.make_search(self.options, '22-10-2018 10:{:02d}:00'.format(minute)) for minute in range(20)
+        ]
+        errors = []
+
+        def record(search):
+            try:
+                PriceHistory(self.directory.name).record(search)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [Thread(target=record, args=(search,)) for search in searches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        history = PriceHistory(self.directory.name)
+        points = len(get_search_points(searches[0])['DXB-BKK'])
+        self.assertEqual(len(history.read('raw', 'DXB-BKK')), len(searches) * points * RECORD_SIZE)
+        with open(join(self.directory.name, 'series.jsonl')) as series_file:
+            self.assertEqual(len(series_file.readlines()), points)
+        self.assertEqual(len(history.query('DXB-BKK', level='raw')[1]), len(searches))
+
+    def test_view(self):
+        url = '/flights.getPriceHistory?source=DXB&destination=BKK'
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with override_settings(FLIGHTS_PRICE_HISTORY={'DIRECTORY': self.directory.name}):
+            self.assertEqual(get_json(self.client.get(url))['response']['points'], [])
+            get_history().record(self.make_search(self.options, '22-10-2018 10:05:00'))
+            option = self.options[0]
+            response = get_json(self.client.get(url + '&resolution=hour&return=0&chain={}'.format(
+                quote(get_chain_name(option))
+            )))
+            self.assertEqual(response, {'response': {'route': 'DXB-BKK', 'resolution': 'hour', 'points': [{
+                'time': '2018-10-22T1000', 'return_tickets': 0, 'currency': 'SGD',
+                'price': str(option.total_amount), 'duration': option.duration
+            }]}})
+            response = get_json(self.client.get(url + '&from=2018-10-22T1000&to=2018-10-22T1100'))['response']
+            self.assertEqual((response['resolution'], len(response['points'])), ('raw', 1))
+
+            for params in ('source=DXB', 'source=DXB&destination=BKK&return=2', 'source=../x&destination=BKK',
+                           'source=DXB&destination=BKK&resolution=week', 'source=DXB&destination=BKK&from=22-10-2018'):
+                response = self.client.get('/flights.getPriceHistory?' + params)
+                self.assertEqual(response.status_code, 400, params)
+                self.assertEqual(get_json(response), {'error': 'Bad Request (400)'})
+
+
+class StoredTests(TestCase):
+    """
+    Stored search responses are queried like the XML files
+    """
+
+    def get_flights(self, url):
+        return get_json(self.client.get(url))['response']
+
+    @staticmethod
+    def get_price(flight):
+        return sum(
+            Decimal(charge['price']) for charge in flight['pricing']['service_charges']
+            if charge['charge_type'] == 'TotalAmount'
+        )
+
+    def test_stored_methods(self):
+        source = settings.FLIGHTS_SOURCES['1']
+        result = from_xml_to_result(source)
+        self.assertEqual(self.get_flights('/stored.getCheapest')['flights'], [])
+        store_result(result, source)
+
+        data = from_xml_to_dict(source)
+        for url in METHODS:
+            flights = self.get_flights('/stored.{}'.format(url))['flights']
+            self.assertTrue(all(flight.pop('request_id') == result.request_id for flight in flights), url)
+            self.assertEqual(flights, get_baseline_flights(url, data), url)
+
+    def test_stored_all(self):
+        results = {}
+        for source in settings.FLIGHTS_SOURCES.values():
+            results[source] = from_xml_to_result(source)
+            store_result(results[source], source)
+        total = sum(len(result.options) for result in results.values())
+
+        response = self.get_flights('/stored.getAll')
+        prices = [self.get_price(flight) for flight in response['flights']]
+        self.assertEqual((len(prices), response['total'], response['next_offset']), (total, total, None))
+        self.assertEqual(prices, sorted(prices))
+
+        page = self.get_flights('/stored.getAll?offset=10&limit=5')
+        self.assertEqual(page['flights'], response['flights'][10:15])
+        self.assertEqual((page['total'], page['offset'], page['next_offset']), (total, 10, 15))
+
+        option = results[settings.FLIGHTS_SOURCES['0']].options[0]
+        route = {
+            'source': option.onward.flights[0].source, 'destination': option.onward.flights[-1].destination,
+            'date': format_timestamp(option.onward.departure)[:10]
+        }
+        flights = self.get_flights('/stored.getAll?{}'.format(urlencode(route)))['flights']
+        self.assertTrue(flights)
+        for flight in flights:
+            onward = flight['onward_itinerary']
+            self.assertEqual(
+                (onward[0]['source'], onward[-1]['destination'], onward[0]['departure_time'][:10]),
+                (route['source'], route['destination'], route['date'])
+            )
+        self.assertEqual(self.get_flights('/stored.getAll?date=2000-01-01')['flights'], [])
+
+        flights = self.get_flights('/stored.getAll?max_stops=0&max_price=1500')['flights']
+        self.assertTrue(flights)
+        for flight in flights:
+            self.assertLessEqual(self.get_price(flight), 1500)
+            self.assertEqual(len(flight['onward_itinerary']), 1)
+            self.assertEqual(len(flight.get('return_itinerary', [None])), 1)
+
+        for url in ('/stored.getAll?date=22.10.2018', '/stored.getAll?offset=-1', '/stored.getCheapest?max_stops=x'):
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+
+class RoutesTests(TestCase):
+    """
+    Routes are built from stored segments within the layover and legs limits
+    """
+
+    def setUp(self):
+        self.timetable = Timetable([
+            make_flight('1', 'AAA', 'BBB', '2018-10-22T0800', '2018-10-22T1000'),
+            # The layover after flight 1 is shorter than the default minimum
+            make_flight('2', 'BBB', 'CCC', '2018-10-22T1030', '2018-10-22T1130'),
+            make_flight('3', 'BBB', 'CCC', '2018-10-22T1100', '2018-10-22T1300'),
+            make_flight('4', 'AAA', 'CCC', '2018-10-22T0900', '2018-10-22T1500'),
+            make_flight('5', 'CCC', 'DDD', '2018-10-22T1600', '2018-10-22T1800'),
+            # The same flight of another itinerary is kept once
+            make_flight('4', 'AAA', 'CCC', '2018-10-22T0900', '2018-10-22T1500'),
+        ])
+
+    def get_route(self, destination, **params):
+        route = self.timetable.find_route('AAA', destination, parse_timestamp('2018-10-22T0000'), **params)
+        return None if route is None else [flight.flight_number for flight in route.flights]
+
+    def test_find_route(self):
+        self.assertEqual(len(self.timetable), 5)
+        self.assertEqual(self.get_route('CCC'), ['1', '3'])
+        self.assertEqual(self.get_route('CCC', optimize='stops'), ['4'])
+        self.assertEqual(self.get_route('CCC', min_layover=30), ['1', '2'])
+        # Both routes arrive at the same time, the one with fewer legs is chosen
+        self.assertEqual(self.get_route('DDD'), ['4', '5'])
+        self.assertEqual(self.get_route('DDD', departure_to=parse_timestamp('2018-10-22T0830')), ['1', '3', '5'])
+        self.assertIsNone(self.get_route('DDD', max_legs=1))
+        self.assertIsNone(self.get_route('DDD', max_layover=30))
+        self.assertIsNone(self.get_route('CCC', departure_to=parse_timestamp('2018-10-22T0700')))
+
+    @override_settings(FLIGHTS_ROUTES_CHECK_INTERVAL=0)
+    def test_stored_routes(self):
+        url = '/routes.getEarliestArrival?source=DXB&destination=BKK&departure_from=2018-10-22T0000'
+        self.assertEqual(get_json(self.client.get(url))['response']['route'], [])
+
+        for source in settings.FLIGHTS_SOURCES.values():
+            store_result(from_xml_to_result(source), source)
+        response = get_json(self.client.get(url))['response']
+        route = response['route']
+        self.assertEqual((route[0]['source'], route[-1]['destination']), ('DXB', 'BKK'))
+        self.assertGreaterEqual(route[0]['departure_time'], '2018-10-22T0000')
+        duration = parse_timestamp(route[-1]['arrival_time']) - parse_timestamp(route[0]['departure_time'])
+        self.assertEqual(response['duration'], duration)
@@ -1,16 +1,176 @@
 from rest_framework.decorators import api_view
 from rest_framework import status
-from django.http import JsonResponse
-from os.path import join
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from datetime import date
+from functools import wraps
+import asyncio
+import logging
+import math
+from asgiref.sync import sync_to_async
 from rest_framework.response import Response
 from rest_framework.parsers import JSONParser
 
-from ticketsapi.handlers.flights_handler import get_flights, get_by, get_optimal, get_difference
+from ticketsapi.handlers.flights_handler import (
+    ENGINES, get_flights, get_difference, get_by_streaming, get_optimal_streaming, iter_flights_json, get_engine,
+    get_page_data, get_flights_many, get_method_data, flights_cache, is_streamed, project_response, submit_flights,
+    get_summary_streaming
+)
+from ticketsapi.handlers.flights_async import fetch_many_async, get_flights_async, get_flights_many_async
+from ticketsapi.handlers.flights_diff import get_chain_index, iter_difference_json
+from ticketsapi.handlers.flights_fanout import failed_sources, fetch_many
+from ticketsapi.handlers.flights_history import LEVELS, get_history, get_route_name, is_route_name
+from ticketsapi.handlers.flights_index import FlightsQuery, filter_flights
+from ticketsapi.handlers.flights_model import format_timestamp, parse_timestamp
+from ticketsapi.handlers.flights_ranking import CRITERIA, get_top, get_pareto_frontier
+from ticketsapi.handlers.flights_renderer import get_rendered, json_response
+from ticketsapi.handlers.flights_routes import MAX_LAYOVER, MAX_LEGS, MIN_LAYOVER, get_timetable
+from ticketsapi.handlers.flights_store import get_stored_by, get_stored_options, load_options
+from ticketsapi.handlers.errors import FlightsError
+from ticketsapi.handlers.flights_parser import get_fields, skipped_itineraries
+from ticketsapi.handlers.flights_refresh import get_snapshot_ages
+from ticketsapi.handlers.single_flight import coalesced_calls
+from ticketsapi.handlers.timing import expose_value, expose_values, stage, stage_histogram
 from ticketsapi.models import Method
 from ticketsapi.serializers import MethodSerializer
 
+logger = logging.getLogger(__name__)
+
+
+def handle_flights_errors(view):
+    """
+    Decorator that turns fatal errors of flight data processing into responses with their HTTP status
+    (see handlers.errors), e.g. 502 if the external supplier is unavailable.
+    Async views are decorated by an async wrapper.
+    """
+    def get_error_response(error):
+        logger.warning('%s: %s', error.__class__.__name__, error)
+        return JsonResponse({'error': error.error}, status=error.status)
+
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapped_async(*args, **kwargs):
+            try:
+                return await view(*args, **kwargs)
+            except FlightsError as error:
+                return get_error_response(error)
+        return wrapped_async
+
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except FlightsError as error:
+            return get_error_response(error)
+    return wrapped
+
+
+def get_flights_params(request, url):
+    """
+    Validates parameters of flights_view
+
+    :param request: <class 'django.http.HttpRequest'>
+    :param url: <class 'str'> - method, e.g. 'getAll'
+    :return: dictionary with 'source' or 'sources' (dictionary: name -> source), 'engine', 'deadline',
+    'query', 'offset', 'limit' and 'fields'; None if the parameters are wrong
+    """
+    return_flights = request.GET.get('return', '1')
+    engine = request.GET.get('engine')
+    if engine is not None and engine not in ENGINES:
+        return None
+
+    params = {'source': None, 'sources': None, 'engine': engine, 'query': None, 'offset': 0, 'limit': None}
+    sources = request.GET.get('sources')
+    if sources is not None:
+        names = sources.split(',')
+        if any(name not in settings.FLIGHTS_SOURCES for name in names):
+            return None
+        params['sources'] = {name: settings.FLIGHTS_SOURCES[name] for name in names}
+    elif return_flights not in settings.FLIGHTS_SOURCES:
+        return None
+    else:
+        params['source'] = settings.FLIGHTS_SOURCES[return_flights]
+
+    try:
+        deadline = float(request.GET.get('deadline', settings.FLIGHTS_FANOUT_DEADLINE * 1000)) / 1000
+        if not math.isfinite(deadline) or deadline < 0:
+            return None
+        params['deadline'] = min(deadline, getattr(settings, 'FLIGHTS_FANOUT_MAX_DEADLINE', 30.0))
+        params['fields'] = get_fields(request.GET['fields']) if 'fields' in request.GET else None
+        if url == 'getAll':
+            params['query'] = FlightsQuery.from_params(request.GET)
+            params['offset'] = int(request.GET.get('offset', '0'))
+            params['limit'] = int(request.GET['limit']) if 'limit' in request.GET else None
+    except ValueError:
+        return None
+    if params['offset'] < 0 or (params['limit'] is not None and params['limit'] < 0):
+        return None
+    if params['query'] is not None and params['query'].is_empty():
+        params['query'] = None
+    return params
+
+
+def get_streamed_response(url, source, params):
+    """
+    Large responses are never loaded into memory as a whole (see flights_handler.is_streamed)
+
+    :param url: <class 'str'> - method, e.g. 'getAll'
+    :param source: <class 'str'> - path where the XML file is located
+    :param params: dictionary returned by get_flights_params
+    :return: <class 'django.http.HttpResponse'>
+    """
+    if url == 'getAll':
+        return StreamingHttpResponse(
+            iter_flights_json(source, params['query'], params['offset'], params['limit'], params['fields']),
+            content_type='application/json'
+        )
+    elif url == 'getMostExpensive':
+        result = get_by_streaming('price', source, max)
+    elif url == 'getCheapest':
+        result = get_by_streaming('price', source, min)
+    elif url == 'getLongest':
+        result = get_by_streaming('duration', source, max)
+    elif url == 'getFastest':
+        result = get_by_streaming('duration', source, min)
+    elif url == 'getOptimal':
+        result = get_optimal_streaming(source)
+    elif url == 'getSummary':
+        response = get_summary_streaming(source)
+        return json_response({'response': project_response(response, params['fields'])}, status=status.HTTP_200_OK)
+    return json_response({'response': project_response(result.as_dict(), params['fields'])}, status=status.HTTP_200_OK)
+
+
+def get_flights_response(request, url, result, params, statuses=None):
+    """
+    :param request: <class 'django.http.HttpRequest'>
+    :param url: <class 'str'> - method, e.g. 'getAll'
+    :param result: <class 'SearchResult'> with flights data
+    :param params: dictionary returned by get_flights_params
+    :param statuses: dictionary: source name -> status for fan-out requests, else None
+    :return: <class 'django.http.HttpResponse'>
+    """
+    query, offset, limit, fields = params['query'], params['offset'], params['limit'], params['fields']
+    if url == 'getAll' and (query is not None or offset or limit is not None):
+        result, total = filter_flights(result, query or FlightsQuery(), offset, limit)
+        response = project_response(result.as_dict(), fields)
+        response.update(get_page_data(total, offset, limit))
+    elif statuses is None and fields is None:
+        # The response depends only on the parsed data: it is serialized once and served with ETag.
+        # Projections are not kept: the fields come from the client, so their combinations are unbounded
+        rendered = get_rendered(
+            result, url, lambda flights: {'response': get_method_data(url, flights, params['engine'])}
+        )
+        return rendered.to_response(request)
+    else:
+        response = project_response(get_method_data(url, result, params['engine']), fields)
+
+    if statuses is not None:
+        response['sources'] = statuses
+    return json_response({'response': response}, status=status.HTTP_200_OK)
+
 
 @api_view(['GET'])
+@handle_flights_errors
 def flights_view(request, url):
     """
     View flights.
@@ -21,41 +181,307 @@ def flights_view(request, url):
     * If url = 'getLongest', then returns longest flights.
     * If url = 'getFastest', then returns fastest flights.
     * If url = 'getOptimal', then returns the best flights.
+    * If url = 'getSummary', then returns all of the above except 'getAll' at once.
+
+    The 'engine' parameter ('python' or 'numpy') chooses how the queries are computed.
+
+    'getAll' supports filters (see FlightsQuery): 'carrier', 'max_stops', 'departure_from', 'departure_to',
+    'max_price', 'via', and pagination: 'offset', 'limit'.
+
+    The 'fields' parameter (comma-separated segment fields, e.g. 'carrier_id,departure_time,arrival_time')
+    limits the fields of segments in the response; streamed responses parse only these fields.
+
+    The 'sources' parameter (comma-separated keys of FLIGHTS_SOURCES, e.g. '0,1') enables fan-out:
+    the sources are fetched concurrently, their flights are merged and deduplicated.
+    Sources that are not ready in 'deadline' ms are skipped, their status is returned in 'sources'.
+    """
+    params = get_flights_params(request, url)
+    if params is None:
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if params['sources'] is not None:
+        # Fan-out: all sources are fetched concurrently, results are merged and deduplicated
+        result, statuses = get_flights_many(params['sources'], params['deadline'])
+        if result is None:
+            return JsonResponse(
+                {'error': 'Bad Gateway (502)', 'sources': statuses}, status=status.HTTP_502_BAD_GATEWAY
+            )
+        return get_flights_response(request, url, result, params, statuses)
+
+    if is_streamed(params['source']):
+        return get_streamed_response(url, params['source'], params)
+    return get_flights_response(request, url, get_flights(params['source']), params)
+
+
+@handle_flights_errors
+async def flights_async_view(request, url):
+    """
+    Async version of flights_view used by the ASGI application (see the FLIGHTS_ASYNC_VIEWS setting).
+    Requests to external suppliers are awaited, so they do not occupy a thread (see handlers.flights_async);
+    parsing, ranking and serialization run in threads.
+
+    Streamed 'getAll' responses of large local files are iterated by the server on the event loop,
+    serve such files as snapshots (see the convert_snapshots command) when the ASGI application is used.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)},
+                            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    params = get_flights_params(request, url)
+    if params is None:
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+
+    statuses = None
+    if params['sources'] is not None:
+        result, statuses = await get_flights_many_async(params['sources'], params['deadline'])
+        if result is None:
+            return JsonResponse(
+                {'error': 'Bad Gateway (502)', 'sources': statuses}, status=status.HTTP_502_BAD_GATEWAY
+            )
+    elif is_streamed(params['source']):
+        return await sync_to_async(get_streamed_response, thread_sensitive=False)(url, params['source'], params)
+    else:
+        with stage('fetch'):
+            result = await get_flights_async(params['source'])
+    return await sync_to_async(get_flights_response, thread_sensitive=False)(request, url, result, params, statuses)
+
+
+@api_view(['GET'])
+@handle_flights_errors
+def flights_top_view(request):
+    """
+    View the best flights by a weighted score.
+
+    * 'k' - number of flights to return (20 by default).
+    * 'price', 'duration', 'stops' - weights of the criteria (1, 1 and 0 by default).
+    Each criterion is scaled to [0, 1] before weighting, lower score is better.
+    * 'pareto=1' - choose only from flights that are not dominated by price and duration.
+    * 'return' and 'engine' - the same as in flights_view.
     """
     return_flights = request.GET.get('return', '1')
+    engine = request.GET.get('engine')
+    if return_flights not in settings.FLIGHTS_SOURCES or (engine is not None and engine not in ENGINES):
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
 
-    if return_flights == '0':
-        # Flights without return itineraries
-        result = get_flights(join('ticketsapi', 'xml_files', 'RS_ViaOW.xml'))
-    elif return_flights == '1':
-        # Flights with return itineraries
-        result = get_flights(join('ticketsapi', 'xml_files', 'RS_Via-3.xml'))
+    defaults = {'price': '1', 'duration': '1', 'stops': '0'}
+    try:
+        k = int(request.GET.get('k', '20'))
+        weights = {criterion: float(request.GET.get(criterion, defaults[criterion])) for criterion in CRITERIA}
+    except ValueError:
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+    # NaN and infinite weights make every score NaN or infinite, so the order is undefined
+    if k < 0 or not all(math.isfinite(weight) for weight in weights.values()):
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+
+    result = get_flights(settings.FLIGHTS_SOURCES[return_flights])
+    if request.GET.get('pareto') == '1':
+        result = get_pareto_frontier(result)
+    result = get_top(result, k, weights, get_engine(engine))
+    return json_response({'response': result.as_dict()}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def stored_flights_view(request, url):
+    """
+    View flights of all stored search responses (see the store_flights command).
+
+    * If url = 'getAll', then returns all flights ordered by price.
+    * If url = 'getMostExpensive', 'getCheapest', 'getLongest' or 'getFastest', then returns these flights.
+
+    'source', 'destination' and 'date' ('2018-10-22') choose the route and the onward departure date.
+    Filters and pagination are the same as in flights_view 'getAll'.
+    Every flight has the 'request_id' of its search response.
+    """
+    offset, limit = 0, None
+    try:
+        query = FlightsQuery.from_params(request.GET)
+        departure_date = date(*map(int, request.GET['date'].split('-'))) if 'date' in request.GET else None
+        if url == 'getAll':
+            offset = int(request.GET.get('offset', '0'))
+            limit = int(request.GET['limit']) if 'limit' in request.GET else None
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+    if offset < 0 or (limit is not None and limit < 0):
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+
+    options = get_stored_options(request.GET.get('source'), request.GET.get('destination'), departure_date, query)
+    if url == 'getAll':
+        total = options.count()
+        end = None if limit is None else offset + limit
+        response = {'flights': load_options(options.order_by('total_amount', 'id')[offset:end])}
+        response.update(get_page_data(total, offset, limit))
     else:
+        key, func = {
+            'getMostExpensive': ('price', max), 'getCheapest': ('price', min),
+            'getLongest': ('duration', max), 'getFastest': ('duration', min)
+        }[url]
+        response = {'flights': load_options(get_stored_by(key, options, func).order_by('id'))}
+    return json_response({'response': response}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def routes_view(request, url):
+    """
+    View routes built from segments of all stored search responses (see handlers.flights_routes).
+
+    * If url = 'getEarliestArrival', then returns the route with the earliest arrival.
+    * If url = 'getFewestStops', then returns the route with the fewest flights.
+
+    'source', 'destination' and 'departure_from' ('2018-10-22T0005') are required.
+    'departure_to' limits the departure of the first flight, 'min_layover' and 'max_layover' (minutes)
+    limit the time between flights, 'max_legs' limits the number of flights.
+    """
+    try:
+        source, destination = request.GET['source'], request.GET['destination']
+        departure_from = parse_timestamp(request.GET['departure_from'])
+        departure_to = parse_timestamp(request.GET['departure_to']) if 'departure_to' in request.GET else None
+        min_layover = int(request.GET.get('min_layover', MIN_LAYOVER))
+        max_layover = int(request.GET.get('max_layover', MAX_LAYOVER))
+        max_legs = int(request.GET.get('max_legs', MAX_LEGS))
+    except (KeyError, ValueError, IndexError):
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+    if min_layover < 0 or max_layover < min_layover or max_legs < 1:
         return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
 
-    if url == 'getMostExpensive':
-        result = get_by('price', result, max)
-    elif url == 'getCheapest':
-        result = get_by('price', result, min)
-    elif url == 'getLongest':
-        result = get_by('duration', result, max)
-    elif url == 'getFastest':
-        result = get_by('duration', result, min)
-    elif url == 'getOptimal':
-        result = get_optimal(result)
+    timetable = get_timetable()
+    with stage('rank'):
+        route = timetable.find_route(
+            source, destination, departure_from, departure_to, min_layover, max_layover, max_legs,
+            'arrival' if url == 'getEarliestArrival' else 'stops'
+        )
+    if route is None:
+        response = {'route': [], 'duration': None, 'stops': None}
+    else:
+        response = {'route': route.as_list(), 'duration': route.duration, 'stops': route.stops}
+    return json_response({'response': response}, status=status.HTTP_200_OK)
 
-    return JsonResponse({'response': result}, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def price_history_view(request):
+    """
+    View the price history of a route (see handlers.flights_history): the minimum total amount and
+    the minimum duration of every search, hour or day.
+
+    'source' and 'destination' are required. 'chain' chooses one segment chain
+    (e.g. 'EK 2524 2018-10-22T0005 2018-10-22T0130'), by default the minimum of the route is returned.
+    'return' (0 or 1) chooses searches without or with return itineraries, by default both.
+    'from' and 'to' ('2018-10-22T0005') limit the time of the searches, 'resolution' is 'raw', 'hour' or 'day'
+    (by default the finest one that keeps the points from 'from').
+    """
+    history = get_history()
+    if history is None:
+        return JsonResponse({'error': 'Not Found (404)'}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        route = get_route_name(request.GET['source'], request.GET['destination'])
+        return_tickets = int(request.GET['return']) if 'return' in request.GET else None
+        time_from = parse_timestamp(request.GET['from']) if 'from' in request.GET else None
+        time_to = parse_timestamp(request.GET['to']) if 'to' in request.GET else None
+    except (KeyError, ValueError, IndexError):
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+    level = request.GET.get('resolution')
+    if return_tickets not in (None, 0, 1) or level not in (None,) + LEVELS or not is_route_name(route):
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+
+    with stage('rank'):
+        level, points = history.query(route, return_tickets, request.GET.get('chain', ''), time_from, time_to, level)
+    response = {
+        'route': route,
+        'resolution': level,
+        'points': [
+            {'time': format_timestamp(time), 'return_tickets': return_tickets, 'currency': currency,
+             'price': str(price), 'duration': duration}
+            for time, return_tickets, currency, price, duration in points
+        ]
+    }
+    return json_response({'response': response}, status=status.HTTP_200_OK)
+
+
+def get_difference_sources(request):
+    """
+    Validates parameters of flights_difference_view
+
+    :param request: <class 'django.http.HttpRequest'>
+    :return: <class 'tuple'> - (dictionary: 'first'/'second' -> source, mode) or None if the parameters are wrong
+    """
+    first, second = request.GET.get('first', '0'), request.GET.get('second', '1')
+    mode = request.GET.get('mode')
+    if first not in settings.FLIGHTS_SOURCES or second not in settings.FLIGHTS_SOURCES or mode not in (None, 'full'):
+        return None
+    return {'first': settings.FLIGHTS_SOURCES[first], 'second': settings.FLIGHTS_SOURCES[second]}, mode
 
 
 @api_view(['GET'])
+@handle_flights_errors
 def flights_difference_view(request):
     """
     View the difference between the two flight requests.
+
+    * 'first', 'second' - keys of FLIGHTS_SOURCES ('0' and '1' by default).
+    * 'mode=full' - compare all flights: the response streams added, removed and repriced flights
+    (matched by their segments, see flights_diff) and their counts.
     """
-    request1 = get_flights(join('ticketsapi', 'xml_files', 'RS_ViaOW.xml'))
-    request2 = get_flights(join('ticketsapi', 'xml_files', 'RS_Via-3.xml'))
+    params = get_difference_sources(request)
+    if params is None:
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+    sources, mode = params
+
+    results, _ = fetch_many(sources, submit_flights)
+    request1 = results.get('first')
+    request2 = results.get('second')
+    if request1 is None or request2 is None:
+        return JsonResponse({'error': 'Bad Gateway (502)'}, status=status.HTTP_502_BAD_GATEWAY)
+    if mode == 'full':
+        return StreamingHttpResponse(iter_difference_json(request1, request2), content_type='application/json')
     result = get_difference(request1, request2)
-    return JsonResponse({'response': result}, status=status.HTTP_200_OK)
+    return json_response({'response': result}, status=status.HTTP_200_OK)
+
+
+@handle_flights_errors
+async def flights_difference_async_view(request):
+    """
+    Async version of flights_difference_view used by the ASGI application (see flights_async_view).
+    With 'mode=full' the chain indexes are built in a thread, the server streams only their serialization.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)},
+                            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    params = get_difference_sources(request)
+    if params is None:
+        return JsonResponse({'error': 'Bad Request (400)'}, status=status.HTTP_400_BAD_REQUEST)
+    sources, mode = params
+
+    results, _ = await fetch_many_async(sources)
+    request1 = results.get('first')
+    request2 = results.get('second')
+    if request1 is None or request2 is None:
+        return JsonResponse({'error': 'Bad Gateway (502)'}, status=status.HTTP_502_BAD_GATEWAY)
+    if mode == 'full':
+        await sync_to_async(get_chain_index, thread_sensitive=False)(request1)
+        await sync_to_async(get_chain_index, thread_sensitive=False)(request2)
+        return StreamingHttpResponse(iter_difference_json(request1, request2), content_type='application/json')
+    result = await sync_to_async(get_difference, thread_sensitive=False)(request1, request2)
+    return json_response({'response': result}, status=status.HTTP_200_OK)
+
+
+def metrics_view(request):
+    """
+    View request stage histograms and cache counters in the Prometheus text format.
+    Histograms are filled only if the FLIGHTS_TIMING_ENABLED setting is True.
+    """
+    cache = flights_cache.stats()
+    lines = stage_histogram.expose()
+    lines += skipped_itineraries.expose()
+    lines += coalesced_calls.expose()
+    lines += failed_sources.expose()
+    lines += expose_value(
+        'flights_cache_hits_total', 'Parsed responses served from the cache', 'counter', cache['hits']
+    )
+    lines += expose_value('flights_cache_misses_total', 'XML responses parsed on request', 'counter', cache['misses'])
+    lines += expose_value('flights_cache_size', 'Parsed responses kept in the cache', 'gauge', cache['size'])
+    lines += expose_values(
+        'flights_snapshot_age_seconds', 'Age of the served snapshot of the source', 'gauge', 'source',
+        get_snapshot_ages()
+    )
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @api_view(['GET', 'POST'])